@@ -13,12 +13,21 @@ from datetime import datetime
 ACS_BASE_URL = "http://localhost:8080"
 
 
-def list_devices():
-    """List all devices"""
+def list_devices(filters=None, page_size=500):
+    """List devices, paging through the ACS with its cursor"""
+    query = {key: value for key, value in (filters or {}).items() if value is not None}
+    query['limit'] = page_size
+    query['fields'] = 'id,manufacturer,product_class,serial_number,online,last_inform,software_version'
     try:
-        response = requests.get(f"{ACS_BASE_URL}/api/devices")
-        response.raise_for_status()
-        devices = response.json()
+        devices = []
+        while True:
+            response = requests.get(f"{ACS_BASE_URL}/api/devices", params=query)
+            response.raise_for_status()
+            page = response.json()
+            devices.extend(page['devices'])
+            if not page['next_cursor']:
+                break
+            query['cursor'] = page['next_cursor']
         
         if not devices:
             print("No devices found.")
@@ -89,10 +98,11 @@ def show_device(device_id):
         sys.exit(1)
 
 
-def list_parameters(device_id):
-    """List device parameters"""
+def list_parameters(device_id, prefix=None, depth=None):
+    """List device parameters, optionally only a subtree (the ACS filters them)"""
     try:
-        response = requests.get(f"{ACS_BASE_URL}/api/devices/{device_id}/parameters")
+        query = {key: value for key, value in (('prefix', prefix), ('depth', depth)) if value is not None}
+        response = requests.get(f"{ACS_BASE_URL}/api/devices/{device_id}/parameters", params=query)
         response.raise_for_status()
         parameters = response.json()
         
@@ -276,6 +286,220 @@ def list_tasks(device_id):
         sys.exit(1)
 
 
+def bulk_task(task_type, parameters, device_ids, device_filter, connection_request):
+    """Queue a task on many devices as a bulk job"""
+    if task_type == 'factory_reset':
+        print("⚠️  WARNING: This will factory reset every targeted device!")
+        if input("Type 'yes' to confirm: ").lower() != 'yes':
+            print("Cancelled.")
+            return
+    
+    body = {'type': task_type, 'connection_request': connection_request}
+    if task_type == 'get_params':
+        body['parameters'] = {'names': parameters}
+    elif task_type == 'set_params':
+        body['parameters'] = {'values': dict(param.split('=', 1) for param in parameters)}
+    if device_ids:
+        body['device_ids'] = device_ids
+    else:
+        body['filter'] = {key: value for key, value in device_filter.items() if value is not None}
+    
+    try:
+        response = requests.post(f"{ACS_BASE_URL}/api/tasks/bulk", json=body)
+        if response.status_code == 400:
+            print(f"Error: {response.json()['detail']}")
+            sys.exit(1)
+        response.raise_for_status()
+        job = response.json()
+        print(f"✅ Job {job['id']} started")
+        print(f"   Follow it with: acs_cli.py job {job['id']}")
+    except requests.exceptions.RequestException as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+
+
+def show_job(job_id, cancel=False):
+    """Show (or cancel) a bulk job"""
+    try:
+        if cancel:
+            response = requests.post(f"{ACS_BASE_URL}/api/jobs/{job_id}/cancel")
+            if response.status_code == 409:
+                print(f"Error: {response.json()['detail']}")
+                sys.exit(1)
+            response.raise_for_status()
+            print(f"✅ {response.json()['message']} ({response.json()['tasks_withdrawn']} tasks withdrawn)")
+        
+        response = requests.get(f"{ACS_BASE_URL}/api/jobs/{job_id}")
+        response.raise_for_status()
+        job = response.json()
+        
+        print(f"\nJob {job['id']}: {job['task_type']} ({job['status']})")
+        print(f"Target:          {json.dumps(job['target'])}")
+        print(f"Devices matched: {job['devices_matched']}")
+        if job['devices_missing']:
+            print(f"Devices missing: {job['devices_missing']}")
+        print(f"Tasks created:   {job['tasks_created']}")
+        for status, count in sorted(job['tasks'].items()):
+            print(f"  {status:<14} {count}")
+        if job['error']:
+            print(f"Error:           {job['error']}")
+        print()
+    except requests.exceptions.RequestException as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+
+
+def start_campaign(task_type, parameters, device_filter, waves, rate, max_in_flight, window, timezone,
+                   connection_request, name=None):
+    """Start a staged rollout of a task over the devices matching a filter"""
+    body = {'type': task_type, 'filter': {key: value for key, value in device_filter.items() if value is not None},
+            'connection_request': connection_request}
+    if name:
+        body['name'] = name
+    if task_type == 'get_params':
+        body['parameters'] = {'names': parameters}
+    elif task_type == 'set_params':
+        body['parameters'] = {'values': dict(param.split('=', 1) for param in parameters)}
+    if waves:
+        body['waves'] = [int(wave) if wave.isdigit() else wave for wave in waves]
+    if rate is not None:
+        body['max_rate'] = rate
+    if max_in_flight is not None:
+        body['max_in_flight'] = max_in_flight
+    if window:
+        start, _, end = window.partition('-')
+        body['windows'] = [{'start': start, 'end': end, **({'timezone': timezone} if timezone else {})}]
+    
+    try:
+        response = requests.post(f"{ACS_BASE_URL}/api/campaigns", json=body)
+        if response.status_code == 400:
+            print(f"Error: {response.json()['detail']}")
+            sys.exit(1)
+        response.raise_for_status()
+        campaign = response.json()
+        print(f"✅ Campaign {campaign['id']} started: {campaign['devices_targeted']} devices in "
+              f"{len(campaign['waves'])} wave(s)")
+        print(f"   Follow it with: acs_cli.py campaign {campaign['id']}")
+    except requests.exceptions.RequestException as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+
+
+def list_campaigns():
+    """List campaigns"""
+    try:
+        response = requests.get(f"{ACS_BASE_URL}/api/campaigns")
+        response.raise_for_status()
+        campaigns = response.json()
+        
+        if not campaigns:
+            print("No campaigns found")
+            return
+        
+        table_data = [[
+            c['id'],
+            c['name'] or '-',
+            c['task_type'],
+            c['status'],
+            f"{c['current_wave']}/{len(c['waves'])}",
+            f"{c['tasks_released']}/{c['devices_targeted']}"
+        ] for c in campaigns]
+        print(tabulate(table_data, headers=['ID', 'Name', 'Type', 'Status', 'Wave', 'Released'], tablefmt='grid'))
+        
+    except requests.exceptions.RequestException as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+
+
+def show_campaign(campaign_id, action=None):
+    """Show (or pause, resume or cancel) a campaign"""
+    try:
+        if action:
+            response = requests.post(f"{ACS_BASE_URL}/api/campaigns/{campaign_id}/{action}")
+            if response.status_code == 409:
+                print(f"Error: {response.json()['detail']}")
+                sys.exit(1)
+            response.raise_for_status()
+            result = response.json()
+            withdrawn = f" ({result['tasks_withdrawn']} tasks withdrawn)" if 'tasks_withdrawn' in result else ''
+            print(f"✅ {result['message']}{withdrawn}")
+        
+        response = requests.get(f"{ACS_BASE_URL}/api/campaigns/{campaign_id}")
+        response.raise_for_status()
+        campaign = response.json()
+        
+        print(f"\nCampaign {campaign['id']}: {campaign['task_type']} ({campaign['status']})")
+        if campaign['pause_reason']:
+            print(f"Paused:           {campaign['pause_reason']}")
+        print(f"Target:           {json.dumps(campaign['target'])}")
+        print(f"Devices targeted: {campaign['devices_targeted']}")
+        print(f"Tasks released:   {campaign['tasks_released']}")
+        print(f"Limits:           {campaign['max_rate']:g} tasks/s, {campaign['max_in_flight']} in flight")
+        for window in campaign['windows']:
+            group = json.dumps(window['group']) if 'group' in window else 'all devices'
+            print(f"Window:           {window['start']}-{window['end']} {window.get('timezone', 'UTC')} "
+                  f"for {group} ({'open' if window['open'] else 'closed'})")
+        for number, wave in enumerate(campaign['waves'], 1):
+            marker = '▶' if number == campaign['current_wave'] else ' '
+            until = wave['released_until'] if wave['released_until'] is not None else 'rest'
+            counts = ', '.join(f"{status} {count}" for status, count in sorted(wave['tasks'].items()))
+            print(f" {marker} Wave {number} (to {until}): {counts or '-'}")
+        print()
+    except requests.exceptions.RequestException as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+
+
+def _print_histogram(summary, title):
+    """Print an Inform histogram, a bar per slot"""
+    print(f"\n{title}: {summary['devices']} devices, {summary['average_rate']}/s on average, "
+          f"{summary['peak_rate']}/s at peak (peak/average {summary['peak_to_average']})")
+    widest = max(summary['histogram']) or 1
+    for slot, count in enumerate(summary['histogram']):
+        start = slot * summary['bucket']
+        print(f"  {start:>6}s {count:>7} {'█' * round(40 * count / widest)}")
+
+
+def inform_spreading(interval, bucket, device_filter, spread=False, dry_run=False):
+    """Show when devices inform over the interval, or spread them out"""
+    device_filter = {key: value for key, value in device_filter.items() if value is not None}
+    try:
+        if not spread:
+            params = {'interval': interval, 'bucket': bucket, **device_filter}
+            response = requests.get(f"{ACS_BASE_URL}/api/inform-spreading",
+                                    params={key: value for key, value in params.items() if value is not None})
+        else:
+            body = {'dry_run': dry_run}
+            if interval is not None:
+                body['interval'] = interval
+            if bucket is not None:
+                body['bucket'] = bucket
+            if device_filter:
+                tag = device_filter.pop('tag', None)
+                body['filter'] = {**device_filter, **({'tags': [tag]} if tag else {})}
+            response = requests.post(f"{ACS_BASE_URL}/api/inform-spreading", json=body)
+        if response.status_code == 400:
+            print(f"Error: {response.json()['detail']}")
+            sys.exit(1)
+        response.raise_for_status()
+        result = response.json()
+        
+        if not spread:
+            _print_histogram(result, 'Informs over the interval')
+        else:
+            _print_histogram(result['before'], 'Before')
+            _print_histogram(result['after'], 'After (once the devices take the change)')
+            if result['job_id'] is not None:
+                print(f"\n✅ {result['devices_moved']} devices moved by job {result['job_id']}")
+                print(f"   Follow it with: acs_cli.py job {result['job_id']}")
+            else:
+                print(f"\n{result['devices_moved']} devices would move")
+        print()
+    except requests.exceptions.RequestException as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+
+
 def show_stats():
     """Show ACS statistics"""
     try:
@@ -290,6 +514,13 @@ def show_stats():
         print(f"🟢 Online:        {stats['online_devices']}")
         print(f"🔴 Offline:       {stats['offline_devices']}")
         print(f"⏳ Pending Tasks: {stats['pending_tasks']}")
+        for field, key, title in (('product_classes', 'product_class', 'Product Class'),
+                                  ('software_versions', 'software_version', 'Software Version')):
+            groups = stats.get(field, [])
+            if groups:
+                print(f"\n{title:<24} {'Total':>7} {'Online':>7}")
+                for group in groups:
+                    print(f"{(group[key] or '-')[:24]:<24} {group['total']:>7} {group['online']:>7}")
         print(f"{'='*40}\n")
         
     except requests.exceptions.RequestException as e:
@@ -302,7 +533,16 @@ def main():
     subparsers = parser.add_subparsers(dest='command', help='Commands')
     
     # List devices
-    subparsers.add_parser('list', help='List all devices')
+    list_parser = subparsers.add_parser('list', help='List devices')
+    status = list_parser.add_mutually_exclusive_group()
+    status.add_argument('--online', dest='online', action='store_const', const='true', help='Only online devices')
+    status.add_argument('--offline', dest='online', action='store_const', const='false', help='Only offline devices')
+    list_parser.add_argument('--product-class', help='Only this product class')
+    list_parser.add_argument('--software-version', help='Only this software version')
+    list_parser.add_argument('--tag', help='Only devices with this tag')
+    list_parser.add_argument('--seen-after', help='Only devices whose last Inform is at or after this ISO time')
+    list_parser.add_argument('--seen-before', help='Only devices whose last Inform is before this ISO time')
+    list_parser.add_argument('--page-size', type=int, default=500, help='Devices per request')
     
     # Show device
     show_parser = subparsers.add_parser('show', help='Show device details')
@@ -311,6 +551,8 @@ def main():
     # Parameters
     params_parser = subparsers.add_parser('parameters', help='List device parameters')
     params_parser.add_argument('device_id', help='Device ID')
+    params_parser.add_argument('prefix', nargs='?', help='Partial path, e.g. InternetGatewayDevice.LANDevice.1.')
+    params_parser.add_argument('--depth', type=int, help='Levels below the prefix to include')
     
     # Get parameter
     get_parser = subparsers.add_parser('get', help='Get parameter values')
@@ -334,6 +576,62 @@ def main():
     tasks_parser = subparsers.add_parser('tasks', help='List device tasks')
     tasks_parser.add_argument('device_id', help='Device ID')
     
+    # Bulk tasks
+    bulk_parser = subparsers.add_parser('bulk', help='Queue a task on many devices')
+    bulk_parser.add_argument('type', choices=['get_params', 'set_params', 'reboot', 'factory_reset'])
+    bulk_parser.add_argument('parameters', nargs='*', help='Parameter names (get_params) or parameter=value pairs (set_params)')
+    bulk_parser.add_argument('--device', action='append', dest='devices', help='Target this device (repeatable)')
+    bulk_status = bulk_parser.add_mutually_exclusive_group()
+    bulk_status.add_argument('--online', dest='online', action='store_const', const=True, help='Only online devices')
+    bulk_status.add_argument('--offline', dest='online', action='store_const', const=False, help='Only offline devices')
+    bulk_parser.add_argument('--product-class', help='Only this product class')
+    bulk_parser.add_argument('--software-version', help='Only this software version')
+    bulk_parser.add_argument('--tag', action='append', dest='tags', help='Only devices with this tag (repeatable: all of them)')
+    bulk_parser.add_argument('--connection-request', action='store_true', help='Ask the devices to connect now')
+    
+    job_parser = subparsers.add_parser('job', help='Show a bulk job')
+    job_parser.add_argument('job_id', type=int, help='Job ID')
+    job_parser.add_argument('--cancel', action='store_true', help='Cancel the job and withdraw its unsent tasks')
+    
+    # Campaigns
+    start_parser = subparsers.add_parser('campaign-start', help='Roll a task out to a device filter in waves')
+    start_parser.add_argument('type', choices=['get_params', 'set_params', 'reboot', 'factory_reset'])
+    start_parser.add_argument('parameters', nargs='*', help='Parameter names (get_params) or parameter=value pairs (set_params)')
+    start_parser.add_argument('--name', help='Campaign name')
+    start_status = start_parser.add_mutually_exclusive_group()
+    start_status.add_argument('--online', dest='online', action='store_const', const=True, help='Only online devices')
+    start_status.add_argument('--offline', dest='online', action='store_const', const=False, help='Only offline devices')
+    start_parser.add_argument('--product-class', help='Only this product class')
+    start_parser.add_argument('--software-version', help='Only this software version')
+    start_parser.add_argument('--tag', action='append', dest='tags', help='Only devices with this tag (repeatable: all of them)')
+    start_parser.add_argument('--wave', action='append', dest='waves',
+                              help='Devices released by the end of a wave, a count or a percentage (repeatable)')
+    start_parser.add_argument('--rate', type=float, help='Tasks released per second')
+    start_parser.add_argument('--max-in-flight', type=int, help='Released tasks not finished yet')
+    start_parser.add_argument('--window', help='Release only between HH:MM-HH:MM')
+    start_parser.add_argument('--timezone', help='Timezone of --window (default UTC)')
+    start_parser.add_argument('--connection-request', action='store_true', help='Ask the devices to connect when released')
+    
+    subparsers.add_parser('campaigns', help='List campaigns')
+    
+    campaign_parser = subparsers.add_parser('campaign', help='Show a campaign')
+    campaign_parser.add_argument('campaign_id', type=int, help='Campaign ID')
+    campaign_action = campaign_parser.add_mutually_exclusive_group()
+    campaign_action.add_argument('--pause', dest='action', action='store_const', const='pause', help='Stop releasing tasks')
+    campaign_action.add_argument('--resume', dest='action', action='store_const', const='resume', help='Release tasks again')
+    campaign_action.add_argument('--cancel', dest='action', action='store_const', const='cancel',
+                                 help='Cancel the campaign and withdraw its unsent tasks')
+    
+    # Inform spreading
+    informs_parser = subparsers.add_parser('informs', help='Show when devices inform over the interval')
+    informs_parser.add_argument('--interval', type=int, help='Periodic Inform interval in seconds')
+    informs_parser.add_argument('--bucket', type=int, help='Seconds per histogram slot')
+    informs_parser.add_argument('--product-class', help='Only this product class')
+    informs_parser.add_argument('--software-version', help='Only this software version')
+    informs_parser.add_argument('--tag', help='Only devices with this tag')
+    informs_parser.add_argument('--spread', action='store_true', help='Move devices of crowded slots to quiet ones')
+    informs_parser.add_argument('--dry-run', action='store_true', help='With --spread: only show the plan')
+    
     # Stats
     subparsers.add_parser('stats', help='Show ACS statistics')
     
@@ -345,11 +643,18 @@ def main():
     
     # Execute command
     if args.command == 'list':
-        list_devices()
+        list_devices({
+            'online': args.online,
+            'product_class': args.product_class,
+            'software_version': args.software_version,
+            'tag': args.tag,
+            'last_inform_after': args.seen_after,
+            'last_inform_before': args.seen_before
+        }, args.page_size)
     elif args.command == 'show':
         show_device(args.device_id)
     elif args.command == 'parameters':
-        list_parameters(args.device_id)
+        list_parameters(args.device_id, args.prefix, args.depth)
     elif args.command == 'get':
         get_parameter(args.device_id, args.parameters)
     elif args.command == 'set':
@@ -360,6 +665,33 @@ def main():
         factory_reset(args.device_id)
     elif args.command == 'tasks':
         list_tasks(args.device_id)
+    elif args.command == 'bulk':
+        bulk_task(args.type, args.parameters, args.devices, {
+            'online': args.online,
+            'product_class': args.product_class,
+            'software_version': args.software_version,
+            'tags': args.tags
+        }, args.connection_request)
+    elif args.command == 'job':
+        show_job(args.job_id, args.cancel)
+    elif args.command == 'campaign-start':
+        start_campaign(args.type, args.parameters, {
+            'online': args.online,
+            'product_class': args.product_class,
+            'software_version': args.software_version,
+            'tags': args.tags
+        }, args.waves, args.rate, args.max_in_flight, args.window, args.timezone,
+            args.connection_request, args.name)
+    elif args.command == 'campaigns':
+        list_campaigns()
+    elif args.command == 'campaign':
+        show_campaign(args.campaign_id, args.action)
+    elif args.command == 'informs':
+        inform_spreading(args.interval, args.bucket, {
+            'product_class': args.product_class,
+            'software_version': args.software_version,
+            'tag': args.tag
+        }, args.spread, args.dry_run)
     elif args.command == 'stats':
         show_stats()
 
@@ -0,0 +1,135 @@
+"""
+Admission Control
+Bounds the CWMP work a worker takes on, answering the excess with 503 and Retry-After
+"""
+import asyncio
+import math
+import random
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from config import settings
+from metrics import metrics
+
+
+class Overloaded(Exception):
+    """A request turned away; retry_after is the seconds the CPE should wait"""
+
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """Admission of /cwmp requests, per worker
+
+    A new session (a POST that belongs to no live session, normally an Inform) is turned
+    away while max_sessions sessions are live, or while max_queue requests already wait
+    for one of the max_concurrent processing slots, or when it waited queue_timeout
+    seconds without getting one. Follow-up POSTs of admitted sessions always wait for a
+    slot, so a session that got in runs to its end. On top of that an Inform is turned
+    away while an earlier Inform of the same device is still being handled, and every
+    Inform spends a token from its device's bucket (device_burst tokens, one more every
+    device_interval seconds), which stops a CPE retransmitting its Inform from costing a
+    session each time. Two Informs of a new device would also race to insert its row,
+    the loser holding up the winner's transaction for the database's lock timeout.
+    Buckets of the least recently seen devices are dropped past device_tracked; a
+    dropped bucket comes back full.
+
+    A global rejection asks the CPE to wait retry_after to twice that, at random, so the
+    retries of a storm spread out instead of coming back together.
+    """
+
+    def __init__(self, max_concurrent: int = 32, max_queue: int = 256, queue_timeout: float = 5,
+                 max_sessions: int = 5000, retry_after: int = 30, device_burst: int = 3,
+                 device_interval: float = 10, device_tracked: int = 100000):
+        self.max_concurrent = max(max_concurrent, 1)
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.max_sessions = max_sessions
+        self.retry_after = retry_after
+        self.device_burst = device_burst
+        self.device_interval = device_interval
+        self.device_tracked = device_tracked
+        self._slots = asyncio.Semaphore(self.max_concurrent)
+        self._waiting = 0
+        self._active = 0
+        self._buckets: OrderedDict = OrderedDict()  # device id -> (tokens, monotonic time)
+        self._informing = set()  # devices with an Inform being handled
+
+    def _retry_after(self) -> int:
+        return random.randint(self.retry_after, 2 * self.retry_after)
+
+    def _reject(self, reason: str, retry_after: int) -> Overloaded:
+        metrics.incr(f'admission_rejected_{reason}')
+        return Overloaded(reason, retry_after)
+
+    def check_session(self, live_sessions: int) -> None:
+        """Raise Overloaded when a new session must not start, before its body is read"""
+        if live_sessions >= self.max_sessions:
+            raise self._reject('sessions', self._retry_after())
+        if self._waiting >= self.max_queue:
+            raise self._reject('queue', self._retry_after())
+
+    async def acquire(self, new_session: bool) -> None:
+        """Wait for a processing slot; a new session gives up after queue_timeout"""
+        self._waiting += 1
+        try:
+            if not new_session:
+                await self._slots.acquire()
+            else:
+                try:
+                    await asyncio.wait_for(self._slots.acquire(), self.queue_timeout)
+                except asyncio.TimeoutError:
+                    raise self._reject('timeout', self._retry_after())
+        finally:
+            self._waiting -= 1
+        self._active += 1
+
+    def release(self, device_id: Optional[str] = None) -> None:
+        """Give a processing slot back, and the device its Inform admitted by check_device"""
+        self._informing.discard(device_id)
+        self._active -= 1
+        self._slots.release()
+
+    def check_device(self, device_id: str, now: Optional[float] = None) -> None:
+        """Admit an Inform of the device; Overloaded while it has another one in hand, or
+        when its bucket is empty. An admitted device must be passed to release()"""
+        if device_id in self._informing:
+            raise self._reject('duplicate', self._retry_after())
+        if self.device_burst > 0:
+            self._spend(device_id, time.monotonic() if now is None else now)
+        self._informing.add(device_id)
+
+    def _spend(self, device_id: str, now: float) -> None:
+        tokens, last = self._buckets.pop(device_id, (float(self.device_burst), now))
+        tokens = min(self.device_burst, tokens + (now - last) / self.device_interval)
+        if tokens < 1:
+            self._buckets[device_id] = (tokens, now)
+            raise self._reject('device', max(1, math.ceil((1 - tokens) * self.device_interval)))
+        self._buckets[device_id] = (tokens - 1, now)
+        while len(self._buckets) > self.device_tracked:
+            self._buckets.popitem(last=False)
+
+    @property
+    def queue_depth(self) -> int:
+        """Requests waiting for a processing slot"""
+        return self._waiting
+
+    @property
+    def in_flight(self) -> int:
+        """Requests holding a processing slot"""
+        return self._active
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+
+# Global admission controller
+admission = AdmissionController(
+    settings.ADMISSION_MAX_CONCURRENT, settings.ADMISSION_MAX_QUEUE, settings.ADMISSION_QUEUE_TIMEOUT,
+    settings.ADMISSION_MAX_SESSIONS, settings.ADMISSION_RETRY_AFTER, settings.ADMISSION_DEVICE_BURST,
+    settings.ADMISSION_DEVICE_INTERVAL, settings.ADMISSION_DEVICE_TRACKED
+)
@@ -0,0 +1,234 @@
+"""
+Bulk Tasks
+Queues one task per targeted device in chunked multi-row INSERTs, tracked as a job
+"""
+import asyncio
+import logging
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy import and_, exists, insert, select, update
+from sqlalchemy.orm import aliased
+
+from config import settings
+from connection_requests import connection_requests
+from fleet_counters import fleet_counters
+from metrics import metrics
+from models import AsyncSessionLocal, Device, DeviceTag, Job, Task
+
+logger = logging.getLogger(__name__)
+
+# Task types a job may queue (the RPCs main._create_task_rpc builds)
+TASK_TYPES = ('get_params', 'set_params', 'reboot', 'factory_reset')
+
+# Device filter keys a job may target
+TARGET_FILTERS = ('online', 'product_class', 'software_version', 'tags')
+
+# Device columns read per target: the id, and what a connection request needs
+TARGET_COLUMNS = (Device.id, Device.connection_request_url,
+                  Device.connection_request_username, Device.connection_request_password)
+
+
+def parse_target(body: Dict[str, Any]) -> Dict[str, Any]:
+    """The job target in a bulk request; ValueError when it is missing or malformed"""
+    device_ids = body.get('device_ids')
+    device_filter = body.get('filter')
+    if (device_ids is None) == (device_filter is None):
+        raise ValueError("Give either device_ids or filter")
+    if device_ids is not None:
+        if not isinstance(device_ids, list) or not all(isinstance(i, str) for i in device_ids):
+            raise ValueError("device_ids must be a list of device ids")
+        if not device_ids:
+            raise ValueError("device_ids is empty")
+        return {'device_ids': list(dict.fromkeys(device_ids))}
+    return {'filter': parse_filter(device_filter)}
+
+
+def parse_filter(device_filter: Any, name: str = 'filter') -> Dict[str, Any]:
+    """A device filter, checked; ValueError when it is empty or malformed"""
+    if not isinstance(device_filter, dict) or not device_filter:
+        # An empty filter would target the whole fleet; say so with explicit conditions
+        raise ValueError(f"{name} must set at least one of: " + ', '.join(TARGET_FILTERS))
+    unknown = [key for key in device_filter if key not in TARGET_FILTERS]
+    if unknown:
+        raise ValueError(f"Unknown {name} keys: {', '.join(unknown)}")
+    if 'online' in device_filter and not isinstance(device_filter['online'], bool):
+        raise ValueError(f"{name}.online must be true or false")
+    tags = device_filter.get('tags')
+    if tags is not None and (not isinstance(tags, list) or not tags or
+                             not all(isinstance(tag, str) for tag in tags)):
+        raise ValueError(f"{name}.tags must be a non-empty list of tags")
+    return device_filter
+
+
+def filter_conditions(device_filter: Dict[str, Any], tags: bool = True) -> List[Any]:
+    """WHERE conditions on devices for a filter; never NULL, so they can be negated"""
+    conditions = []
+    for key, column in (('online', Device.online), ('product_class', Device.product_class),
+                        ('software_version', Device.software_version)):
+        if device_filter.get(key) is not None:
+            conditions.append(and_(column.is_not(None), column == device_filter[key]))
+    for tag in (device_filter.get('tags') or []) if tags else []:
+        other = aliased(DeviceTag)
+        conditions.append(exists().where(other.device_id == Device.id, other.tag == tag))
+    return conditions
+
+
+def job_summary(job: Job, task_counts: Optional[Dict[str, int]] = None) -> Dict[str, Any]:
+    """A job as returned by the API; a device id list is given by its length"""
+    target = job.target or {}
+    return {
+        'id': job.id,
+        'task_type': job.task_type,
+        'parameters': job.parameters,
+        'target': {'device_ids': len(target['device_ids'])} if 'device_ids' in target else target,
+        'status': job.status,
+        'devices_matched': job.devices_matched or 0,
+        'devices_missing': job.devices_missing or 0,
+        'tasks_created': job.tasks_created or 0,
+        'tasks': task_counts or {},
+        'error': job.error,
+        'created_at': job.created_at.isoformat() if job.created_at else None,
+        'completed_at': job.completed_at.isoformat() if job.completed_at else None
+    }
+
+
+def _filtered_devices(device_filter: Dict[str, Any], after: Optional[str], limit: int):
+    """The next page of devices matching a filter, in id order"""
+    tags = device_filter.get('tags') or []
+    # Like the device list: a tag filter walks device_tags' (tag, device_id) key
+    id_key = DeviceTag.device_id if tags else Device.id
+    query = select(*TARGET_COLUMNS).filter(*filter_conditions({**device_filter, 'tags': tags[1:]}))
+    if tags:
+        query = query.join(DeviceTag, DeviceTag.device_id == Device.id).filter(DeviceTag.tag == tags[0])
+    if after is not None:
+        query = query.filter(id_key > after)
+    return query.order_by(id_key).limit(limit)
+
+
+class BulkTaskRunner:
+    """Creates a job's tasks in the background of the worker that accepted it
+
+    Targets are read a chunk at a time in short transactions: a filter pages through
+    devices by id (keyset, like the device list), an id list is checked against the
+    devices table a slice at a time. Each chunk's tasks go in one multi-row INSERT,
+    committed with the job's counters and cursor, so the counters are exact at every
+    commit. A job cancelled through the API (by any worker) stops at its next chunk.
+    """
+
+    def __init__(self, chunk_size: int = 1000):
+        self.chunk_size = chunk_size
+        self._running: Dict[int, asyncio.Task] = {}
+
+    def submit(self, job_id: int, connection_request: bool = False) -> None:
+        """Start creating a job's tasks"""
+        task = asyncio.create_task(self._run(job_id, connection_request))
+        self._running[job_id] = task
+        task.add_done_callback(lambda _: self._running.pop(job_id, None))
+
+    async def _next_chunk(self, job: Job, cursor: Optional[str]) -> Tuple[List[Any], int, Optional[str]]:
+        """(devices, listed ids not found, new cursor) for the chunk after cursor"""
+        async with AsyncSessionLocal() as db:
+            if 'filter' in job.target:
+                devices = (await db.execute(_filtered_devices(job.target['filter'], cursor, self.chunk_size))).all()
+                return devices, 0, devices[-1].id if devices else cursor
+            start = int(cursor or 0)
+            ids = job.target['device_ids'][start:start + self.chunk_size]
+            if not ids:
+                return [], 0, cursor
+            found = {row.id: row for row in await db.execute(select(*TARGET_COLUMNS).filter(Device.id.in_(ids)))}
+            return [found[i] for i in ids if i in found], len(ids) - len(found), str(start + len(ids))
+
+    async def _run(self, job_id: int, connection_request: bool) -> None:
+        async with AsyncSessionLocal() as db:
+            job = await db.get(Job, job_id)
+        cursor = job.cursor
+        try:
+            while True:
+                devices, missing, next_cursor = await self._next_chunk(job, cursor)
+                if not devices and not missing:
+                    break
+                now = datetime.utcnow()
+                async with AsyncSessionLocal() as db:
+                    if devices:
+                        await db.execute(insert(Task), [{
+                            'device_id': device.id,
+                            'task_type': job.task_type,
+                            'parameters': job.parameters,
+                            'status': 'pending',
+                            'created_at': now,
+                            'job_id': job_id
+                        } for device in devices])
+                    progress = await db.execute(
+                        update(Job)
+                        .where(Job.id == job_id, Job.status == 'running')
+                        .values(devices_matched=Job.devices_matched + len(devices),
+                                devices_missing=Job.devices_missing + missing,
+                                tasks_created=Job.tasks_created + len(devices),
+                                cursor=next_cursor)
+                    )
+                    if not progress.rowcount:
+                        # Cancelled since the last chunk: drop this one
+                        await db.rollback()
+                        return
+                    await db.commit()
+                cursor = next_cursor
+                fleet_counters.tasks_queued(len(devices))
+                metrics.incr('bulk_tasks_created', len(devices))
+                if connection_request:
+                    for device in devices:
+                        connection_requests.trigger(device)
+                    # Queue no faster than the dispatcher sends
+                    while len(connection_requests) > self.chunk_size:
+                        await asyncio.sleep(0.1)
+            await self._finish(job_id, 'completed')
+        except asyncio.CancelledError:
+            await self._finish(job_id, 'failed', 'Interrupted by shutdown')
+            raise
+        except Exception as e:
+            logger.exception("Bulk job %d failed", job_id)
+            await self._finish(job_id, 'failed', str(e))
+
+    async def _finish(self, job_id: int, status: str, error: Optional[str] = None) -> None:
+        async with AsyncSessionLocal() as db:
+            await db.execute(
+                update(Job)
+                .where(Job.id == job_id, Job.status == 'running')
+                .values(status=status, error=error, completed_at=datetime.utcnow())
+            )
+            await db.commit()
+
+    async def cancel(self, job_id: int) -> Optional[int]:
+        """Stop a running job and fail its tasks not sent yet; None when it was not running"""
+        now = datetime.utcnow()
+        async with AsyncSessionLocal() as db:
+            stopped = await db.execute(
+                update(Job)
+                .where(Job.id == job_id, Job.status == 'running')
+                .values(status='cancelled', completed_at=now)
+            )
+            if not stopped.rowcount:
+                return None
+            withdrawn = await db.execute(
+                update(Task)
+                .where(Task.job_id == job_id, Task.status == 'pending')
+                .values(status='failed', completed_at=now, result={'error': 'Job cancelled'})
+                .execution_options(synchronize_session=False)
+            )
+            await db.commit()
+        fleet_counters.tasks_queued(-withdrawn.rowcount)
+        return withdrawn.rowcount
+
+    async def stop(self) -> None:
+        """Interrupt the jobs this worker is running"""
+        for task in list(self._running.values()):
+            task.cancel()
+        if self._running:
+            await asyncio.gather(*self._running.values(), return_exceptions=True)
+
+    def __len__(self) -> int:
+        return len(self._running)
+
+
+# Global bulk task runner
+bulk_tasks = BulkTaskRunner(settings.BULK_TASK_CHUNK_SIZE)
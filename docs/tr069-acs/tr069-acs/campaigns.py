@@ -0,0 +1,539 @@
+"""
+Campaigns
+Staged rollouts: a task released to a device filter in waves, within a rate, a cap on
+tasks in flight and per-group maintenance windows, paused when a wave fails too often
+"""
+import asyncio
+import logging
+import math
+import re
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Set, Tuple
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+from sqlalchemy import and_, func, insert, not_, or_, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from bulk_tasks import TARGET_COLUMNS, TASK_TYPES, filter_conditions, parse_filter
+from config import settings
+from connection_requests import connection_requests
+from fleet_counters import fleet_counters
+from metrics import metrics
+from models import AsyncSessionLocal, Campaign, Device, Job, Task
+
+logger = logging.getLogger(__name__)
+
+# Task statuses that count as in flight once released
+UNFINISHED = ('pending', 'sent')
+
+WEEKDAYS = ('mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun')
+TIME_OF_DAY = re.compile(r'^([01]\d|2[0-3]):([0-5]\d)$')
+PERCENTAGE = re.compile(r'^(\d+(?:\.\d+)?)%$')
+
+
+def _number(body: Dict[str, Any], key: str, default: float, minimum: float = 0,
+            maximum: Optional[float] = None, integer: bool = False) -> float:
+    value = body.get(key, default)
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or (integer and not isinstance(value, int)):
+        raise ValueError(f"{key} must be {'an integer' if integer else 'a number'}")
+    if value < minimum or (maximum is not None and value > maximum):
+        raise ValueError(f"{key} must be between {minimum} and {maximum}" if maximum is not None
+                         else f"{key} must be at least {minimum}")
+    return value
+
+
+def _parse_wave(wave: Any) -> Any:
+    if isinstance(wave, int) and not isinstance(wave, bool) and wave > 0:
+        return wave
+    match = PERCENTAGE.match(wave) if isinstance(wave, str) else None
+    if match and 0 < float(match.group(1)) <= 100:
+        return wave
+    raise ValueError(f"waves: {wave!r} is neither a device count nor a percentage such as '10%'")
+
+
+def _parse_window(window: Any) -> Dict[str, Any]:
+    if not isinstance(window, dict):
+        raise ValueError("windows must be a list of objects")
+    unknown = [key for key in window if key not in ('group', 'start', 'end', 'days', 'timezone')]
+    if unknown:
+        raise ValueError(f"Unknown window keys: {', '.join(unknown)}")
+    for key in ('start', 'end'):
+        if not isinstance(window.get(key), str) or not TIME_OF_DAY.match(window[key]):
+            raise ValueError(f"window {key} must be a time of day such as '01:30'")
+    if 'group' in window:
+        parse_filter(window['group'], 'window group')
+    days = window.get('days')
+    if days is not None and (not isinstance(days, list) or not days or
+                             not all(day in WEEKDAYS for day in days)):
+        raise ValueError(f"window days must be a non-empty list of: {', '.join(WEEKDAYS)}")
+    if 'timezone' in window:
+        try:
+            ZoneInfo(window['timezone'])
+        except (ZoneInfoNotFoundError, TypeError, ValueError):
+            raise ValueError(f"Unknown window timezone: {window['timezone']}")
+    return window
+
+
+def parse_campaign(body: Dict[str, Any]) -> Dict[str, Any]:
+    """Campaign columns from a create request; ValueError when it is malformed"""
+    task_type = body.get('type')
+    if task_type not in TASK_TYPES:
+        raise ValueError(f"type must be one of: {', '.join(TASK_TYPES)}")
+    if 'device_ids' in body:
+        raise ValueError("Campaigns target a filter; tag the devices to roll out to a list")
+    waves = body.get('waves', ['100%'])
+    if not isinstance(waves, list) or not waves:
+        raise ValueError("waves must be a non-empty list")
+    windows = body.get('windows', [])
+    if not isinstance(windows, list):
+        raise ValueError("windows must be a list")
+    return {
+        'name': body.get('name'),
+        'task_type': task_type,
+        'parameters': body.get('parameters', {}),
+        'target': {'filter': parse_filter(body.get('filter'))},
+        'waves': [_parse_wave(wave) for wave in waves],
+        'windows': [_parse_window(window) for window in windows],
+        'max_rate': _number(body, 'max_rate', settings.CAMPAIGN_MAX_RATE, minimum=0.01),
+        'max_in_flight': _number(body, 'max_in_flight', settings.CAMPAIGN_MAX_IN_FLIGHT, 1, integer=True),
+        'failure_threshold': _number(body, 'failure_threshold', settings.CAMPAIGN_FAILURE_THRESHOLD, 0, 1),
+        'failure_min_tasks': _number(body, 'failure_min_tasks', settings.CAMPAIGN_FAILURE_MIN_TASKS, 1, integer=True),
+        'wave_timeout': _number(body, 'wave_timeout', settings.CAMPAIGN_WAVE_TIMEOUT, 0, integer=True),
+        'connection_request': bool(body.get('connection_request'))
+    }
+
+
+def resolve_waves(waves: List[Any], total: int) -> List[int]:
+    """Cumulative task counts of the waves, percentages taken of the devices targeted
+
+    A wave adding nothing to the one before is dropped; the last wave has no bound
+    and releases every device left.
+    """
+    resolved: List[int] = []
+    for wave in waves:
+        count = wave if isinstance(wave, int) else math.ceil(total * float(wave[:-1]) / 100)
+        if not resolved or count > resolved[-1]:
+            resolved.append(count)
+    return resolved
+
+
+def window_open(window: Dict[str, Any], now: Optional[datetime] = None) -> bool:
+    """Whether a maintenance window is open at now (naive UTC)"""
+    now = (now or datetime.utcnow()).replace(tzinfo=timezone.utc)
+    local = now.astimezone(ZoneInfo(window.get('timezone', 'UTC')))
+    start, end = window['start'], window['end']
+    clock = local.strftime('%H:%M')
+    if start <= end:
+        inside, opened_on = start <= clock < end, local
+    else:
+        # Past midnight: it opened the day before
+        inside = clock >= start or clock < end
+        opened_on = local if clock >= start else local - timedelta(days=1)
+    days = window.get('days')
+    return inside and (days is None or WEEKDAYS[opened_on.weekday()] in days)
+
+
+def _lanes(campaign: Campaign) -> List[Tuple[List[Any], Optional[Dict[str, Any]]]]:
+    """(device conditions, window or None) per lane of the campaign's target
+
+    A device follows the first window whose group it matches, so lane i excludes the
+    groups of the windows before it; the last lane, without a window, holds the devices
+    no window applies to. A window without a group applies to every device left.
+    """
+    target = filter_conditions(campaign.target['filter'])
+    lanes = []
+    earlier: List[Any] = []
+    for window in campaign.windows or []:
+        group = filter_conditions(window['group']) if window.get('group') else []
+        lanes.append((target + earlier + group, window))
+        if not group:
+            return lanes
+        earlier.append(not_(and_(*group)))
+    lanes.append((target + earlier, None))
+    return lanes
+
+
+def campaign_summary(campaign: Campaign, counts: Optional[Dict[int, Dict[str, int]]] = None,
+                     now: Optional[datetime] = None) -> Dict[str, Any]:
+    """A campaign as returned by the API, with its tasks by status overall and per wave"""
+    counts = counts or {}
+    tasks: Dict[str, int] = {}
+    for wave_tasks in counts.values():
+        for status, count in wave_tasks.items():
+            tasks[status] = tasks.get(status, 0) + count
+    return {
+        'id': campaign.id,
+        'name': campaign.name,
+        'task_type': campaign.task_type,
+        'parameters': campaign.parameters,
+        'target': campaign.target,
+        'status': campaign.status,
+        'pause_reason': campaign.pause_reason,
+        'devices_targeted': campaign.devices_targeted or 0,
+        'tasks_released': campaign.tasks_released or 0,
+        'tasks': tasks,
+        'current_wave': (campaign.wave or 0) + 1,
+        'waves': [{
+            # Tasks released by the end of the wave; the last one takes every device left
+            'released_until': size if wave < len(campaign.waves) - 1 else None,
+            'job_id': job_id,
+            'tasks': counts.get(job_id, {}) if job_id is not None else {}
+        } for wave, (size, job_id) in enumerate(zip(
+            campaign.waves, (campaign.wave_job_ids or []) + [None] * len(campaign.waves)))],
+        'windows': [{**window, 'open': window_open(window, now)} for window in campaign.windows or []],
+        'max_rate': campaign.max_rate,
+        'max_in_flight': campaign.max_in_flight,
+        'failure_threshold': campaign.failure_threshold,
+        'failure_min_tasks': campaign.failure_min_tasks,
+        'wave_timeout': campaign.wave_timeout,
+        'connection_request': campaign.connection_request,
+        'created_at': campaign.created_at.isoformat() if campaign.created_at else None,
+        'completed_at': campaign.completed_at.isoformat() if campaign.completed_at else None
+    }
+
+
+async def wave_counts(db: AsyncSession, campaign: Campaign) -> Dict[int, Dict[str, int]]:
+    """Tasks of each wave job by status, off the (job_id, status) index"""
+    counts: Dict[int, Dict[str, int]] = {}
+    if campaign.wave_job_ids:
+        rows = await db.execute(
+            select(Task.job_id, Task.status, func.count())
+            .filter(Task.job_id.in_(campaign.wave_job_ids))
+            .group_by(Task.job_id, Task.status)
+        )
+        for job_id, status, count in rows:
+            counts.setdefault(job_id, {})[status] = count
+    return counts
+
+
+class CampaignScheduler:
+    """Releases the tasks of running campaigns, a tick at a time
+
+    Each campaign is driven by one worker at a time, the holder of its lease
+    (CAMPAIGN_LEASE_TIMEOUT, renewed every tick; another worker takes over once it
+    lapses). A tick releases at most what the campaign's token bucket (max_rate),
+    its tasks in flight (max_in_flight: released, not yet completed or failed) and the
+    current wave have room for, from the lanes whose window is open, each paged through
+    by device id. The tasks are inserted in one multi-row INSERT under the wave's job,
+    committed with the lane cursors only while the campaign is still running and leased
+    to this worker. The next wave starts once the current one is released and its tasks
+    have finished, or after wave_timeout; a wave whose failed share of finished tasks
+    exceeds failure_threshold pauses the campaign.
+    """
+
+    def __init__(self, interval: float = 1, lease_timeout: float = 30):
+        self.interval = interval
+        self.lease = timedelta(seconds=lease_timeout)
+        self.owner = uuid.uuid4().hex
+        self._owned: Set[int] = set()
+        self._tokens: Dict[int, Tuple[float, float]] = {}  # campaign id -> (tokens, monotonic time)
+        self._task: Optional[asyncio.Task] = None
+
+    async def create(self, db: AsyncSession, spec: Dict[str, Any]) -> Campaign:
+        """Count the targeted devices, resolve the waves and start the first wave's job"""
+        campaign = Campaign(**spec, status='running', tasks_released=0, wave=0)
+        campaign.devices_targeted = await db.scalar(
+            select(func.count()).select_from(Device).filter(*filter_conditions(spec['target']['filter']))
+        )
+        campaign.waves = resolve_waves(spec['waves'], campaign.devices_targeted)
+        campaign.cursors = [''] * len(_lanes(campaign))
+        job = self._wave_job(campaign, 0)
+        db.add(job)
+        await db.flush()
+        campaign.wave_job_ids = [job.id]
+        campaign.wave_started_at = datetime.utcnow()
+        db.add(campaign)
+        await db.flush()
+        job.target = {'campaign_id': campaign.id, 'wave': 1}
+        await db.commit()
+        return campaign
+
+    @staticmethod
+    def _wave_job(campaign: Campaign, wave: int) -> Job:
+        return Job(task_type=campaign.task_type, parameters=campaign.parameters, status='running',
+                   target={'campaign_id': campaign.id, 'wave': wave + 1},
+                   devices_matched=0, devices_missing=0, tasks_created=0)
+
+    async def _update(self, db: AsyncSession, campaign_id: int, *conditions, **values) -> bool:
+        """Write campaign columns while it is running and leased to this worker"""
+        result = await db.execute(
+            update(Campaign)
+            .where(Campaign.id == campaign_id, Campaign.status == 'running', Campaign.lease_owner == self.owner,
+                   *conditions)
+            .values(**values)
+        )
+        return bool(result.rowcount)
+
+    async def _claim(self, now: datetime) -> None:
+        """Take the leases of running campaigns nobody holds, and renew ours"""
+        async with AsyncSessionLocal() as db:
+            rows = (await db.execute(
+                select(Campaign.id, Campaign.lease_owner, Campaign.lease_expires_at)
+                .filter(Campaign.status == 'running')
+            )).all()
+            renew = [row.id for row in rows
+                     if row.lease_owner == self.owner or row.lease_expires_at is None or row.lease_expires_at < now]
+            owned = set()
+            if renew:
+                # Only rows whose lease is still ours or lapsed: of two workers, one wins
+                owned = set((await db.scalars(
+                    update(Campaign)
+                    .where(Campaign.id.in_(renew), Campaign.status == 'running', or_(
+                        Campaign.lease_owner == self.owner,
+                        Campaign.lease_expires_at.is_(None),
+                        Campaign.lease_expires_at < now
+                    ))
+                    .values(lease_owner=self.owner, lease_expires_at=now + self.lease)
+                    .returning(Campaign.id)
+                )).all())
+            await db.commit()
+        for campaign_id in owned - self._owned:
+            logger.info("Releasing tasks of campaign %d", campaign_id)
+            self._tokens[campaign_id] = (0.0, time.monotonic())
+        for campaign_id in self._owned - owned:
+            self._tokens.pop(campaign_id, None)
+        self._owned = owned
+
+    def _take_tokens(self, campaign: Campaign) -> float:
+        """Refill the campaign's bucket; holds at most one tick's worth"""
+        tokens, last = self._tokens.get(campaign.id, (0.0, time.monotonic()))
+        now = time.monotonic()
+        tokens = min(tokens + (now - last) * campaign.max_rate, max(campaign.max_rate * self.interval, 1.0))
+        self._tokens[campaign.id] = (tokens, now)
+        return tokens
+
+    def _spend_tokens(self, campaign_id: int, spent: int) -> None:
+        tokens, last = self._tokens[campaign_id]
+        self._tokens[campaign_id] = (tokens - spent, last)
+
+    async def tick(self, now: Optional[datetime] = None) -> int:
+        """Claim leases and step every campaign this worker holds; returns tasks released"""
+        now = now or datetime.utcnow()
+        await self._claim(now)
+        released = 0
+        for campaign_id in sorted(self._owned):
+            try:
+                released += await self._step(campaign_id, now)
+            except Exception:
+                logger.exception("Campaign %d step failed; retrying on the next tick", campaign_id)
+        return released
+
+    async def _step(self, campaign_id: int, now: datetime) -> int:
+        async with AsyncSessionLocal() as db:
+            campaign = await db.get(Campaign, campaign_id)
+            if campaign is None or campaign.status != 'running':
+                self._owned.discard(campaign_id)
+                return 0
+            counts = await wave_counts(db, campaign)
+            await db.commit()
+
+        job_id = campaign.wave_job_ids[campaign.wave]
+        current = counts.get(job_id, {})
+        in_flight = sum(c.get(status, 0) for c in counts.values() for status in UNFINISHED)
+        last_wave = campaign.wave >= len(campaign.waves) - 1
+        lanes_done = all(cursor is None for cursor in campaign.cursors)
+        wave_released = lanes_done or (not last_wave and campaign.tasks_released >= campaign.waves[campaign.wave])
+        wave_unfinished = sum(current.get(status, 0) for status in UNFINISHED)
+
+        # Failure rate of the wave, over the tasks finished since it started (or resumed)
+        baseline = campaign.failure_baseline or {}
+        failed = current.get('failed', 0) - baseline.get('failed', 0)
+        finished = failed + current.get('completed', 0) - baseline.get('completed', 0)
+        drained = wave_released and not wave_unfinished
+        if finished and (finished >= campaign.failure_min_tasks or drained) and \
+                failed / finished > campaign.failure_threshold:
+            reason = (f"Wave {campaign.wave + 1}: {failed} of {finished} tasks failed "
+                      f"({failed / finished:.0%}, threshold {campaign.failure_threshold:.0%})")
+            async with AsyncSessionLocal() as db:
+                if await self._update(db, campaign_id, status='paused', pause_reason=reason):
+                    logger.warning("Campaign %d paused: %s", campaign_id, reason)
+                    metrics.incr('campaigns_paused')
+                await db.commit()
+            return 0
+
+        if wave_released:
+            timed_out = campaign.wave_timeout and now - campaign.wave_started_at >= timedelta(seconds=campaign.wave_timeout)
+            if wave_unfinished and not timed_out:
+                return 0  # let the wave finish before judging it
+            async with AsyncSessionLocal() as db:
+                await db.execute(update(Job).where(Job.id == job_id, Job.status == 'running')
+                                 .values(status='completed', completed_at=now))
+                if lanes_done:
+                    if await self._update(db, campaign_id, status='completed', completed_at=now):
+                        logger.info("Campaign %d completed", campaign_id)
+                else:
+                    job = self._wave_job(campaign, campaign.wave + 1)
+                    db.add(job)
+                    await db.flush()
+                    if not await self._update(db, campaign_id, Campaign.wave == campaign.wave,
+                                              wave=campaign.wave + 1,
+                                              wave_job_ids=campaign.wave_job_ids + [job.id],
+                                              wave_started_at=now, failure_baseline=None):
+                        await db.rollback()
+                        return 0
+                    logger.info("Campaign %d: wave %d started", campaign_id, campaign.wave + 2)
+                await db.commit()
+            return 0
+
+        return await self._release(campaign, job_id, in_flight, now)
+
+    async def _release(self, campaign: Campaign, job_id: int, in_flight: int, now: datetime) -> int:
+        """Release the next tasks the limits and open windows allow"""
+        budget = min(int(self._take_tokens(campaign)), campaign.max_in_flight - in_flight)
+        if campaign.wave < len(campaign.waves) - 1:
+            budget = min(budget, campaign.waves[campaign.wave] - campaign.tasks_released)
+        if budget <= 0:
+            return 0
+
+        cursors = list(campaign.cursors)
+        devices: List[Any] = []
+        async with AsyncSessionLocal() as db:
+            for lane, (conditions, window) in enumerate(_lanes(campaign)):
+                if cursors[lane] is None or (window is not None and not window_open(window, now)):
+                    continue
+                page = (await db.execute(
+                    select(*TARGET_COLUMNS)
+                    .filter(*conditions, Device.id > cursors[lane])
+                    .order_by(Device.id)
+                    .limit(budget - len(devices))
+                )).all()
+                # A short page is the end of the lane
+                cursors[lane] = page[-1].id if len(page) == budget - len(devices) else None
+                devices.extend(page)
+                if len(devices) == budget:
+                    break
+            if cursors == campaign.cursors:
+                await db.commit()
+                return 0
+
+            if devices:
+                await db.execute(insert(Task), [{
+                    'device_id': device.id,
+                    'task_type': campaign.task_type,
+                    'parameters': campaign.parameters,
+                    'status': 'pending',
+                    'created_at': now,
+                    'job_id': job_id
+                } for device in devices])
+            wave_open = await db.execute(
+                update(Job)
+                .where(Job.id == job_id, Job.status == 'running')
+                .values(devices_matched=Job.devices_matched + len(devices),
+                        tasks_created=Job.tasks_created + len(devices))
+            )
+            if not await self._update(db, campaign.id, Campaign.tasks_released == campaign.tasks_released,
+                                      cursors=cursors, tasks_released=campaign.tasks_released + len(devices)):
+                # Paused, cancelled, taken over or released from since this tick read it
+                await db.rollback()
+                return 0
+            if not wave_open.rowcount:
+                await db.rollback()
+                await self.pause(campaign.id, f"Wave {campaign.wave + 1} job {job_id} was cancelled")
+                return 0
+            await db.commit()
+
+        self._spend_tokens(campaign.id, len(devices))
+        fleet_counters.tasks_queued(len(devices))
+        metrics.incr('campaign_tasks_released', len(devices))
+        if campaign.connection_request:
+            for device in devices:
+                connection_requests.trigger(device)
+        return len(devices)
+
+    async def pause(self, campaign_id: int, reason: Optional[str] = None) -> bool:
+        """Stop releasing a running campaign's tasks; those released stay queued"""
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(
+                update(Campaign)
+                .where(Campaign.id == campaign_id, Campaign.status == 'running')
+                .values(status='paused', pause_reason=reason or 'Paused through the API')
+            )
+            await db.commit()
+        return bool(result.rowcount)
+
+    async def resume(self, campaign_id: int) -> bool:
+        """Release a paused campaign's tasks again; its wave's failures so far are set aside"""
+        async with AsyncSessionLocal() as db:
+            campaign = await db.get(Campaign, campaign_id)
+            if campaign is None or campaign.status != 'paused':
+                return False
+            current = (await wave_counts(db, campaign)).get(campaign.wave_job_ids[campaign.wave], {})
+            result = await db.execute(
+                update(Campaign)
+                .where(Campaign.id == campaign_id, Campaign.status == 'paused')
+                .values(status='running', pause_reason=None, failure_baseline={
+                    'failed': current.get('failed', 0),
+                    'completed': current.get('completed', 0)
+                })
+            )
+            await db.commit()
+        return bool(result.rowcount)
+
+    async def cancel(self, campaign_id: int) -> Optional[int]:
+        """Stop a campaign and fail its tasks not sent yet; None when it was already over"""
+        now = datetime.utcnow()
+        async with AsyncSessionLocal() as db:
+            stopped = (await db.scalars(
+                update(Campaign)
+                .where(Campaign.id == campaign_id, Campaign.status.in_(('running', 'paused')))
+                .values(status='cancelled', pause_reason=None, completed_at=now)
+                .returning(Campaign.wave_job_ids)
+            )).first()
+            if stopped is None:
+                return None
+            await db.execute(
+                update(Job)
+                .where(Job.id.in_(stopped), Job.status == 'running')
+                .values(status='cancelled', completed_at=now)
+            )
+            withdrawn = await db.execute(
+                update(Task)
+                .where(Task.job_id.in_(stopped), Task.status == 'pending')
+                .values(status='failed', completed_at=now, result={'error': 'Campaign cancelled'})
+                .execution_options(synchronize_session=False)
+            )
+            await db.commit()
+        fleet_counters.tasks_queued(-withdrawn.rowcount)
+        return withdrawn.rowcount
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.tick()
+            except Exception:
+                logger.exception("Campaign tick failed; retrying")
+            await asyncio.sleep(self.interval)
+
+    async def start(self) -> None:
+        """Start releasing tasks"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stop releasing tasks and hand the leases back"""
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        if self._owned:
+            async with AsyncSessionLocal() as db:
+                await db.execute(
+                    update(Campaign)
+                    .where(Campaign.id.in_(self._owned), Campaign.lease_owner == self.owner)
+                    .values(lease_owner=None, lease_expires_at=None)
+                )
+                await db.commit()
+            self._owned.clear()
+
+    def __len__(self) -> int:
+        return len(self._owned)
+
+
+# Global campaign scheduler
+campaigns = CampaignScheduler(settings.CAMPAIGN_TICK_INTERVAL, settings.CAMPAIGN_LEASE_TIMEOUT)
@@ -14,25 +14,105 @@ class Settings:
     # Database
     DATABASE_URL: str = os.getenv("DATABASE_URL", "sqlite:///tr069_acs.db")
     
+    # Connection pool
+    DB_POOL_SIZE: int = int(os.getenv("DB_POOL_SIZE", "10"))
+    DB_MAX_OVERFLOW: int = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+    DB_POOL_TIMEOUT: int = int(os.getenv("DB_POOL_TIMEOUT", "30"))  # seconds
+    DB_POOL_RECYCLE: int = int(os.getenv("DB_POOL_RECYCLE", "1800"))  # seconds, server databases only
+    DB_POOL_PRE_PING: bool = os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"
+    
+    # SQLite tuning
+    SQLITE_JOURNAL_MODE: str = os.getenv("SQLITE_JOURNAL_MODE", "WAL")
+    SQLITE_SYNCHRONOUS: str = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+    SQLITE_BUSY_TIMEOUT: int = int(os.getenv("SQLITE_BUSY_TIMEOUT", "5000"))  # milliseconds
+    SQLITE_MMAP_SIZE: int = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))  # bytes
+    SQLITE_CACHE_SIZE: int = int(os.getenv("SQLITE_CACHE_SIZE", "-65536"))  # negative = KiB
+    
     # CWMP settings
     CWMP_ENDPOINT: str = "/cwmp"
     MAX_ENVELOPES: int = 1
+    XML_BACKEND: str = os.getenv("XML_BACKEND", "auto")  # auto, lxml or stdlib
+    CWMP_PARSER: str = os.getenv("CWMP_PARSER", "stream")  # stream or tree
+    CWMP_PRETTY_XML: bool = os.getenv("CWMP_PRETTY_XML", "false").lower() == "true"  # Debug only
+    # Ask CPEs to hold their own requests while queued tasks remain in the session
+    CWMP_HOLD_REQUESTS: bool = os.getenv("CWMP_HOLD_REQUESTS", "false").lower() == "true"
+    
+    # Parameter change detection
+    FINGERPRINT_CACHE_SIZE: int = int(os.getenv("FINGERPRINT_CACHE_SIZE", "10000"))  # devices, 0 disables the LRU
+    FINGERPRINT_CACHE_MAX_ENTRIES: int = int(os.getenv("FINGERPRINT_CACHE_MAX_ENTRIES", "1000000"))  # parameters, all devices
+    PARAMETER_INGEST_CHUNK_SIZE: int = int(os.getenv("PARAMETER_INGEST_CHUNK_SIZE", "1000"))  # rows per upsert
+    PARAMETER_NAME_CACHE_SIZE: int = int(os.getenv("PARAMETER_NAME_CACHE_SIZE", "100000"))  # interned name ids
+    
+    # Write-behind buffer for last_inform/online/ip_address
+    LIVENESS_FLUSH_INTERVAL_MS: int = int(os.getenv("LIVENESS_FLUSH_INTERVAL_MS", "1000"))
+    LIVENESS_FLUSH_MAX_DEVICES: int = int(os.getenv("LIVENESS_FLUSH_MAX_DEVICES", "500"))  # flush early at this many
+    
+    # Fleet counters behind /api/stats, reloaded from the database this often (0: at startup only)
+    FLEET_COUNTERS_RECONCILE_INTERVAL: int = int(os.getenv("FLEET_COUNTERS_RECONCILE_INTERVAL", "300"))  # seconds
+    
+    # In-process device cache
+    WORKERS: int = int(os.getenv("WEB_CONCURRENCY", "1"))  # uvicorn worker processes
+    DEVICE_CACHE: str = os.getenv("DEVICE_CACHE", "auto")  # auto (single worker or shared invalidation), true, false
+    DEVICE_CACHE_SIZE: int = int(os.getenv("DEVICE_CACHE_SIZE", "10000"))  # devices
+    DEVICE_CACHE_TTL: int = int(os.getenv("DEVICE_CACHE_TTL", "300"))  # seconds
+    DEVICE_CACHE_INVALIDATION: str = os.getenv("DEVICE_CACHE_INVALIDATION", "")  # '' or postgres (LISTEN/NOTIFY)
     
     # Session timeout (seconds)
-    SESSION_TIMEOUT: int = 30
+    SESSION_TIMEOUT: int = int(os.getenv("SESSION_TIMEOUT", "30"))
+    SESSION_MAX_ACTIVE: int = int(os.getenv("SESSION_MAX_ACTIVE", "10000"))  # live sessions per worker
+    SESSION_FLUSH_INTERVAL_MS: int = int(os.getenv("SESSION_FLUSH_INTERVAL_MS", "1000"))
+    SESSION_FLUSH_MAX_SESSIONS: int = int(os.getenv("SESSION_FLUSH_MAX_SESSIONS", "500"))  # flush early at this many
+    
+    # Admission control on /cwmp, per worker: new sessions beyond these limits get 503 + Retry-After
+    ADMISSION_CONTROL: bool = os.getenv("ADMISSION_CONTROL", "true").lower() == "true"
+    ADMISSION_MAX_CONCURRENT: int = int(os.getenv("ADMISSION_MAX_CONCURRENT", "32"))  # requests processed at once
+    ADMISSION_MAX_QUEUE: int = int(os.getenv("ADMISSION_MAX_QUEUE", "256"))  # requests waiting for a slot
+    ADMISSION_QUEUE_TIMEOUT: float = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "5"))  # seconds a new session waits
+    ADMISSION_MAX_SESSIONS: int = int(os.getenv("ADMISSION_MAX_SESSIONS", "5000"))  # live sessions
+    ADMISSION_RETRY_AFTER: int = int(os.getenv("ADMISSION_RETRY_AFTER", "30"))  # seconds, randomized up to twice
+    # Per-device token bucket on Informs: a burst of ADMISSION_DEVICE_BURST (0 disables it),
+    # refilled one every ADMISSION_DEVICE_INTERVAL seconds, for the last ADMISSION_DEVICE_TRACKED devices
+    ADMISSION_DEVICE_BURST: int = int(os.getenv("ADMISSION_DEVICE_BURST", "3"))
+    ADMISSION_DEVICE_INTERVAL: float = float(os.getenv("ADMISSION_DEVICE_INTERVAL", "10"))
+    ADMISSION_DEVICE_TRACKED: int = int(os.getenv("ADMISSION_DEVICE_TRACKED", "100000"))
+    
+    # Connection requests sent to CPEs when tasks are queued for them
+    CONNECTION_REQUESTS: bool = os.getenv("CONNECTION_REQUESTS", "true").lower() == "true"
+    CONNECTION_REQUEST_TIMEOUT: int = int(os.getenv("CONNECTION_REQUEST_TIMEOUT", "5"))  # seconds per attempt
+    CONNECTION_REQUEST_MAX_CONCURRENT: int = int(os.getenv("CONNECTION_REQUEST_MAX_CONCURRENT", "100"))
+    CONNECTION_REQUEST_MAX_PER_SUBNET: int = int(os.getenv("CONNECTION_REQUEST_MAX_PER_SUBNET", "10"))
+    CONNECTION_REQUEST_SUBNET_PREFIX: int = int(os.getenv("CONNECTION_REQUEST_SUBNET_PREFIX", "24"))  # IPv4; /64 for IPv6
+    CONNECTION_REQUEST_RETRIES: int = int(os.getenv("CONNECTION_REQUEST_RETRIES", "3"))
+    CONNECTION_REQUEST_BACKOFF: float = float(os.getenv("CONNECTION_REQUEST_BACKOFF", "2"))  # seconds, doubled per retry
+    # Digest credentials for devices without their own connection_request_username/password
+    CONNECTION_REQUEST_USERNAME: Optional[str] = os.getenv("CONNECTION_REQUEST_USERNAME")
+    CONNECTION_REQUEST_PASSWORD: Optional[str] = os.getenv("CONNECTION_REQUEST_PASSWORD")
     
-    # Connection Request
-    CONNECTION_REQUEST_TIMEOUT: int = 5
+    # Device settings: offline after this long without an Inform (0 never marks devices offline)
+    DEVICE_OFFLINE_THRESHOLD: int = int(os.getenv("DEVICE_OFFLINE_THRESHOLD", "600"))  # seconds (10 minutes)
+    OFFLINE_SWEEP_INTERVAL: int = int(os.getenv("OFFLINE_SWEEP_INTERVAL", "10"))  # seconds between sweeps
+    OFFLINE_SWEEP_BATCH_SIZE: int = int(os.getenv("OFFLINE_SWEEP_BATCH_SIZE", "500"))  # devices per UPDATE
     
-    # Device settings
-    DEVICE_OFFLINE_THRESHOLD: int = 600  # seconds (10 minutes)
+    # Periodic inform interval (default for new devices, and the one inform spreading sets)
+    DEFAULT_INFORM_INTERVAL: int = int(os.getenv("DEFAULT_INFORM_INTERVAL", "300"))  # seconds (5 minutes)
+    INFORM_SPREAD_BUCKET: int = int(os.getenv("INFORM_SPREAD_BUCKET", "10"))  # seconds per histogram slot
     
-    # Periodic inform interval (default for new devices)
-    DEFAULT_INFORM_INTERVAL: int = 300  # seconds (5 minutes)
+    # Task settings: a sent task unanswered after TASK_RESPONSE_TIMEOUT (0: never) is requeued
+    # after TASK_RETRY_DELAY, doubled per retry, and failed after MAX_TASK_RETRIES retries
+    TASK_RESPONSE_TIMEOUT: int = int(os.getenv("TASK_RESPONSE_TIMEOUT", "120"))  # seconds
+    MAX_TASK_RETRIES: int = int(os.getenv("MAX_TASK_RETRIES", "3"))
+    TASK_RETRY_DELAY: int = int(os.getenv("TASK_RETRY_DELAY", "60"))  # seconds
+    TASK_RETRY_SWEEP_INTERVAL: int = int(os.getenv("TASK_RETRY_SWEEP_INTERVAL", "10"))  # seconds between sweeps
+    BULK_TASK_CHUNK_SIZE: int = int(os.getenv("BULK_TASK_CHUNK_SIZE", "1000"))  # tasks per INSERT in bulk jobs
     
-    # Task settings
-    MAX_TASK_RETRIES: int = 3
-    TASK_RETRY_DELAY: int = 60  # seconds
+    # Campaign defaults (each campaign may set its own) and the scheduler releasing their tasks
+    CAMPAIGN_MAX_RATE: float = float(os.getenv("CAMPAIGN_MAX_RATE", "10"))  # tasks released per second
+    CAMPAIGN_MAX_IN_FLIGHT: int = int(os.getenv("CAMPAIGN_MAX_IN_FLIGHT", "1000"))  # released, not finished
+    CAMPAIGN_FAILURE_THRESHOLD: float = float(os.getenv("CAMPAIGN_FAILURE_THRESHOLD", "0.1"))  # failed share that pauses
+    CAMPAIGN_FAILURE_MIN_TASKS: int = int(os.getenv("CAMPAIGN_FAILURE_MIN_TASKS", "20"))
+    CAMPAIGN_WAVE_TIMEOUT: int = int(os.getenv("CAMPAIGN_WAVE_TIMEOUT", "3600"))  # seconds (0: wait for every task)
+    CAMPAIGN_TICK_INTERVAL: float = float(os.getenv("CAMPAIGN_TICK_INTERVAL", "1"))  # seconds between releases
+    CAMPAIGN_LEASE_TIMEOUT: int = int(os.getenv("CAMPAIGN_LEASE_TIMEOUT", "30"))  # seconds before another worker takes over
     
     # API settings
     API_PREFIX: str = "/api"
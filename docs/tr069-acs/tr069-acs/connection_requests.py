@@ -0,0 +1,164 @@
+"""
+Connection Requests
+Asks CPEs to open a CWMP session as soon as tasks are queued for them (TR-069 3.2.2)
+"""
+import asyncio
+import ipaddress
+import logging
+import random
+from contextlib import asynccontextmanager
+from typing import Dict, Optional, Set
+from urllib.parse import urlsplit
+
+import httpx
+
+from config import settings
+from metrics import metrics
+from models import Device
+
+logger = logging.getLogger(__name__)
+
+# Responses after which asking again may succeed
+RETRY_STATUSES = {408, 429, 500, 502, 503, 504}
+
+
+class ConnectionRequestDispatcher:
+    """Sends HTTP digest-auth connection requests, bounded globally and per subnet
+
+    A device with a request already waiting, in flight or backing off is not asked again:
+    the session it opens drains every task queued by then.
+    """
+
+    def __init__(self, max_concurrent: int = 100, max_per_subnet: int = 10, timeout: float = 5,
+                 retries: int = 3, backoff: float = 2.0, subnet_prefix: int = 24,
+                 enabled: bool = True):
+        self.max_concurrent = max_concurrent
+        self.max_per_subnet = max_per_subnet
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.subnet_prefix = subnet_prefix
+        self.enabled = enabled
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._subnets: Dict[str, asyncio.Semaphore] = {}
+        self._subnet_users: Dict[str, int] = {}  # requests holding or waiting for each subnet's semaphore
+        self._pending: Set[str] = set()
+        self._tasks: Set[asyncio.Task] = set()
+        self._client: Optional[httpx.AsyncClient] = None
+
+    def trigger(self, device: Device) -> bool:
+        """Queue a connection request for a device; False when none was queued"""
+        if not self.enabled or self._client is None:
+            return False
+        if not device.connection_request_url:
+            metrics.incr('connection_requests_skipped')
+            return False
+        if device.id in self._pending:
+            metrics.incr('connection_requests_coalesced')
+            return False
+        self._pending.add(device.id)
+        username = device.connection_request_username or settings.CONNECTION_REQUEST_USERNAME
+        password = device.connection_request_password or settings.CONNECTION_REQUEST_PASSWORD
+        task = asyncio.create_task(self._dispatch(device.id, device.connection_request_url, username, password))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return True
+
+    async def _dispatch(self, device_id: str, url: str, username: Optional[str],
+                        password: Optional[str]) -> None:
+        """Request with retries; the device stays pending until the last attempt ends"""
+        auth = httpx.DigestAuth(username, password) if username else None
+        try:
+            for attempt in range(self.retries + 1):
+                if attempt:
+                    # Exponential backoff with jitter, holding no slot while waiting
+                    await asyncio.sleep(self.backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5))
+                    metrics.incr('connection_request_retries')
+                outcome = await self._send(url, auth)
+                if outcome == 'sent':
+                    metrics.incr('connection_requests_sent')
+                    return
+                if outcome == 'rejected':
+                    break
+            metrics.incr('connection_requests_failed')
+            logger.warning("Connection request to %s (%s) failed", device_id, url)
+        except Exception:
+            metrics.incr('connection_requests_failed')
+            logger.exception("Connection request to %s failed", device_id)
+        finally:
+            self._pending.discard(device_id)
+
+    async def _send(self, url: str, auth: Optional[httpx.DigestAuth]) -> str:
+        """One attempt: 'sent', 'retry' or 'rejected'"""
+        subnet = self._subnet(url)
+        async with self._subnet_slot(subnet), self._slots:
+            try:
+                response = await self._client.get(url, auth=auth)
+            except httpx.TransportError as e:
+                logger.debug("Connection request to %s: %s", url, e)
+                return 'retry'
+        # 200 OK or 204 No Content: the CPE will open a session
+        if response.status_code in (200, 204):
+            return 'sent'
+        logger.debug("Connection request to %s answered %d", url, response.status_code)
+        return 'retry' if response.status_code in RETRY_STATUSES else 'rejected'
+
+    def _subnet(self, url: str) -> str:
+        """Subnet of the URL's host, or the host name when it is not an IP address"""
+        host = urlsplit(url).hostname or ''
+        try:
+            address = ipaddress.ip_address(host)
+        except ValueError:
+            return host
+        prefix = self.subnet_prefix if address.version == 4 else 64
+        return str(ipaddress.ip_network(f'{address}/{prefix}', strict=False))
+
+    @asynccontextmanager
+    async def _subnet_slot(self, subnet: str):
+        """Hold one of the subnet's slots; idle subnets drop their semaphore"""
+        semaphore = self._subnets.get(subnet)
+        if semaphore is None:
+            semaphore = self._subnets[subnet] = asyncio.Semaphore(self.max_per_subnet)
+        self._subnet_users[subnet] = self._subnet_users.get(subnet, 0) + 1
+        try:
+            async with semaphore:
+                yield
+        finally:
+            self._subnet_users[subnet] -= 1
+            if not self._subnet_users[subnet]:
+                del self._subnet_users[subnet]
+                del self._subnets[subnet]
+
+    async def start(self) -> None:
+        """Open the shared HTTP client"""
+        if self.enabled and self._client is None:
+            self._slots = asyncio.Semaphore(self.max_concurrent)
+            self._client = httpx.AsyncClient(
+                timeout=self.timeout,
+                limits=httpx.Limits(max_connections=self.max_concurrent, max_keepalive_connections=0)
+            )
+
+    async def stop(self) -> None:
+        """Abandon queued requests and close the client"""
+        for task in list(self._tasks):
+            task.cancel()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+
+# Global connection request dispatcher
+connection_requests = ConnectionRequestDispatcher(
+    settings.CONNECTION_REQUEST_MAX_CONCURRENT,
+    settings.CONNECTION_REQUEST_MAX_PER_SUBNET,
+    settings.CONNECTION_REQUEST_TIMEOUT,
+    settings.CONNECTION_REQUEST_RETRIES,
+    settings.CONNECTION_REQUEST_BACKOFF,
+    settings.CONNECTION_REQUEST_SUBNET_PREFIX,
+    settings.CONNECTION_REQUESTS
+)
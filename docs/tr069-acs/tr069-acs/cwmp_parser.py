@@ -0,0 +1,191 @@
+"""
+Streaming CWMP SOAP Parser
+Parses CPE requests in a single incremental pass with bounded memory
+"""
+import xml.etree.ElementTree as ET
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from xml_backend import XMLBackend
+
+SOAP_HEADER = '{http://schemas.xmlsoap.org/soap/envelope/}Header'
+SOAP_BODY = '{http://schemas.xmlsoap.org/soap/envelope/}Body'
+XSI_TYPE = '{http://www.w3.org/2001/XMLSchema-instance}type'
+
+# Bytes handed to the pull parser per step; events are drained after each one,
+# so a fully buffered body never queues more than one chunk's worth of elements
+FEED_CHUNK_SIZE = 16 * 1024
+
+# Methods whose children are consumed and discarded as they stream in.
+# Everything else is kept as a small subtree and handed to the tree parsers.
+STREAMED_METHODS = {'Inform', 'GetParameterValuesResponse'}
+
+# Streamed methods whose ParameterValueStructs keep their xsi:type
+TYPED_METHODS = {'Inform', 'GetParameterValuesResponse'}
+
+# Methods whose values can be handed to the caller as they arrive (stream_values)
+VALUE_STREAMED_METHODS = {'GetParameterValuesResponse'}
+
+
+class StreamingSOAPParser:
+    """Incremental parser producing the same dict as CWMPServer.parse_soap_request"""
+
+    def __init__(self, method_parser: Callable[[str, ET.Element], Dict[str, Any]],
+                 backend: XMLBackend, stream_values: bool = False):
+        self._method_parser = method_parser
+        self._stream_values = stream_values
+        self.values: List[Tuple[str, str, Optional[str]]] = []  # (name, value, xsi:type) when streaming values
+        self._parse_error = backend.ParseError
+        self._parser = backend.pull_parser()
+        self._stack = []
+        self._error: Optional[str] = None
+
+        self._cwmp_id: Optional[str] = None
+        self._body: Optional[ET.Element] = None
+        self._method: Optional[ET.Element] = None
+        self._method_name: Optional[str] = None
+        self._streamed = False
+        self._params: Dict[str, Any] = {}
+
+        # First DeviceId / Event / ParameterList, matching find('.//...')
+        self._device_id: Optional[ET.Element] = None
+        self._event: Optional[ET.Element] = None
+        self._param_list: Optional[ET.Element] = None
+
+    def parse(self, xml_data) -> Dict[str, Any]:
+        """Parse a complete message"""
+        self.feed(xml_data)
+        return self.close()
+
+    def feed(self, data) -> None:
+        """Feed the next chunk of the request body"""
+        for offset in range(0, len(data), FEED_CHUNK_SIZE):
+            if self._error is not None:
+                return
+            try:
+                self._parser.feed(data[offset:offset + FEED_CHUNK_SIZE])
+                self._drain()
+            except self._parse_error as e:
+                self._error = f'XML Parse Error: {str(e)}'
+
+    def close(self) -> Dict[str, Any]:
+        """Finish parsing and return the parsed request"""
+        if self._error is None:
+            try:
+                self._parser.close()
+                self._drain()
+            except self._parse_error as e:
+                self._error = f'XML Parse Error: {str(e)}'
+        if self._error is not None:
+            return {'error': self._error}
+
+        if self._body is None:
+            return {'error': 'No SOAP Body found'}
+        if self._method is None:
+            return {'error': 'No CWMP method found'}
+
+        params = self._params if self._streamed else self._method_parser(self._method_name, self._method)
+        if self._method_name == 'GetParameterValuesResponse':
+            # An empty response still carries its (empty) value list, like the tree parser's
+            params.setdefault('parameters', {})
+            params.setdefault('types', {})
+        return {
+            'method': self._method_name,
+            'params': params,
+            'cwmp_id': self._cwmp_id
+        }
+
+    @property
+    def method(self) -> Optional[str]:
+        """Name of the CWMP method, once its start tag has been read"""
+        return self._method_name
+
+    def _drain(self) -> None:
+        """Process pending parser events"""
+        for event, elem in self._parser.read_events():
+            if event == 'start':
+                self._start(elem)
+            else:
+                self._end(elem)
+
+    def _start(self, elem: ET.Element) -> None:
+        stack = self._stack
+        parent = stack[-1] if stack else None
+
+        if self._body is None:
+            if len(stack) == 1 and elem.tag == SOAP_BODY:
+                self._body = elem
+        elif self._method is None:
+            if parent is self._body:
+                self._method = elem
+                self._method_name = local_name(elem.tag)
+                self._streamed = self._method_name in STREAMED_METHODS
+        elif self._streamed:
+            if elem.tag == 'DeviceId' and self._device_id is None:
+                self._device_id = elem
+            elif elem.tag == 'Event' and self._event is None:
+                self._event = elem
+                self._params['events'] = []
+            elif elem.tag == 'ParameterList' and self._param_list is None:
+                self._param_list = elem
+                self._params['parameters'] = {}
+                if self._method_name in TYPED_METHODS:
+                    self._params['types'] = {}
+
+        stack.append(elem)
+
+    def _end(self, elem: ET.Element) -> None:
+        stack = self._stack
+        stack.pop()
+        if self._body is None:
+            # Header cwmp:ID, in whichever cwmp namespace version the CPE speaks
+            if (len(stack) == 2 and stack[1].tag == SOAP_HEADER and self._cwmp_id is None
+                    and local_name(elem.tag) == 'ID'):
+                self._cwmp_id = elem.text
+            return
+        if not self._streamed or self._method not in stack:
+            return
+        parent = stack[-1]
+
+        if elem is self._device_id:
+            self._params['device_id'] = {
+                'manufacturer': _child_text(elem, 'Manufacturer'),
+                'oui': _child_text(elem, 'OUI'),
+                'product_class': _child_text(elem, 'ProductClass'),
+                'serial_number': _child_text(elem, 'SerialNumber'),
+            }
+        elif elem.tag == 'EventStruct':
+            if self._event is not None and self._event in stack:
+                event_code = elem.find('EventCode')
+                if event_code is not None:
+                    self._params['events'].append(event_code.text)
+        elif elem.tag == 'ParameterValueStruct':
+            if self._param_list is not None and self._param_list in stack:
+                name = elem.find('Name')
+                value = elem.find('Value')
+                if name is not None and value is not None:
+                    value_type = value.get(XSI_TYPE) if self._method_name in TYPED_METHODS else None
+                    if self._stream_values and self._method_name in VALUE_STREAMED_METHODS:
+                        self.values.append((name.text, value.text, value_type))
+                    else:
+                        self._params['parameters'][name.text] = value.text
+                        if value_type:
+                            self._params['types'][name.text] = value_type
+        elif parent is not self._method:
+            return
+        elif elem.tag == 'MaxEnvelopes':
+            self._params['max_envelopes'] = elem.text
+
+        # Drop the consumed subtree so memory stays flat however long the list is.
+        # Siblings are removed as they close, so this never scans more than a few children.
+        parent.remove(elem)
+
+
+def local_name(tag: str) -> str:
+    """Tag without its namespace"""
+    return tag.split('}')[-1]
+
+
+def _child_text(elem: ET.Element, tag: str) -> Optional[str]:
+    """Text of a direct child, or '' when the child is missing"""
+    child = elem.find(tag)
+    return child.text if child is not None else ''
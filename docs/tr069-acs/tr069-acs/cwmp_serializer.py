@@ -0,0 +1,188 @@
+"""
+CWMP SOAP Envelope Serializer
+Builds outgoing ACS messages from precompiled byte templates
+"""
+from typing import Dict, Iterable, Optional
+from xml.sax.saxutils import escape
+
+from xml_backend import XMLBackend, StdlibBackend
+
+# SOAP namespaces (kept in sync with cwmp_server.NAMESPACES)
+SOAP_NS = 'http://schemas.xmlsoap.org/soap/envelope/'
+CWMP_NS = 'urn:dslforum-org:cwmp-1-0'
+XSD_NS = 'http://www.w3.org/2001/XMLSchema'
+XSI_NS = 'http://www.w3.org/2001/XMLSchema-instance'
+
+# Static envelope fragments, encoded once at import time
+XML_DECLARATION = b'<?xml version="1.0" encoding="UTF-8"?>\n'
+ENVELOPE_OPEN = (
+    f'<soap:Envelope xmlns:soap="{SOAP_NS}" xmlns:cwmp="{CWMP_NS}" '
+    f'xmlns:xsd="{XSD_NS}" xmlns:xsi="{XSI_NS}">'
+).encode('utf-8')
+ENVELOPE_CLOSE = b'</soap:Envelope>'
+HEADER_OPEN = b'<soap:Header>'
+HEADER_CLOSE = b'</soap:Header>'
+ID_OPEN = b'<cwmp:ID soap:mustUnderstand="1">'
+ID_CLOSE = b'</cwmp:ID>'
+HOLD_REQUESTS = b'<cwmp:HoldRequests soap:mustUnderstand="1">1</cwmp:HoldRequests>'
+BODY_OPEN = b'<soap:Body>'
+BODY_CLOSE = b'</soap:Body>'
+EMPTY_BODY = b'<soap:Body/>'
+
+# Per-RPC body templates
+INFORM_RESPONSE_OPEN = b'<cwmp:InformResponse><MaxEnvelopes>'
+INFORM_RESPONSE_CLOSE = b'</MaxEnvelopes></cwmp:InformResponse>'
+
+TRANSFER_COMPLETE_RESPONSE = b'<cwmp:TransferCompleteResponse/>'
+AUTONOMOUS_TRANSFER_COMPLETE_RESPONSE = b'<cwmp:AutonomousTransferCompleteResponse/>'
+
+RPC_METHODS_RESPONSE_OPEN = b'<cwmp:GetRPCMethodsResponse><MethodList soap:arrayType="xsd:string['
+RPC_METHODS_RESPONSE_ARRAY_CLOSE = b']">'
+RPC_METHODS_RESPONSE_CLOSE = b'</MethodList></cwmp:GetRPCMethodsResponse>'
+
+FAULT_OPEN = b'<soap:Fault><faultcode>'
+FAULT_DETAIL_OPEN = b'</faultcode><faultstring>CWMP fault</faultstring><detail><cwmp:Fault><FaultCode>'
+FAULT_STRING_OPEN = b'</FaultCode><FaultString>'
+FAULT_CLOSE = b'</FaultString></cwmp:Fault></detail></soap:Fault>'
+
+GPV_OPEN = b'<cwmp:GetParameterValues><ParameterNames soap:arrayType="xsd:string['
+GPV_ARRAY_CLOSE = b']">'
+GPV_CLOSE = b'</ParameterNames></cwmp:GetParameterValues>'
+STRING_OPEN = b'<string>'
+STRING_CLOSE = b'</string>'
+
+SPV_OPEN = b'<cwmp:SetParameterValues><ParameterList soap:arrayType="cwmp:ParameterValueStruct['
+SPV_ARRAY_CLOSE = b']">'
+SPV_LIST_CLOSE = b'</ParameterList><ParameterKey>'
+SPV_CLOSE = b'</ParameterKey></cwmp:SetParameterValues>'
+PVS_OPEN = b'<ParameterValueStruct><Name>'
+PVS_VALUE_OPEN = b'</Name><Value xsi:type="'
+PVS_VALUE_TYPE_CLOSE = b'">'
+PVS_CLOSE = b'</Value></ParameterValueStruct>'
+DEFAULT_VALUE_TYPE = b'xsd:string'
+
+REBOOT_OPEN = b'<cwmp:Reboot><CommandKey>'
+REBOOT_CLOSE = b'</CommandKey></cwmp:Reboot>'
+
+FACTORY_RESET = b'<cwmp:FactoryReset/>'
+
+
+def _text(value) -> bytes:
+    """Escape a text node value and encode it as UTF-8"""
+    text = value if isinstance(value, str) else str(value)
+    # Most parameter names and values need no escaping, so check before escaping
+    if '&' in text or '<' in text or '>' in text:
+        text = escape(text)
+    return text.encode('utf-8')
+
+
+class EnvelopeSerializer:
+    """Renders CWMP RPC messages by splicing escaped values into static templates"""
+
+    def __init__(self, pretty: bool = False, backend: Optional[XMLBackend] = None):
+        # Pretty mode re-indents every message and is meant for debugging only
+        self.pretty = pretty
+        self.backend = backend or StdlibBackend()
+
+    def inform_response(self, cwmp_id: Optional[str] = None, max_envelopes: int = 1,
+                        hold_requests: bool = False) -> bytes:
+        """Render InformResponse"""
+        return self._envelope(cwmp_id, [
+            INFORM_RESPONSE_OPEN, str(int(max_envelopes)).encode('ascii'), INFORM_RESPONSE_CLOSE
+        ], hold_requests)
+
+    def transfer_complete_response(self, cwmp_id: Optional[str], hold_requests: bool = False) -> bytes:
+        """Render TransferCompleteResponse"""
+        return self._envelope(cwmp_id, [TRANSFER_COMPLETE_RESPONSE], hold_requests)
+
+    def autonomous_transfer_complete_response(self, cwmp_id: Optional[str], hold_requests: bool = False) -> bytes:
+        """Render AutonomousTransferCompleteResponse"""
+        return self._envelope(cwmp_id, [AUTONOMOUS_TRANSFER_COMPLETE_RESPONSE], hold_requests)
+
+    def get_rpc_methods_response(self, cwmp_id: Optional[str], methods: Iterable[str],
+                                 hold_requests: bool = False) -> bytes:
+        """Render GetRPCMethodsResponse"""
+        methods = list(methods)
+        parts = [RPC_METHODS_RESPONSE_OPEN, str(len(methods)).encode('ascii'), RPC_METHODS_RESPONSE_ARRAY_CLOSE]
+        for method in methods:
+            parts.append(STRING_OPEN)
+            parts.append(_text(method))
+            parts.append(STRING_CLOSE)
+        parts.append(RPC_METHODS_RESPONSE_CLOSE)
+        return self._envelope(cwmp_id, parts, hold_requests)
+
+    def fault(self, cwmp_id: Optional[str], fault_code: int, fault_string: str,
+              soap_fault_code: str = 'Server') -> bytes:
+        """Render a SOAP Fault carrying a CWMP fault (TR-069 A.5.1)"""
+        return self._envelope(cwmp_id, [
+            FAULT_OPEN, _text(soap_fault_code), FAULT_DETAIL_OPEN, str(int(fault_code)).encode('ascii'),
+            FAULT_STRING_OPEN, _text(fault_string), FAULT_CLOSE
+        ])
+
+    def get_parameter_values(self, cwmp_id: Optional[str], parameter_names: Iterable[str],
+                             hold_requests: bool = False) -> bytes:
+        """Render GetParameterValues"""
+        names = list(parameter_names)
+        parts = [GPV_OPEN, str(len(names)).encode('ascii'), GPV_ARRAY_CLOSE]
+        for name in names:
+            parts.append(STRING_OPEN)
+            parts.append(_text(name))
+            parts.append(STRING_CLOSE)
+        parts.append(GPV_CLOSE)
+        return self._envelope(cwmp_id, parts, hold_requests)
+
+    def set_parameter_values(self, cwmp_id: Optional[str], parameters: Dict[str, str],
+                             parameter_key: str = '', hold_requests: bool = False,
+                             types: Optional[Dict[str, str]] = None) -> bytes:
+        """Render SetParameterValues; values typed xsd:string unless types names another"""
+        parts = [SPV_OPEN, str(len(parameters)).encode('ascii'), SPV_ARRAY_CLOSE]
+        for name, value in parameters.items():
+            value_type = types.get(name) if types else None
+            parts.append(PVS_OPEN)
+            parts.append(_text(name))
+            parts.append(PVS_VALUE_OPEN)
+            parts.append(escape(value_type, {'"': '&quot;'}).encode('utf-8') if value_type else DEFAULT_VALUE_TYPE)
+            parts.append(PVS_VALUE_TYPE_CLOSE)
+            parts.append(_text(value))
+            parts.append(PVS_CLOSE)
+        parts.append(SPV_LIST_CLOSE)
+        parts.append(_text(parameter_key))
+        parts.append(SPV_CLOSE)
+        return self._envelope(cwmp_id, parts, hold_requests)
+
+    def reboot(self, cwmp_id: Optional[str], command_key: str, hold_requests: bool = False) -> bytes:
+        """Render Reboot"""
+        return self._envelope(cwmp_id, [REBOOT_OPEN, _text(command_key), REBOOT_CLOSE], hold_requests)
+
+    def factory_reset(self, cwmp_id: Optional[str], hold_requests: bool = False) -> bytes:
+        """Render FactoryReset"""
+        return self._envelope(cwmp_id, [FACTORY_RESET], hold_requests)
+
+    def empty(self) -> bytes:
+        """Render an envelope with an empty Body"""
+        return self._finish([XML_DECLARATION, ENVELOPE_OPEN, EMPTY_BODY, ENVELOPE_CLOSE])
+
+    def _envelope(self, cwmp_id: Optional[str], body_parts: list, hold_requests: bool = False) -> bytes:
+        """Wrap body fragments in the precompiled envelope, header and body tags"""
+        parts = [XML_DECLARATION, ENVELOPE_OPEN]
+        if cwmp_id is not None or hold_requests:
+            parts.append(HEADER_OPEN)
+            if cwmp_id is not None:
+                parts.append(ID_OPEN)
+                parts.append(_text(cwmp_id))
+                parts.append(ID_CLOSE)
+            if hold_requests:
+                parts.append(HOLD_REQUESTS)
+            parts.append(HEADER_CLOSE)
+        parts.append(BODY_OPEN)
+        parts.extend(body_parts)
+        parts.append(BODY_CLOSE)
+        parts.append(ENVELOPE_CLOSE)
+        return self._finish(parts)
+
+    def _finish(self, parts: list) -> bytes:
+        """Join fragments, optionally re-indenting for debug output"""
+        data = b''.join(parts)
+        if self.pretty:
+            return self.backend.reindent(data)
+        return data
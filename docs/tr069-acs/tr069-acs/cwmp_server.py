@@ -7,6 +7,11 @@ from datetime import datetime
 from typing import Optional, Dict, Any
 import uuid
 
+from config import settings
+from cwmp_parser import StreamingSOAPParser, XSI_TYPE, local_name, _child_text
+from cwmp_serializer import EnvelopeSerializer
+from xml_backend import get_backend
+
 # SOAP namespaces
 NAMESPACES = {
     'soap': 'http://schemas.xmlsoap.org/soap/envelope/',
@@ -15,6 +20,12 @@ NAMESPACES = {
     'xsi': 'http://www.w3.org/2001/XMLSchema-instance'
 }
 
+# Methods the ACS accepts from a CPE, as reported to GetRPCMethods
+ACS_METHODS = ('Inform', 'GetRPCMethods', 'TransferComplete', 'AutonomousTransferComplete')
+
+# ACS fault for a CPE request outside ACS_METHODS (TR-069 Table 93)
+METHOD_NOT_SUPPORTED = 8000
+
 # Register namespaces for pretty XML
 for prefix, uri in NAMESPACES.items():
     ET.register_namespace(prefix, uri)
@@ -23,41 +34,75 @@ for prefix, uri in NAMESPACES.items():
 class CWMPServer:
     """Handles TR-069 CWMP protocol communication"""
     
-    def __init__(self):
-        self.pending_commands = {}  # device_id -> list of commands
+    def __init__(self, pretty_xml: bool = False, parser: str = 'stream', xml_backend: str = 'auto'):
+        self.parser = parser  # 'stream' (single pass) or 'tree' (full DOM)
+        self.backend = get_backend(xml_backend)
+        self.serializer = EnvelopeSerializer(pretty=pretty_xml, backend=self.backend)
     
-    def parse_soap_request(self, xml_data: str) -> Dict[str, Any]:
+    def parse_soap_request(self, xml_data: bytes) -> Dict[str, Any]:
         """Parse incoming SOAP request from CPE"""
+        if isinstance(xml_data, str):
+            xml_data = xml_data.encode('utf-8')
+        
+        if self.parser == 'stream':
+            return self.create_stream_parser().parse(xml_data)
+        
         try:
-            root = ET.fromstring(xml_data)
+            root = self.backend.fromstring(xml_data)
+            
+            # Session-level ID the CPE echoes back in responses (the cwmp namespace varies by version)
+            cwmp_id = None
+            header = root.find('soap:Header', NAMESPACES)
+            if header is not None:
+                for child in header:
+                    if local_name(child.tag) == 'ID':
+                        cwmp_id = child.text
+                        break
             
             # Find the CWMP method
             body = root.find('soap:Body', NAMESPACES)
             if body is None:
                 return {'error': 'No SOAP Body found'}
+            if len(body) == 0:
+                return {'error': 'No CWMP method found'}
             
             # Get the first child of Body (the CWMP method)
             method = body[0]
             method_name = method.tag.split('}')[-1]  # Remove namespace
             
-            result = {
+            return {
                 'method': method_name,
-                'params': {}
+                'params': self._parse_method(method_name, method),
+                'cwmp_id': cwmp_id
             }
             
-            # Parse method-specific parameters
-            if method_name == 'Inform':
-                result['params'] = self._parse_inform(method)
-            elif method_name == 'TransferCompleteResponse':
-                result['params'] = self._parse_transfer_complete(method)
-            elif method_name == 'GetRPCMethodsResponse':
-                result['params'] = self._parse_rpc_methods_response(method)
-            
-            return result
-            
-        except ET.ParseError as e:
+        except self.backend.ParseError as e:
             return {'error': f'XML Parse Error: {str(e)}'}
     
+    def create_stream_parser(self, stream_values: bool = False) -> StreamingSOAPParser:
+        """Create an incremental parser for one request body
+
+        With stream_values, GetParameterValuesResponse values are left in parser.values
+        for the caller to drain between feeds instead of being collected in the result.
+        """
+        return StreamingSOAPParser(self._parse_method, self.backend, stream_values)
+    
+    def _parse_method(self, method_name: str, method: ET.Element) -> Dict[str, Any]:
+        """Parse method-specific parameters"""
+        if method_name == 'Inform':
+            return self._parse_inform(method)
+        elif method_name == 'TransferComplete':
+            return self._parse_transfer_complete(method)
+        elif method_name == 'GetRPCMethodsResponse':
+            return self._parse_rpc_methods_response(method)
+        elif method_name == 'GetParameterValuesResponse':
+            return self._parse_parameter_values_response(method)
+        elif method_name == 'SetParameterValuesResponse':
+            return self._parse_set_parameter_values_response(method)
+        elif method_name == 'Fault':
+            return self._parse_fault(method)
+        return {}
+    
     def _parse_inform(self, method: ET.Element) -> Dict[str, Any]:
         """Parse Inform message from CPE"""
         params = {}
@@ -81,21 +126,75 @@ class CWMPServer:
                 if event_code is not None:
                     params['events'].append(event_code.text)
         
+        # Envelopes the CPE accepts per HTTP response
+        max_envelopes = method.find('MaxEnvelopes', NAMESPACES)
+        if max_envelopes is not None:
+            params['max_envelopes'] = max_envelopes.text
+        
         # Extract Parameters
         param_list = method.find('.//ParameterList', NAMESPACES)
         if param_list is not None:
-            params['parameters'] = {}
-            for param in param_list.findall('.//ParameterValueStruct', NAMESPACES):
-                name = param.find('Name', NAMESPACES)
-                value = param.find('Value', NAMESPACES)
-                if name is not None and value is not None:
-                    params['parameters'][name.text] = value.text
+            params['types'] = {}
+            params['parameters'] = self._parse_parameter_list(param_list, params['types'])
         
         return params
     
+    def _parse_parameter_list(self, param_list: ET.Element,
+                              types: Optional[Dict[str, str]] = None) -> Dict[str, str]:
+        """Parse ParameterValueStruct entries into {name: value}, collecting xsi:type into types"""
+        parameters = {}
+        for param in param_list.findall('.//ParameterValueStruct', NAMESPACES):
+            name = param.find('Name', NAMESPACES)
+            value = param.find('Value', NAMESPACES)
+            if name is not None and value is not None:
+                parameters[name.text] = value.text
+                value_type = value.get(XSI_TYPE)
+                if types is not None and value_type:
+                    types[name.text] = value_type
+        return parameters
+    
     def _parse_transfer_complete(self, method: ET.Element) -> Dict[str, Any]:
         """Parse TransferComplete message"""
-        return {'status': 'complete'}
+        fault = method.find('FaultStruct')
+        return {
+            'command_key': _child_text(method, 'CommandKey'),
+            'fault_code': _child_text(fault, 'FaultCode') if fault is not None else '',
+            'fault_string': _child_text(fault, 'FaultString') if fault is not None else ''
+        }
+    
+    def _parse_parameter_values_response(self, method: ET.Element) -> Dict[str, Any]:
+        """Parse GetParameterValuesResponse"""
+        types = {}
+        param_list = method.find('.//ParameterList', NAMESPACES)
+        parameters = self._parse_parameter_list(param_list, types) if param_list is not None else {}
+        return {'parameters': parameters, 'types': types}
+    
+    def _parse_set_parameter_values_response(self, method: ET.Element) -> Dict[str, Any]:
+        """Parse SetParameterValuesResponse"""
+        return {'status': _child_text(method, 'Status')}
+    
+    def _parse_fault(self, method: ET.Element) -> Dict[str, Any]:
+        """Parse a SOAP Fault, preferring the CWMP fault in its detail"""
+        detail = None
+        for elem in method.iter():
+            if elem is not method and local_name(elem.tag) == 'Fault':
+                detail = elem
+                break
+        if detail is None:
+            return {
+                'fault_code': _child_text(method, 'faultcode'),
+                'fault_string': _child_text(method, 'faultstring'),
+                'parameter_faults': []
+            }
+        return {
+            'fault_code': _child_text(detail, 'FaultCode'),
+            'fault_string': _child_text(detail, 'FaultString'),
+            'parameter_faults': [{
+                'name': _child_text(fault, 'ParameterName'),
+                'fault_code': _child_text(fault, 'FaultCode'),
+                'fault_string': _child_text(fault, 'FaultString')
+            } for fault in detail.findall('SetParameterValuesFault')]
+        }
     
     def _parse_rpc_methods_response(self, method: ET.Element) -> Dict[str, Any]:
         """Parse GetRPCMethodsResponse"""
@@ -107,126 +206,61 @@ class CWMPServer:
                     methods.append(m.text)
         return {'methods': methods}
     
-    def create_inform_response(self) -> str:
+    def create_inform_response(self, cwmp_id: Optional[str] = None, hold_requests: bool = False) -> bytes:
         """Create InformResponse SOAP message"""
-        envelope = ET.Element('{http://schemas.xmlsoap.org/soap/envelope/}Envelope')
-        envelope.set('xmlns:soap', NAMESPACES['soap'])
-        envelope.set('xmlns:cwmp', NAMESPACES['cwmp'])
-        
-        body = ET.SubElement(envelope, '{http://schemas.xmlsoap.org/soap/envelope/}Body')
-        inform_response = ET.SubElement(body, '{urn:dslforum-org:cwmp-1-0}InformResponse')
-        max_envelopes = ET.SubElement(inform_response, 'MaxEnvelopes')
-        max_envelopes.text = '1'
-        
-        return self._prettify_xml(envelope)
+        return self.serializer.inform_response(cwmp_id, settings.MAX_ENVELOPES, hold_requests)
+    
+    def create_transfer_complete_response(self, cwmp_id: Optional[str] = None,
+                                          hold_requests: bool = False) -> bytes:
+        """Create TransferCompleteResponse SOAP message"""
+        return self.serializer.transfer_complete_response(cwmp_id, hold_requests)
+    
+    def create_autonomous_transfer_complete_response(self, cwmp_id: Optional[str] = None,
+                                                     hold_requests: bool = False) -> bytes:
+        """Create AutonomousTransferCompleteResponse SOAP message"""
+        return self.serializer.autonomous_transfer_complete_response(cwmp_id, hold_requests)
     
-    def create_get_parameter_values(self, parameter_names: list) -> str:
+    def create_get_rpc_methods_response(self, cwmp_id: Optional[str] = None,
+                                        hold_requests: bool = False) -> bytes:
+        """Create GetRPCMethodsResponse SOAP message listing the methods the ACS accepts"""
+        return self.serializer.get_rpc_methods_response(cwmp_id, ACS_METHODS, hold_requests)
+    
+    def create_fault(self, fault_code: int, fault_string: str, cwmp_id: Optional[str] = None) -> bytes:
+        """Create a SOAP Fault with an ACS fault code (8000 Method not supported, ...)"""
+        # TR-069 Table 93: only 8003 Invalid arguments is a Client fault
+        return self.serializer.fault(cwmp_id, fault_code, fault_string,
+                                     'Client' if fault_code == 8003 else 'Server')
+    
+    def create_get_parameter_values(self, parameter_names: list, cwmp_id: Optional[str] = None,
+                                    hold_requests: bool = False) -> bytes:
         """Create GetParameterValues request"""
-        envelope = ET.Element('{http://schemas.xmlsoap.org/soap/envelope/}Envelope')
-        envelope.set('xmlns:soap', NAMESPACES['soap'])
-        envelope.set('xmlns:cwmp', NAMESPACES['cwmp'])
-        
-        # Add SOAP Header with ID
-        header = ET.SubElement(envelope, '{http://schemas.xmlsoap.org/soap/envelope/}Header')
-        cwmp_id = ET.SubElement(header, '{urn:dslforum-org:cwmp-1-0}ID')
-        cwmp_id.set('soap:mustUnderstand', '1')
-        cwmp_id.text = str(uuid.uuid4())
-        
-        body = ET.SubElement(envelope, '{http://schemas.xmlsoap.org/soap/envelope/}Body')
-        get_params = ET.SubElement(body, '{urn:dslforum-org:cwmp-1-0}GetParameterValues')
-        
-        param_names = ET.SubElement(get_params, 'ParameterNames')
-        param_names.set('soap:arrayType', f'xsd:string[{len(parameter_names)}]')
-        
-        for name in parameter_names:
-            string = ET.SubElement(param_names, 'string')
-            string.text = name
-        
-        return self._prettify_xml(envelope)
+        return self.serializer.get_parameter_values(cwmp_id or str(uuid.uuid4()), parameter_names,
+                                                    hold_requests)
     
-    def create_set_parameter_values(self, parameters: Dict[str, str]) -> str:
+    def create_set_parameter_values(self, parameters: Dict[str, str], cwmp_id: Optional[str] = None,
+                                    hold_requests: bool = False,
+                                    types: Optional[Dict[str, str]] = None) -> bytes:
         """Create SetParameterValues request"""
-        envelope = ET.Element('{http://schemas.xmlsoap.org/soap/envelope/}Envelope')
-        envelope.set('xmlns:soap', NAMESPACES['soap'])
-        envelope.set('xmlns:cwmp', NAMESPACES['cwmp'])
-        
-        # Add SOAP Header with ID
-        header = ET.SubElement(envelope, '{http://schemas.xmlsoap.org/soap/envelope/}Header')
-        cwmp_id = ET.SubElement(header, '{urn:dslforum-org:cwmp-1-0}ID')
-        cwmp_id.set('soap:mustUnderstand', '1')
-        cwmp_id.text = str(uuid.uuid4())
-        
-        body = ET.SubElement(envelope, '{http://schemas.xmlsoap.org/soap/envelope/}Body')
-        set_params = ET.SubElement(body, '{urn:dslforum-org:cwmp-1-0}SetParameterValues')
-        
-        param_list = ET.SubElement(set_params, 'ParameterList')
-        param_list.set('soap:arrayType', f'cwmp:ParameterValueStruct[{len(parameters)}]')
-        
-        for name, value in parameters.items():
-            param_struct = ET.SubElement(param_list, 'ParameterValueStruct')
-            name_elem = ET.SubElement(param_struct, 'Name')
-            name_elem.text = name
-            value_elem = ET.SubElement(param_struct, 'Value')
-            value_elem.set('xsi:type', 'xsd:string')
-            value_elem.text = str(value)
-        
-        param_key = ET.SubElement(set_params, 'ParameterKey')
-        param_key.text = ''
-        
-        return self._prettify_xml(envelope)
+        return self.serializer.set_parameter_values(cwmp_id or str(uuid.uuid4()), parameters,
+                                                    hold_requests=hold_requests, types=types)
     
-    def create_reboot(self) -> str:
+    def create_reboot(self, cwmp_id: Optional[str] = None, hold_requests: bool = False) -> bytes:
         """Create Reboot request"""
-        envelope = ET.Element('{http://schemas.xmlsoap.org/soap/envelope/}Envelope')
-        envelope.set('xmlns:soap', NAMESPACES['soap'])
-        envelope.set('xmlns:cwmp', NAMESPACES['cwmp'])
-        
-        # Add SOAP Header with ID
-        header = ET.SubElement(envelope, '{http://schemas.xmlsoap.org/soap/envelope/}Header')
-        cwmp_id = ET.SubElement(header, '{urn:dslforum-org:cwmp-1-0}ID')
-        cwmp_id.set('soap:mustUnderstand', '1')
-        cwmp_id.text = str(uuid.uuid4())
-        
-        body = ET.SubElement(envelope, '{http://schemas.xmlsoap.org/soap/envelope/}Body')
-        reboot = ET.SubElement(body, '{urn:dslforum-org:cwmp-1-0}Reboot')
-        command_key = ET.SubElement(reboot, 'CommandKey')
-        command_key.text = f'reboot_{datetime.utcnow().timestamp()}'
-        
-        return self._prettify_xml(envelope)
+        return self.serializer.reboot(cwmp_id or str(uuid.uuid4()), f'reboot_{datetime.utcnow().timestamp()}',
+                                      hold_requests)
     
-    def create_factory_reset(self) -> str:
+    def create_factory_reset(self, cwmp_id: Optional[str] = None, hold_requests: bool = False) -> bytes:
         """Create FactoryReset request"""
-        envelope = ET.Element('{http://schemas.xmlsoap.org/soap/envelope/}Envelope')
-        envelope.set('xmlns:soap', NAMESPACES['soap'])
-        envelope.set('xmlns:cwmp', NAMESPACES['cwmp'])
-        
-        # Add SOAP Header with ID
-        header = ET.SubElement(envelope, '{http://schemas.xmlsoap.org/soap/envelope/}Header')
-        cwmp_id = ET.SubElement(header, '{urn:dslforum-org:cwmp-1-0}ID')
-        cwmp_id.set('soap:mustUnderstand', '1')
-        cwmp_id.text = str(uuid.uuid4())
-        
-        body = ET.SubElement(envelope, '{http://schemas.xmlsoap.org/soap/envelope/}Body')
-        factory_reset = ET.SubElement(body, '{urn:dslforum-org:cwmp-1-0}FactoryReset')
-        
-        return self._prettify_xml(envelope)
+        return self.serializer.factory_reset(cwmp_id or str(uuid.uuid4()), hold_requests)
     
-    def create_empty_response(self) -> str:
+    def create_empty_response(self) -> bytes:
         """Create empty SOAP response (no more commands)"""
-        envelope = ET.Element('{http://schemas.xmlsoap.org/soap/envelope/}Envelope')
-        envelope.set('xmlns:soap', NAMESPACES['soap'])
-        
-        body = ET.SubElement(envelope, '{http://schemas.xmlsoap.org/soap/envelope/}Body')
-        
-        return self._prettify_xml(envelope)
-    
-    def _prettify_xml(self, elem: ET.Element) -> str:
-        """Convert XML element to pretty string"""
-        from xml.dom import minidom
-        rough_string = ET.tostring(elem, encoding='unicode')
-        reparsed = minidom.parseString(rough_string)
-        return reparsed.toprettyxml(indent="  ", encoding='utf-8').decode('utf-8')
+        return self.serializer.empty()
 
 
 # Global CWMP server instance
-cwmp_server = CWMPServer()
+cwmp_server = CWMPServer(
+    pretty_xml=settings.CWMP_PRETTY_XML,
+    parser=settings.CWMP_PARSER,
+    xml_backend=settings.XML_BACKEND
+)
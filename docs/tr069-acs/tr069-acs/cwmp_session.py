@@ -0,0 +1,242 @@
+"""
+CWMP Sessions
+Bounded store of CWMP sessions that span several HTTP POSTs, persisted when they finish
+"""
+import asyncio
+import heapq
+import logging
+import time
+import uuid
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+from fastapi import Request
+from sqlalchemy import insert
+
+from config import settings
+from metrics import metrics
+from models import AsyncSessionLocal, Session as DBSession
+
+logger = logging.getLogger(__name__)
+
+# Cookie the ACS sets on the InformResponse; CPEs return it on every POST of the session
+SESSION_COOKIE = 'cwmp_session'
+
+
+class CWMPSession:
+    """State of one CWMP session, from Inform to the final empty HTTP response"""
+
+    def __init__(self, device_id: str, events: List[str], max_envelopes: int, connection: str,
+                 deadline: float):
+        self.id = uuid.uuid4().hex
+        self.device_id = device_id
+        self.events = events
+        self.max_envelopes = max_envelopes
+        self.connection = connection
+        self.started_at = datetime.utcnow()
+        self.started = time.monotonic()
+        self.deadline = deadline  # monotonic time the session expires unless the CPE posts again
+        self.messages = 1
+        self.cpe_done = False  # CPE sent an empty POST: it has no more requests of its own
+        self.task_id: Optional[int] = None  # task whose RPC is awaiting the CPE's response
+        self.task_cwmp_id: Optional[str] = None
+
+
+class SessionManager:
+    """Looks sessions up by cookie, falling back to the TCP connection for CPEs without cookie support
+
+    At most max_sessions are kept; past that the session closest to expiry is evicted.
+    Deadlines live in a min-heap that is only corrected when an entry reaches the top, so a
+    POST just moves the session's deadline and expiry never scans the live sessions.
+    Finished sessions are written to the sessions table in batches by a background task.
+    """
+
+    def __init__(self, timeout: float = 30, max_sessions: int = 10000,
+                 flush_interval_ms: int = 1000, flush_max_sessions: int = 500):
+        self.timeout = timeout
+        self.max_sessions = max(max_sessions, 1)
+        self.flush_interval = flush_interval_ms / 1000
+        self.flush_max_sessions = flush_max_sessions
+        self._sessions: Dict[str, CWMPSession] = {}
+        self._connections: Dict[str, str] = {}  # "host:port" -> session id
+        self._deadlines: List = []  # heap of (deadline, session id), possibly stale
+        self._finished: deque = deque(maxlen=self.max_sessions)  # session rows waiting to be written
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._flush_lock = asyncio.Lock()
+
+    def create(self, request: Request, device_id: str, events: List[str],
+               max_envelopes: Optional[str]) -> CWMPSession:
+        """Start a session for an Inform, replacing any earlier session on the same connection"""
+        now = time.monotonic()
+        self._expire(now)
+        connection = _connection_key(request)
+        previous = self._connections.get(connection)
+        if previous is not None and previous in self._sessions:
+            self._finish(self._sessions[previous], 'replaced')
+        while len(self._sessions) >= self.max_sessions:
+            self._finish(self._pop_earliest(), 'evicted')
+
+        session = CWMPSession(device_id, events, _parse_max_envelopes(max_envelopes), connection,
+                              now + self.timeout)
+        self._sessions[session.id] = session
+        self._connections[connection] = session.id
+        heapq.heappush(self._deadlines, (session.deadline, session.id))
+        if len(self._deadlines) > 2 * self.max_sessions:
+            # Entries of sessions that ended early wait for their deadline; drop them in one pass
+            self._deadlines = [(s.deadline, s.id) for s in self._sessions.values()]
+            heapq.heapify(self._deadlines)
+        metrics.incr('cwmp_sessions_started')
+        return session
+
+    def peek(self, request: Request) -> Optional[CWMPSession]:
+        """Session a POST belongs to, without counting it as activity"""
+        session_id = request.cookies.get(SESSION_COOKIE) or self._connections.get(_connection_key(request))
+        return self._sessions.get(session_id) if session_id else None
+
+    def get(self, request: Request) -> Optional[CWMPSession]:
+        """Session a follow-up POST belongs to, if it has not timed out"""
+        now = time.monotonic()
+        self._expire(now)
+        session = self.peek(request)
+        if session is not None:
+            self.touch(session)
+            session.messages += 1
+        return session
+
+    def touch(self, session: CWMPSession) -> None:
+        """Push a session's deadline back, e.g. while a long request body is still arriving"""
+        # The heap entry keeps the old deadline and is moved when it reaches the top
+        session.deadline = time.monotonic() + self.timeout
+
+    def end(self, session: CWMPSession) -> None:
+        """Finish a session that ran to completion"""
+        if session.id in self._sessions:
+            self._finish(session, 'completed')
+
+    def _finish(self, session: CWMPSession, reason: str) -> None:
+        """Forget a session and queue its record"""
+        del self._sessions[session.id]
+        if self._connections.get(session.connection) == session.id:
+            del self._connections[session.connection]
+        metrics.incr(f'cwmp_sessions_{reason}')
+
+        ended = time.monotonic()
+        if reason == 'expired':
+            ended = min(ended, session.deadline - self.timeout)  # last time the CPE was heard from
+        if len(self._finished) == self._finished.maxlen:
+            # The database is not keeping up; drop the oldest record rather than grow without bound
+            metrics.incr('cwmp_session_rows_dropped')
+        self._finished.append({
+            'id': session.id,
+            'device_id': session.device_id,
+            'started_at': session.started_at,
+            'ended_at': session.started_at + timedelta(seconds=max(ended - session.started, 0)),
+            'inform_events': session.events,
+            'messages_exchanged': session.messages
+        })
+        if len(self._finished) >= self.flush_max_sessions:
+            self._wake.set()
+
+    def _pop_earliest(self, until: float = float('inf')) -> Optional[CWMPSession]:
+        """Remove and return the live session with the earliest deadline, if it is due by until"""
+        heap = self._deadlines
+        while heap:
+            deadline, session_id = heap[0]
+            session = self._sessions.get(session_id)
+            if session is None:
+                heapq.heappop(heap)  # ended before its deadline
+            elif session.deadline > deadline:
+                heapq.heapreplace(heap, (session.deadline, session_id))  # touched since it was pushed
+            elif deadline > until:
+                return None
+            else:
+                heapq.heappop(heap)
+                return session
+        return None
+
+    def _expire(self, now: float) -> None:
+        """Finish every session whose deadline has passed"""
+        while True:
+            session = self._pop_earliest(now)
+            if session is None:
+                return
+            self._finish(session, 'expired')
+
+    async def flush(self) -> int:
+        """Write every finished session; returns the number of rows written"""
+        async with self._flush_lock:
+            if not self._finished:
+                return 0
+            batch = list(self._finished)
+            self._finished.clear()
+            try:
+                async with AsyncSessionLocal() as db:
+                    await db.execute(insert(DBSession), batch)
+                    await db.commit()
+            except Exception:
+                # Retry with the next flush, ahead of sessions that finished since
+                self._finished = deque(batch + list(self._finished), maxlen=self.max_sessions)
+                metrics.incr('cwmp_session_flush_errors')
+                raise
+            metrics.incr('cwmp_session_rows_written', len(batch))
+            return len(batch)
+
+    async def _run(self) -> None:
+        """Expire idle sessions and write finished ones every flush_interval, or sooner when many are waiting"""
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            self._expire(time.monotonic())
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Session flush failed; retrying on the next cycle")
+
+    async def start(self) -> None:
+        """Start the background expiry and writer"""
+        if self._task is None:
+            self._wake = asyncio.Event()  # bind to the running loop
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stop the background writer, recording sessions still open as expired"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for session in list(self._sessions.values()):
+            self._finish(session, 'expired')
+        await self.flush()
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+
+def _connection_key(request: Request) -> str:
+    client = request.client
+    return f"{client.host}:{client.port}" if client else ''
+
+
+def _parse_max_envelopes(value: Optional[str]) -> int:
+    """MaxEnvelopes from the Inform; anything missing or invalid counts as 1"""
+    try:
+        return max(int(value), 1)
+    except (TypeError, ValueError):
+        return 1
+
+
+# Global session manager
+session_manager = SessionManager(
+    timeout=settings.SESSION_TIMEOUT,
+    max_sessions=settings.SESSION_MAX_ACTIVE,
+    flush_interval_ms=settings.SESSION_FLUSH_INTERVAL_MS,
+    flush_max_sessions=settings.SESSION_FLUSH_MAX_SESSIONS
+)
@@ -0,0 +1,206 @@
+"""
+Device Cache
+Bounded LRU/TTL cache of device rows for the Inform path and REST lookups
+"""
+import json
+import logging
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, Optional
+
+from sqlalchemy import inspect, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import make_transient_to_detached
+
+try:
+    import asyncpg
+except ImportError:  # only needed for the PostgreSQL invalidation channel
+    asyncpg = None
+
+from config import settings
+from metrics import metrics
+from models import Device
+
+logger = logging.getLogger(__name__)
+
+NOTIFY_CHANNEL = 'acs_device_cache'
+
+# PostgreSQL rejects NOTIFY payloads of 8000 bytes or more
+NOTIFY_PAYLOAD_LIMIT = 7000
+
+DEVICE_COLUMNS = [attr.key for attr in inspect(Device).column_attrs]
+
+# Columns the database fills in on INSERT; a new row only knows them after a reload
+SERVER_DEFAULT_COLUMNS = {
+    attr.key for attr in inspect(Device).column_attrs
+    if any(column.server_default is not None for column in attr.columns)
+}
+
+
+class PostgresInvalidationChannel:
+    """Shares invalidations between worker processes through LISTEN/NOTIFY"""
+
+    def __init__(self, database_url: str, cache: 'DeviceCache'):
+        url = make_url(database_url)
+        if url.get_backend_name() != 'postgresql':
+            raise RuntimeError("DEVICE_CACHE_INVALIDATION=postgres needs a PostgreSQL DATABASE_URL")
+        if asyncpg is None:
+            raise RuntimeError("asyncpg is not installed")
+        self._dsn = url.set(drivername='postgresql').render_as_string(hide_password=False)
+        self._cache = cache
+        self._origin = uuid.uuid4().hex  # skip notifications this process sent
+        self._conn = None
+
+    async def start(self) -> None:
+        self._conn = await asyncpg.connect(self._dsn)
+        await self._conn.add_listener(NOTIFY_CHANNEL, self._on_notify)
+
+    async def stop(self) -> None:
+        if self._conn is not None:
+            await self._conn.close()
+            self._conn = None
+
+    async def publish(self, db: AsyncSession, device_ids: list) -> None:
+        """Queue invalidations in db's transaction; PostgreSQL delivers them on commit"""
+        batch = []
+        size = 0
+        for device_id in device_ids:
+            if batch and size + len(device_id) > NOTIFY_PAYLOAD_LIMIT:
+                await self._notify(db, batch)
+                batch, size = [], 0
+            batch.append(device_id)
+            size += len(device_id) + 4
+        if batch:
+            await self._notify(db, batch)
+
+    async def _notify(self, db: AsyncSession, device_ids: list) -> None:
+        await db.execute(text("SELECT pg_notify(:channel, :payload)"), {
+            'channel': NOTIFY_CHANNEL,
+            'payload': json.dumps([self._origin, device_ids])
+        })
+
+    def _on_notify(self, conn, pid, channel, payload) -> None:
+        origin, device_ids = json.loads(payload)
+        if origin != self._origin:
+            for device_id in device_ids:
+                self._cache.invalidate(device_id)
+
+
+INVALIDATION_CHANNELS = {
+    'postgres': PostgresInvalidationChannel,
+}
+
+
+class DeviceCache:
+    """LRU of device column values with a TTL; hits are attached to the caller's session without a query"""
+
+    def __init__(self, max_size: int = 10000, ttl: float = 300, enabled: bool = True,
+                 invalidation: Optional[str] = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.enabled = enabled and max_size > 0
+        self.invalidation = invalidation
+        self._entries: OrderedDict = OrderedDict()  # device_id -> (expires_at, column values)
+        self._channel: Optional[PostgresInvalidationChannel] = None
+
+    async def get(self, db: AsyncSession, device_id: str) -> Optional[Device]:
+        """Load a device into db, from the cache when possible"""
+        if not self.enabled:
+            return await db.get(Device, device_id)
+
+        entry = self._entries.get(device_id)
+        if entry is not None:
+            if entry[0] > time.monotonic():
+                self._entries.move_to_end(device_id)
+                metrics.incr('device_cache_hits')
+                device = Device(**entry[1])
+                make_transient_to_detached(device)
+                return await db.merge(device, load=False)
+            del self._entries[device_id]
+            metrics.incr('device_cache_expirations')
+
+        metrics.incr('device_cache_misses')
+        device = await db.get(Device, device_id)
+        if device is not None:
+            self.put(device)
+        return device
+
+    def put(self, device: Device, created: bool = False) -> None:
+        """Cache a device's committed column values
+
+        A row this session INSERTed leaves the columns it was not given unloaded; with
+        created they are cached as NULL, which is what the INSERT wrote.
+        """
+        if not self.enabled:
+            return
+        state = inspect(device)
+        unloaded = state.unloaded
+        if created:
+            unloaded = unloaded & SERVER_DEFAULT_COLUMNS
+        if unloaded or state.modified:
+            # Partially loaded or uncommitted rows would be cached wrong; look them up next time
+            self.invalidate(device.id)
+            return
+        values = {key: state.dict.get(key) for key in DEVICE_COLUMNS}
+        self._entries[device.id] = (time.monotonic() + self.ttl, values)
+        self._entries.move_to_end(device.id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            metrics.incr('device_cache_evictions')
+
+    def patch(self, device_id: str, values: Dict[str, Any]) -> None:
+        """Apply columns written without going through a cached instance"""
+        entry = self._entries.get(device_id)
+        if entry is not None:
+            entry[1].update((key, value) for key, value in values.items() if key in entry[1])
+
+    def invalidate(self, device_id: str) -> None:
+        """Drop a device after it was written elsewhere"""
+        if self._entries.pop(device_id, None) is not None:
+            metrics.incr('device_cache_invalidations')
+
+    async def publish(self, db: AsyncSession, device_ids: Iterable[str]) -> None:
+        """Tell other workers to drop these devices once db commits"""
+        if self._channel is not None:
+            await self._channel.publish(db, list(device_ids))
+
+    async def start(self) -> None:
+        """Connect the shared invalidation channel, if one is configured"""
+        if self.enabled and self.invalidation and self._channel is None:
+            if self.invalidation not in INVALIDATION_CHANNELS:
+                raise ValueError(f"Unknown device cache invalidation channel: {self.invalidation}")
+            self._channel = INVALIDATION_CHANNELS[self.invalidation](settings.DATABASE_URL, self)
+            await self._channel.start()
+
+    async def stop(self) -> None:
+        if self._channel is not None:
+            await self._channel.stop()
+            self._channel = None
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+def cache_enabled() -> bool:
+    """DEVICE_CACHE=auto turns the cache off for multi-worker deployments without an invalidation channel"""
+    mode = settings.DEVICE_CACHE.lower()
+    if mode == 'auto':
+        return settings.WORKERS <= 1 or bool(settings.DEVICE_CACHE_INVALIDATION)
+    if mode == 'true' and settings.WORKERS > 1 and not settings.DEVICE_CACHE_INVALIDATION:
+        logger.warning("Device cache enabled for %d workers without an invalidation channel; "
+                       "reads may be stale for up to DEVICE_CACHE_TTL", settings.WORKERS)
+    return mode == 'true'
+
+
+# Global device cache
+device_cache = DeviceCache(
+    max_size=settings.DEVICE_CACHE_SIZE,
+    ttl=settings.DEVICE_CACHE_TTL,
+    enabled=cache_enabled(),
+    invalidation=settings.DEVICE_CACHE_INVALIDATION or None
+)
@@ -0,0 +1,147 @@
+"""
+Parameter Fingerprints
+Hashes of the stored parameter values (parameters.value_hash), used to skip unchanged writes
+"""
+from collections import OrderedDict
+from hashlib import blake2b
+from typing import Dict, Iterable, Optional, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from config import settings
+from metrics import metrics
+from models import Parameter, ParameterName
+
+
+def _name_hash(name: str) -> int:
+    return int.from_bytes(blake2b(name.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def value_hash(value: Optional[str], value_type: Optional[str] = None) -> int:
+    """64-bit hash of a value and its type, signed to fit a BIGINT column
+
+    A value whose hash collides with the stored one is never written, so the hash is 64
+    bits wide: at 2^-64 per changed value, a skipped write is out of reach at any fleet size.
+    """
+    # 0 is reserved for None so it never matches an empty string
+    if value is None:
+        return 0
+    if value_type:
+        # A type change alone must rewrite the row; untyped values hash as before
+        value = f'{value}\0{value_type}'
+    return int.from_bytes(blake2b(value.encode('utf-8'), digest_size=8).digest(), 'little', signed=True) or 1
+
+
+def changed_parameters(known: Dict[int, int], parameters: Dict[str, str],
+                       types: Optional[Dict[str, str]] = None) -> Tuple[Dict[str, str], Dict[int, int]]:
+    """Parameters whose value (and type, when given) differs from known, with their new fingerprints"""
+    types = types or {}
+    changed = {}
+    updates = {}
+    for name, value in parameters.items():
+        name_hash = _name_hash(name)
+        new_hash = value_hash(value, types.get(name))
+        if known.get(name_hash) != new_hash:
+            changed[name] = value
+            updates[name_hash] = new_hash
+
+    metrics.incr('parameter_writes', len(changed))
+    metrics.incr('parameter_writes_avoided', len(parameters) - len(changed))
+    return changed, updates
+
+
+async def stored_fingerprints(db: AsyncSession, device_id: str,
+                              names: Optional[Iterable[str]] = None) -> Dict[int, int]:
+    """{name hash: value hash} of a device's stored parameters, or of some of them
+
+    Rows written before value_hash existed have none and are rewritten once.
+    """
+    query = select(ParameterName.name, Parameter.value_hash).join(
+        ParameterName, ParameterName.id == Parameter.name_id
+    ).filter(Parameter.device_id == device_id, Parameter.value_hash.isnot(None))
+    if names is not None:
+        query = query.filter(ParameterName.name.in_(list(names)))
+    return {_name_hash(name): stored for name, stored in await db.execute(query)}
+
+
+class ParameterFingerprints:
+    """LRU of per-device fingerprints, read back from parameters.value_hash on a miss
+
+    Entries follow the writes of this process only: every writer of the parameters table
+    hashes the values it stores, and remember() applies them once committed. With several
+    workers a device's rows change unseen, so the LRU is off and each diff reads back the
+    hashes of the names it compares.
+    """
+
+    def __init__(self, max_devices: int = 10000, max_entries: int = 1000000):
+        self.max_devices = max_devices
+        self.max_entries = max_entries  # ~120 bytes each; full-tree GPVs make maps large
+        self._devices: OrderedDict = OrderedDict()  # device_id -> {name hash: value hash}
+        self._entries = 0
+
+    async def load(self, db: AsyncSession, device_id: str, names: Iterable[str]) -> Dict[int, int]:
+        """Fingerprints of a device, covering at least names
+
+        A miss reads back every stored hash of the device, or only those of names when the
+        LRU is off. The returned dict is shared with the cache; copy it before changing it.
+        """
+        fingerprints = self._devices.get(device_id)
+        if fingerprints is not None:
+            self._devices.move_to_end(device_id)
+            metrics.incr('fingerprint_cache_hits')
+            return fingerprints
+        metrics.incr('fingerprint_cache_misses')
+        if self.max_devices <= 0:
+            return await stored_fingerprints(db, device_id, names)
+        fingerprints = await stored_fingerprints(db, device_id)
+        self._store(device_id, fingerprints)
+        return fingerprints
+
+    def _store(self, device_id: str, fingerprints: Dict[int, int]) -> None:
+        self._discard(device_id)
+        if self.max_devices <= 0 or len(fingerprints) > self.max_entries:
+            return
+        self._devices[device_id] = fingerprints
+        self._entries += len(fingerprints)
+        self._evict()
+
+    def _evict(self) -> None:
+        while len(self._devices) > self.max_devices or self._entries > self.max_entries:
+            self._entries -= len(self._devices.popitem(last=False)[1])
+
+    def _discard(self, device_id: str) -> None:
+        fingerprints = self._devices.pop(device_id, None)
+        if fingerprints is not None:
+            self._entries -= len(fingerprints)
+
+    async def diff(self, db: AsyncSession, device_id: str, parameters: Dict[str, str],
+                   types: Optional[Dict[str, str]] = None) -> Tuple[Dict[str, str], Dict[int, int]]:
+        """Split off the parameters whose value (or xsi:type) differs from the last stored one
+
+        Returns the changed parameters and their new fingerprints, for remember() once written.
+        """
+        known = await self.load(db, device_id, parameters)
+        return changed_parameters(known, parameters, types)
+
+    def remember(self, device_id: str, updates: Dict[int, int]) -> None:
+        """Apply fingerprints after their rows were committed"""
+        fingerprints = self._devices.get(device_id)
+        if fingerprints is None:
+            return
+        before = len(fingerprints)
+        fingerprints.update(updates)
+        self._entries += len(fingerprints) - before
+        self._evict()
+
+    def __len__(self) -> int:
+        return len(self._devices)
+
+
+def cache_size() -> int:
+    """Devices the LRU may hold: none with several workers, which write each other's devices"""
+    return settings.FINGERPRINT_CACHE_SIZE if settings.WORKERS <= 1 else 0
+
+
+# Global fingerprint cache
+parameter_fingerprints = ParameterFingerprints(cache_size(), settings.FINGERPRINT_CACHE_MAX_ENTRIES)
@@ -0,0 +1,162 @@
+"""
+Fleet Counters
+Device and task aggregates for /api/stats, kept up to date as devices and tasks change
+"""
+import asyncio
+import logging
+from collections import Counter
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy import func, select
+
+from config import settings
+from liveness import liveness_buffer
+from metrics import metrics
+from models import AsyncSessionLocal, Device, Task
+
+logger = logging.getLogger(__name__)
+
+# (product_class, software_version, online) -> devices
+DeviceKey = Tuple[Optional[str], Optional[str], bool]
+
+
+class FleetCounters:
+    """Per-worker device counts by product class, software version and online state, and pending tasks
+
+    Callers report each change after it commits, so reads never touch the database. A
+    periodic reconciliation replaces the counts with the database's, which corrects drift
+    and, with several workers, picks up the changes the other workers made.
+    """
+
+    def __init__(self, reconcile_interval: float = 300):
+        self.reconcile_interval = reconcile_interval
+        self._devices: Counter = Counter()
+        self._pending_tasks = 0
+        self._since: Optional[Counter] = None  # changes reported while a reconciliation reads
+        self._pending_since = 0
+        self.reconciled_at: Optional[datetime] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def device_added(self, product_class: Optional[str], software_version: Optional[str],
+                     online: bool = True) -> None:
+        """A device row was created"""
+        self._add((product_class, software_version, bool(online)), 1)
+
+    def device_changed(self, before: DeviceKey, after: DeviceKey) -> None:
+        """A device moved between (product_class, software_version, online) groups"""
+        before = (before[0], before[1], bool(before[2]))
+        after = (after[0], after[1], bool(after[2]))
+        if before != after:
+            self._add(before, -1)
+            self._add(after, 1)
+
+    def tasks_queued(self, count: int = 1) -> None:
+        """Tasks entered the pending state (a negative count: they left it)"""
+        self._pending_tasks += count
+        if self._since is not None:
+            self._pending_since += count
+
+    def _add(self, key: DeviceKey, amount: int) -> None:
+        self._devices[key] += amount
+        if self._devices[key] <= 0:
+            del self._devices[key]
+        if self._since is not None:
+            self._since[key] += amount
+
+    def stats(self) -> Dict[str, Any]:
+        """Totals and breakdowns; the cost depends on the number of groups, not of devices"""
+        total = online = 0
+        product_classes: Dict[Optional[str], List[int]] = {}
+        software_versions: Dict[Optional[str], List[int]] = {}
+        for (product_class, software_version, is_online), count in self._devices.items():
+            total += count
+            for groups, name in ((product_classes, product_class), (software_versions, software_version)):
+                group = groups.setdefault(name, [0, 0])
+                group[0] += count
+                if is_online:
+                    group[1] += count
+            if is_online:
+                online += count
+        return {
+            'total_devices': total,
+            'online_devices': online,
+            'offline_devices': total - online,
+            'pending_tasks': self._pending_tasks,
+            'product_classes': _breakdown('product_class', product_classes),
+            'software_versions': _breakdown('software_version', software_versions),
+            'reconciled_at': self.reconciled_at.isoformat() if self.reconciled_at else None
+        }
+
+    async def reconcile(self) -> int:
+        """Reload the counts from the database; returns how many devices and tasks they were off by"""
+        self._since = Counter()
+        self._pending_since = 0
+        try:
+            # Buffered heartbeats would otherwise read as the devices' previous online state
+            await liveness_buffer.flush()
+            async with AsyncSessionLocal() as db:
+                rows = await db.execute(
+                    select(Device.product_class, Device.software_version, Device.online, func.count())
+                    .group_by(Device.product_class, Device.software_version, Device.online)
+                )
+                devices = Counter()
+                for product_class, software_version, online, count in rows:
+                    devices[(product_class, software_version, bool(online))] += count
+                pending_tasks = await db.scalar(
+                    select(func.count()).select_from(Task).filter(Task.status == 'pending')
+                )
+            # Changes reported during the read are not all in it; applying them again can only
+            # overcount the few that committed before it, until the next reconciliation
+            devices.update(self._since)
+            devices = Counter({key: count for key, count in devices.items() if count > 0})
+            pending_tasks += self._pending_since
+        finally:
+            self._since = None
+        drift = sum(abs(devices[key] - self._devices[key]) for key in set(devices) | set(self._devices))
+        drift += abs(pending_tasks - self._pending_tasks)
+        self._devices = devices
+        self._pending_tasks = pending_tasks
+        self.reconciled_at = datetime.utcnow()
+        metrics.incr('fleet_counter_reconciliations')
+        metrics.incr('fleet_counter_corrections', drift)
+        return drift
+
+    async def _run(self) -> None:
+        """Reconcile every reconcile_interval"""
+        while True:
+            await asyncio.sleep(self.reconcile_interval)
+            try:
+                drift = await self.reconcile()
+                if drift:
+                    logger.info("Fleet counters were off by %d; reloaded from the database", drift)
+            except Exception:
+                logger.exception("Fleet counter reconciliation failed; retrying on the next cycle")
+
+    async def start(self) -> None:
+        """Load the counts and start the periodic reconciliation"""
+        await self.reconcile()
+        if self._task is None and self.reconcile_interval > 0:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stop the periodic reconciliation"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+def _breakdown(key: str, groups: Dict[Optional[str], List[int]]) -> List[Dict[str, Any]]:
+    """Groups as a list, largest first"""
+    return [
+        {key: name, 'total': total, 'online': online, 'offline': total - online}
+        for name, (total, online) in sorted(groups.items(), key=lambda item: (-item[1][0], item[0] or ''))
+    ]
+
+
+# Global fleet counters
+fleet_counters = FleetCounters(settings.FLEET_COUNTERS_RECONCILE_INTERVAL)
@@ -0,0 +1,300 @@
+"""
+Inform Spreading
+Evens out when the fleet's periodic Informs arrive over the interval, moving devices out of
+crowded slots with set_params tasks on PeriodicInformInterval and PeriodicInformTime
+"""
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Any, AsyncIterator, Dict, Iterable, List, Optional
+
+from sqlalchemy import and_, insert, or_, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from bulk_tasks import filter_conditions, parse_filter
+from config import settings
+from fleet_counters import fleet_counters
+from metrics import metrics
+from models import Device, Job, Parameter, Task
+from parameter_names import parameter_names
+
+logger = logging.getLogger(__name__)
+
+# Data model roots: a device is set under the one it reported its ConnectionRequestURL in,
+# InternetGatewayDevice (TR-098) when neither is stored
+ROOTS = ('InternetGatewayDevice', 'Device')
+URL_PARAMETER = 'ManagementServer.ConnectionRequestURL'
+INTERVAL_PARAMETER = 'ManagementServer.PeriodicInformInterval'
+TIME_PARAMETER = 'ManagementServer.PeriodicInformTime'
+
+# Task states in which a device's phase change is still on its way
+UNFINISHED = ('pending', 'sent')
+
+# Slots a histogram may have (interval / bucket)
+MAX_SLOTS = 3600
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def check_slots(interval: Any, bucket: Any) -> None:
+    """ValueError unless the interval splits into whole slots of bucket seconds"""
+    for name, value in (('interval', interval), ('bucket', bucket)):
+        if isinstance(value, bool) or not isinstance(value, int) or value < 1:
+            raise ValueError(f"{name} must be a positive whole number of seconds")
+    if interval % bucket:
+        raise ValueError("interval must be a multiple of bucket")
+    if interval // bucket > MAX_SLOTS:
+        raise ValueError(f"interval / bucket must be at most {MAX_SLOTS} slots")
+
+
+def parse_spreading(body: Dict[str, Any]) -> Dict[str, Any]:
+    """The options of a spreading request; ValueError when one is malformed"""
+    interval = body.get('interval', settings.DEFAULT_INFORM_INTERVAL)
+    bucket = body.get('bucket', settings.INFORM_SPREAD_BUCKET)
+    check_slots(interval, bucket)
+    device_filter = body.get('filter')
+    return {
+        'interval': interval,
+        'bucket': bucket,
+        'filter': parse_filter(device_filter) if device_filter is not None else None,
+        'dry_run': bool(body.get('dry_run'))
+    }
+
+
+def inform_phase(last_inform: datetime, interval: int) -> int:
+    """Second of the interval (counted from the epoch) an Inform arrived in"""
+    return int((last_inform - EPOCH).total_seconds()) % interval
+
+
+def histogram_summary(counts: List[int], interval: int, bucket: int) -> Dict[str, Any]:
+    """Inform rates of a histogram, in Informs per second; peak_to_average is 1.0 when flat"""
+    devices = sum(counts)
+    peak = max(counts)
+    return {
+        'devices': devices,
+        'interval': interval,
+        'bucket': bucket,
+        'average_rate': round(devices / interval, 3),
+        'peak_rate': round(peak / bucket, 3),
+        'peak_to_average': round(peak * len(counts) / devices, 3) if devices else None,
+        'histogram': counts
+    }
+
+
+def even_targets(counts: List[int]) -> List[int]:
+    """Devices each slot should hold: the same number, give or take one, the extra
+    devices staying in the slots that hold the most already"""
+    base, extra = divmod(sum(counts), len(counts))
+    targets = [base] * len(counts)
+    for slot in sorted(range(len(counts)), key=lambda slot: -counts[slot])[:extra]:
+        targets[slot] += 1
+    return targets
+
+
+def assign_slots(movers: List[str], counts: List[int], targets: List[int], bucket: int) -> Dict[str, int]:
+    """New phases of the devices taken out of crowded slots, filling the slots short of their
+    target in order, evenly spaced within each; counts (without the movers) is updated"""
+    phases = {}
+    taken = 0
+    for slot, target in enumerate(targets):
+        room = target - counts[slot]
+        if room <= 0 or taken >= len(movers):
+            continue
+        arrivals = movers[taken:taken + room]
+        taken += len(arrivals)
+        for position, device_id in enumerate(arrivals):
+            phases[device_id] = slot * bucket + (2 * position + 1) * bucket // (2 * len(arrivals))
+        counts[slot] += len(arrivals)
+    return phases
+
+
+async def _informing_devices(db: AsyncSession, interval: int, device_filter: Optional[Dict[str, Any]],
+                             now: datetime) -> AsyncIterator[List[Any]]:
+    """Pages of (id, last_inform) of the devices that informed within two intervals,
+    in id order; devices silent for longer are offline and have no phase to speak of"""
+    since = now - timedelta(seconds=2 * interval)
+    page_size = settings.BULK_TASK_CHUNK_SIZE
+    after = None
+    while True:
+        query = select(Device.id, Device.last_inform).filter(
+            Device.last_inform >= since, *filter_conditions(device_filter or {})
+        )
+        if after is not None:
+            query = query.filter(Device.id > after)
+        rows = (await db.execute(query.order_by(Device.id).limit(page_size))).all()
+        if rows:
+            yield rows
+        if len(rows) < page_size:
+            return
+        after = rows[-1].id
+
+
+async def inform_histogram(db: AsyncSession, interval: int, bucket: int,
+                           device_filter: Optional[Dict[str, Any]] = None,
+                           now: Optional[datetime] = None) -> List[int]:
+    """Devices per slot of the interval, by the phase of their last Inform"""
+    counts = [0] * (interval // bucket)
+    async for rows in _informing_devices(db, interval, device_filter, now or datetime.utcnow()):
+        for row in rows:
+            counts[inform_phase(row.last_inform, interval) // bucket] += 1
+    return counts
+
+
+async def _pending_phases(db: AsyncSession, device_ids: List[str], interval: int,
+                          now: datetime) -> Dict[str, Optional[int]]:
+    """Devices with a PeriodicInformTime change queued, or applied less than an interval
+    ago (their last Inform may predate it), and the phase it sets (None when the time
+    cannot be read); these devices are not moved again"""
+    since = now - timedelta(seconds=interval)
+    rows = await db.execute(
+        select(Task.device_id, Task.parameters).filter(
+            Task.device_id.in_(device_ids), Task.task_type == 'set_params',
+            or_(Task.status.in_(UNFINISHED), and_(Task.status == 'completed', Task.completed_at >= since))
+        )
+    )
+    phases = {}
+    for device_id, parameters in rows:
+        for name, value in (parameters or {}).get('values', {}).items():
+            if not name.endswith(TIME_PARAMETER):
+                continue
+            try:
+                reference = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+            except ValueError:
+                phases.setdefault(device_id, None)
+                continue
+            if reference.tzinfo is not None:
+                reference = reference.astimezone(timezone.utc).replace(tzinfo=None)
+            phases[device_id] = inform_phase(reference, interval)
+    return phases
+
+
+async def _roots(db: AsyncSession, device_ids: Iterable[str]) -> Dict[str, str]:
+    """Data model root of each device that reported a ConnectionRequestURL"""
+    names = {f'{root}.{URL_PARAMETER}': root for root in ROOTS}
+    ids = await db.run_sync(lambda session: parameter_names.ids(session, names, create=False))
+    if not ids:
+        return {}
+    by_id = {name_id: names[name] for name, name_id in ids.items()}
+    rows = await db.execute(
+        select(Parameter.device_id, Parameter.name_id).filter(
+            Parameter.device_id.in_(list(device_ids)), Parameter.name_id.in_(list(by_id))
+        )
+    )
+    return {device_id: by_id[name_id] for device_id, name_id in rows}
+
+
+def spreading_parameters(root: str, interval: int, phase: int, now: datetime) -> Dict[str, Any]:
+    """set_params parameters putting a device's Informs at the phase of every interval"""
+    reference = EPOCH + timedelta(seconds=int((now - EPOCH).total_seconds()) // interval * interval + phase)
+    interval_name = f'{root}.{INTERVAL_PARAMETER}'
+    time_name = f'{root}.{TIME_PARAMETER}'
+    return {
+        'values': {interval_name: str(interval), time_name: reference.strftime('%Y-%m-%dT%H:%M:%SZ')},
+        'types': {interval_name: 'xsd:unsignedInt', time_name: 'xsd:dateTime'}
+    }
+
+
+async def spread_informs(db: AsyncSession, interval: int, bucket: int,
+                         device_filter: Optional[Dict[str, Any]] = None,
+                         dry_run: bool = False) -> Dict[str, Any]:
+    """Plan, and unless dry_run queue, the moves that even out the Inform histogram
+
+    A first pass reads the histogram, as measured and as it will be once the
+    PeriodicInformTime changes already queued are applied, and gives every slot its even
+    share of the latter. A second pass over the same devices takes the excess of the
+    crowded slots, leaving devices with a change queued where they are, and places it in
+    the slots short of their share. The tasks go in as a job (GET /api/jobs/{id}), a
+    multi-row INSERT per chunk, and are sent at each device's next Inform: no connection
+    requests, which would only add a spike of their own. 'after' is the histogram once
+    every queued change is applied.
+    """
+    now = datetime.utcnow()
+    measured = [0] * (interval // bucket)
+    counts = [0] * (interval // bucket)
+    async for rows in _informing_devices(db, interval, device_filter, now):
+        pending = await _pending_phases(db, [row.id for row in rows], interval, now)
+        for row in rows:
+            phase = inform_phase(row.last_inform, interval)
+            measured[phase // bucket] += 1
+            planned = pending.get(row.id)
+            counts[(phase if planned is None else planned) // bucket] += 1
+    targets = even_targets(counts)
+    excess = [max(count - target, 0) for count, target in zip(counts, targets)]
+    movers = []
+    sources = []
+    if any(excess):
+        async for rows in _informing_devices(db, interval, device_filter, now):
+            crowded = [row for row in rows if excess[inform_phase(row.last_inform, interval) // bucket]]
+            if not crowded:
+                continue
+            pending = await _pending_phases(db, [row.id for row in crowded], interval, now)
+            for row in crowded:
+                slot = inform_phase(row.last_inform, interval) // bucket
+                if excess[slot] and row.id not in pending:
+                    excess[slot] -= 1
+                    counts[slot] -= 1
+                    movers.append(row.id)
+                    sources.append(slot)
+    phases = assign_slots(movers, counts, targets, bucket)
+    # Devices that informed between the passes can leave movers without a place; they stay
+    for slot in sources[len(phases):]:
+        counts[slot] += 1
+
+    result = {
+        'before': histogram_summary(measured, interval, bucket),
+        'after': histogram_summary(counts, interval, bucket),
+        'devices_moved': len(phases),
+        'job_id': None
+    }
+    if dry_run or not phases:
+        return result
+
+    job = Job(
+        task_type='set_params',
+        parameters={'interval': interval, 'bucket': bucket},
+        target={'inform_spreading': {
+            'filter': device_filter,
+            'peak_to_average': {'before': result['before']['peak_to_average'],
+                                'after': result['after']['peak_to_average']}
+        }},
+        status='running',
+        devices_matched=sum(measured)
+    )
+    db.add(job)
+    await db.commit()
+    result['job_id'] = job.id
+
+    chunk_size = settings.BULK_TASK_CHUNK_SIZE
+    device_ids = list(phases)
+    try:
+        for start in range(0, len(device_ids), chunk_size):
+            chunk = device_ids[start:start + chunk_size]
+            roots = await _roots(db, chunk)
+            await db.execute(insert(Task), [{
+                'device_id': device_id,
+                'task_type': 'set_params',
+                'parameters': spreading_parameters(roots.get(device_id, ROOTS[0]), interval,
+                                                   phases[device_id], now),
+                'status': 'pending',
+                'created_at': now,
+                'job_id': job.id
+            } for device_id in chunk])
+            await db.execute(
+                update(Job).where(Job.id == job.id).values(tasks_created=Job.tasks_created + len(chunk))
+            )
+            await db.commit()
+            fleet_counters.tasks_queued(len(chunk))
+            metrics.incr('inform_spreading_tasks', len(chunk))
+    except Exception as e:
+        logger.exception("Inform spreading job %d failed", job.id)
+        await db.rollback()
+        await db.execute(
+            update(Job).where(Job.id == job.id)
+            .values(status='failed', error=str(e), completed_at=datetime.utcnow())
+        )
+        await db.commit()
+        raise
+    await db.execute(
+        update(Job).where(Job.id == job.id).values(status='completed', completed_at=datetime.utcnow())
+    )
+    await db.commit()
+    return result
@@ -0,0 +1,123 @@
+"""
+Liveness Buffer
+Write-behind buffer for the heartbeat fields every Inform refreshes
+"""
+import asyncio
+import logging
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+from sqlalchemy import update
+
+from config import settings
+from device_cache import device_cache
+from metrics import metrics
+from models import AsyncSessionLocal, Device
+
+logger = logging.getLogger(__name__)
+
+# Device columns owned by the buffer between flushes
+LIVENESS_FIELDS = ('last_inform', 'online', 'ip_address')
+
+
+class LivenessBuffer:
+    """Coalesces last_inform/online/ip_address per device and writes them in one batched UPDATE"""
+
+    def __init__(self, flush_interval_ms: int = 1000, max_devices: int = 500):
+        self.flush_interval = flush_interval_ms / 1000
+        self.max_devices = max_devices
+        self._pending: Dict[str, Dict[str, Any]] = {}
+        self._flushing: Dict[str, Dict[str, Any]] = {}  # batch being written, still visible to reads
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._flush_lock = asyncio.Lock()
+
+    def record(self, device_id: str, ip_address: Optional[str],
+               last_inform: Optional[datetime] = None) -> Dict[str, Any]:
+        """Buffer an Inform's heartbeat; later Informs from the same device replace it"""
+        heartbeat = {
+            'id': device_id,
+            'last_inform': last_inform or datetime.utcnow(),
+            'online': True,
+            'ip_address': ip_address
+        }
+        self._pending[device_id] = heartbeat
+        metrics.incr('liveness_updates_buffered')
+        if len(self._pending) >= self.max_devices:
+            self._wake.set()
+        return heartbeat
+
+    def get(self, device_id: str) -> Optional[Dict[str, Any]]:
+        """Buffered heartbeat for a device, if one has not reached the database yet"""
+        return self._pending.get(device_id) or self._flushing.get(device_id)
+
+    def view(self, device: Device) -> Dict[str, Any]:
+        """A device's liveness fields, preferring buffered values over the loaded row"""
+        buffered = self.get(device.id)
+        if buffered is not None:
+            return buffered
+        return {field: getattr(device, field) for field in LIVENESS_FIELDS}
+
+    async def flush(self) -> int:
+        """Write every buffered heartbeat; returns the number of devices updated"""
+        async with self._flush_lock:
+            if not self._pending:
+                return 0
+            batch, self._pending = self._pending, {}
+            self._flushing = batch
+            try:
+                async with AsyncSessionLocal() as db:
+                    # ORM bulk UPDATE by primary key: one executemany for the whole batch
+                    await db.execute(update(Device), list(batch.values()))
+                    await device_cache.publish(db, batch)
+                    await db.commit()
+            except Exception:
+                # Keep the batch for the next attempt unless a newer heartbeat replaced it
+                for device_id, row in batch.items():
+                    self._pending.setdefault(device_id, row)
+                metrics.incr('liveness_flush_errors')
+                raise
+            finally:
+                self._flushing = {}
+            for device_id, row in batch.items():
+                device_cache.patch(device_id, row)
+            metrics.incr('liveness_flushes')
+            metrics.incr('liveness_rows_flushed', len(batch))
+            return len(batch)
+
+    async def _run(self) -> None:
+        """Flush every flush_interval, or sooner once max_devices are waiting"""
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Liveness flush failed; retrying on the next cycle")
+
+    async def start(self) -> None:
+        """Start the background flusher"""
+        if self._task is None:
+            self._wake = asyncio.Event()  # bind to the running loop
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stop the background flusher and write whatever is still buffered"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+
+# Global liveness buffer
+liveness_buffer = LivenessBuffer(settings.LIVENESS_FLUSH_INTERVAL_MS, settings.LIVENESS_FLUSH_MAX_DEVICES)
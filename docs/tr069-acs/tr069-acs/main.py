@@ -2,20 +2,46 @@
 TR-069 ACS - Main Application
 FastAPI server with CWMP endpoint and REST API
 """
-from fastapi import FastAPI, Request, Depends, HTTPException
+from fastapi import FastAPI, Request, Depends, HTTPException, Query
 from fastapi.responses import Response, HTMLResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy.orm import Session
-from typing import List, Optional
-from datetime import datetime
+from sqlalchemy import and_, delete, func, insert, or_, select, tuple_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import List, Optional, Tuple
+from datetime import datetime, timezone
+import base64
+import json
+import logging
+import operator
 import uuid
 
-from cwmp_server import cwmp_server
+from admission import Overloaded, admission
+from bulk_tasks import TASK_TYPES, bulk_tasks, job_summary, parse_target
+from campaigns import campaign_summary, campaigns, parse_campaign, wave_counts
+from config import settings
+from connection_requests import connection_requests
+from cwmp_server import METHOD_NOT_SUPPORTED, cwmp_server
+from cwmp_session import CWMPSession, SESSION_COOKIE, session_manager
+from device_cache import device_cache
+from fleet_counters import fleet_counters
+from fingerprints import parameter_fingerprints
+from inform_spreading import check_slots, histogram_summary, inform_histogram, parse_spreading, spread_informs
+from liveness import liveness_buffer
+from metrics import metrics
+from parameter_names import parameter_names, path_depth, prefix_range
+from parameter_store import ParameterIngest, upsert_parameters_async
+from parameter_types import TYPE_COLUMNS, convert, type_name
+from offline_sweeper import offline_sweeper
+from task_queue import claim_next_task
+from task_retries import task_retries
 from models import (
-    init_db, get_db, Device, Parameter, Task, Session as DBSession
+    init_db, get_async_db, async_engine, Campaign, Device, DeviceTag, Job, Parameter, ParameterName, Task, Session as DBSession
 )
 
+logger = logging.getLogger(__name__)
+
 # Initialize FastAPI app
 app = FastAPI(title="TR-069 ACS", version="1.0.0")
 
@@ -32,41 +58,296 @@ app.add_middleware(
 init_db()
 
 
+@app.on_event("startup")
+async def startup():
+    """Start background writers"""
+    await device_cache.start()
+    await liveness_buffer.start()
+    await fleet_counters.start()
+    await offline_sweeper.start()
+    await connection_requests.start()
+    await task_retries.start()
+    await campaigns.start()
+    await session_manager.start()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    """Flush buffered writes and close pooled async database connections"""
+    await session_manager.stop()
+    await bulk_tasks.stop()
+    await campaigns.stop()
+    await task_retries.stop()
+    await connection_requests.stop()
+    await offline_sweeper.stop()
+    await fleet_counters.stop()
+    await liveness_buffer.stop()
+    await device_cache.stop()
+    await async_engine.dispose()
+
+
 # ============================================================================
 # CWMP Endpoint (for device communication)
 # ============================================================================
 
+# CPE-initiated requests answered within a session, besides Inform; any other request
+# gets a Fault 8000 (Method not supported)
+CPE_REQUESTS = {
+    'GetRPCMethods': cwmp_server.create_get_rpc_methods_response,
+    'TransferComplete': cwmp_server.create_transfer_complete_response,
+    'AutonomousTransferComplete': cwmp_server.create_autonomous_transfer_complete_response,
+}
+
+# Response the CPE sends to each task type's RPC (or a Fault)
+TASK_RESPONSES = {
+    'get_params': 'GetParameterValuesResponse',
+    'set_params': 'SetParameterValuesResponse',
+    'reboot': 'RebootResponse',
+    'factory_reset': 'FactoryResetResponse',
+}
+
+
+def _soap_response(content: bytes) -> Response:
+    return Response(
+        content=content,
+        media_type="text/xml",
+        headers={"SOAPAction": ""}
+    )
+
+
+def _fault_response(content: bytes) -> Response:
+    """A SOAP Fault goes out with 500 Internal Server Error (SOAP 1.1, 6.2)"""
+    return Response(
+        content=content,
+        status_code=500,
+        media_type="text/xml",
+        headers={"SOAPAction": ""}
+    )
+
+
+def _overloaded_response(overloaded: Overloaded) -> Response:
+    """503 with Retry-After: the CPE retries the session later (TR-069 3.2.1.1)"""
+    return Response(status_code=503, headers={"Retry-After": str(overloaded.retry_after)})
+
+
+def _create_task_rpc(task: Task, cwmp_id: str, hold_requests: bool) -> Optional[bytes]:
+    """Build the RPC for a queued task, or None for an unknown task type"""
+    if task.task_type == 'get_params':
+        param_names = task.parameters.get('names', [])
+        return cwmp_server.create_get_parameter_values(param_names, cwmp_id, hold_requests)
+    elif task.task_type == 'set_params':
+        params_to_set = task.parameters.get('values', {})
+        return cwmp_server.create_set_parameter_values(params_to_set, cwmp_id, hold_requests,
+                                                       task.parameters.get('types'))
+    elif task.task_type == 'reboot':
+        return cwmp_server.create_reboot(cwmp_id, hold_requests)
+    elif task.task_type == 'factory_reset':
+        return cwmp_server.create_factory_reset(cwmp_id, hold_requests)
+    return None
+
+
+async def _pending_tasks(db: AsyncSession, device_id: str, limit: int) -> List[Task]:
+    """Oldest pending tasks of a device, in the order they were queued
+    
+    None while the oldest is backing off after a timeout, so tasks never overtake it.
+    """
+    tasks = (await db.scalars(select(Task).filter(
+        Task.device_id == device_id,
+        Task.status == 'pending'
+    ).order_by(Task.id).limit(limit))).all()
+    if tasks and tasks[0].next_attempt_at and tasks[0].next_attempt_at > datetime.utcnow():
+        return []
+    return tasks
+
+
+async def _commit_with_parameters(db: AsyncSession, device_id: str, parameters: dict,
+                                  types: Optional[dict] = None) -> None:
+    """Commit, storing the reported or confirmed parameter values that changed"""
+    if not parameters or await device_cache.get(db, device_id) is None:
+        await db.commit()
+        return
+    changed, fingerprints = await parameter_fingerprints.diff(db, device_id, parameters, types)
+    if changed:
+        await upsert_parameters_async(db, device_id, changed, types=types)
+    await db.commit()
+    parameter_fingerprints.remember(device_id, fingerprints)
+
+
+async def _commit_with_ingest(db: AsyncSession, ingest: ParameterIngest) -> None:
+    """Commit the end of a GetParameterValuesResponse ingest with the caller's changes"""
+    await db.commit()
+    ingest.remember()
+
+
+async def _finish_task(db: AsyncSession, session: CWMPSession, method: str, params: dict,
+                       cwmp_id: Optional[str], ingest: Optional[ParameterIngest] = None) -> None:
+    """Record the CPE's response to the RPC sent for the session's current task"""
+    task = await db.get(Task, session.task_id) if session.task_id is not None else None
+    session.task_id = None
+    if task is not None and method != 'Fault' and method != TASK_RESPONSES.get(task.task_type):
+        # Not the answer to this task's RPC: the task stays sent, and is requeued if never answered
+        logger.warning("Device %s sent %s while task %d (%s) awaits its response",
+                       session.device_id, method, task.id, task.task_type)
+        metrics.incr('cwmp_unexpected_responses')
+        task = None
+    if task is None or task.status != 'sent':
+        if ingest is not None:
+            # Streamed chunks are already committed; store the rest
+            await ingest.finish()
+            await _commit_with_ingest(db, ingest)
+        return
+    task_retries.answered(task.id)
+    if cwmp_id and cwmp_id != session.task_cwmp_id:
+        logger.warning("Device %s answered cwmp:ID %s, expected %s",
+                       session.device_id, cwmp_id, session.task_cwmp_id)
+    
+    # Keep the stored parameters in step with what the device reported or accepted
+    if method == 'GetParameterValuesResponse':
+        if ingest is None:
+            # Values parsed in full (tree parser): ingest them in the same chunks
+            device = await device_cache.get(db, session.device_id)
+            if device is not None:
+                ingest = ParameterIngest(db, device)
+                types = params.get('types', {})
+                await ingest.add([(name, value, types.get(name)) for name, value in params['parameters'].items()])
+        if ingest is not None:
+            # A summary, not the values: a full-tree response can hold tens of thousands
+            task.status = 'completed'
+            task.completed_at = datetime.utcnow()
+            task.result = {'method': method, **await ingest.finish()}
+            await _commit_with_ingest(db, ingest)
+            return
+    
+    task.status = 'failed' if method == 'Fault' else 'completed'
+    task.completed_at = datetime.utcnow()
+    task.result = {'method': method, **params}
+    values = task.parameters.get('values', {}) if method == 'SetParameterValuesResponse' else {}
+    await _commit_with_parameters(db, session.device_id, values, task.parameters.get('types'))
+
+
+async def _read_request(request: Request, db: AsyncSession) -> Tuple[Optional[dict], Optional[ParameterIngest]]:
+    """Parse a POST as its body arrives; returns (None, None) for an empty POST
+    
+    GetParameterValuesResponse values are upserted in chunks while the body streams in,
+    through the returned ParameterIngest, so a full-tree response never sits in memory.
+    """
+    if cwmp_server.parser != 'stream':
+        body = await request.body()
+        return (cwmp_server.parse_soap_request(body) if body.strip() else None), None
+    
+    parser = cwmp_server.create_stream_parser(stream_values=True)
+    ingest = None
+    session = None
+    empty = True
+    async for chunk in request.stream():
+        if empty and chunk.strip():
+            empty = False
+        parser.feed(chunk)
+        if not parser.values:
+            continue
+        if session is None:
+            session = session_manager.peek(request)
+            device = await device_cache.get(db, session.device_id) if session and session.task_id else None
+            ingest = ParameterIngest(db, device) if device is not None else None
+        values, parser.values = parser.values, []
+        if ingest is not None:
+            await ingest.add(values)
+            session_manager.touch(session)
+    return (parser.close() if not empty else None), ingest
+
+
+async def _next_task_response(db: AsyncSession, session: CWMPSession) -> Optional[Response]:
+    """Send the device's next pending task, or None once its queue is empty"""
+    while True:
+        # Claimed (marked sent) atomically: no other session or worker sends it too
+        task = await claim_next_task(db, session.device_id)
+        if task is None:
+            return None
+        cwmp_id = str(uuid.uuid4())
+        # The CPE must not interleave its own requests while more tasks are queued behind this one
+        hold_requests = settings.CWMP_HOLD_REQUESTS and bool(await _pending_tasks(db, session.device_id, 1))
+        response_xml = _create_task_rpc(task, cwmp_id, hold_requests)
+        if response_xml is None:
+            task.status = 'failed'
+            task.completed_at = datetime.utcnow()
+            task.result = {'error': f'Unknown task type: {task.task_type}'}
+            await db.commit()
+            continue
+        
+        # Unanswered, it is requeued after TASK_RESPONSE_TIMEOUT
+        task_retries.sent(task.id, task.sent_at, task.retries or 0)
+        session.task_id = task.id
+        session.task_cwmp_id = cwmp_id
+        return _soap_response(response_xml)
+
+
 @app.post("/cwmp")
-async def cwmp_endpoint(request: Request, db: Session = Depends(get_db)):
+async def cwmp_endpoint(request: Request, db: AsyncSession = Depends(get_async_db)):
     """
     Main CWMP endpoint for TR-069 communication with CPE devices
+    
+    A session starts with an Inform and continues over follow-up POSTs, tracked by
+    a cookie: the CPE's own requests are answered first, then every pending task is
+    sent one RPC at a time until the queue is empty and the session ends with an
+    empty HTTP response. One envelope is sent per HTTP response, which satisfies any
+    MaxEnvelopes the CPE announces.
+    
+    Requests pass admission control first (admission.py): a new session the worker has
+    no room for, or an Inform its device repeats while the last one is in hand or too
+    often, gets 503 with Retry-After before it reaches the database.
     """
-    # Get request body
-    body = await request.body()
-    xml_data = body.decode('utf-8')
+    if not settings.ADMISSION_CONTROL:
+        return await _handle_cwmp(request, db)
     
-    # Parse CWMP request
-    parsed = cwmp_server.parse_soap_request(xml_data)
+    new_session = session_manager.peek(request) is None
+    try:
+        if new_session:
+            admission.check_session(len(session_manager))
+        await admission.acquire(new_session)
+    except Overloaded as e:
+        return _overloaded_response(e)
+    try:
+        return await _handle_cwmp(request, db)
+    except Overloaded as e:
+        return _overloaded_response(e)
+    finally:
+        admission.release(getattr(request.state, 'inform_device', None))
+
+
+async def _handle_cwmp(request: Request, db: AsyncSession) -> Response:
+    """One POST of a CWMP session"""
+    # Parse the request body as bytes so the XML declaration's encoding is honored
+    parsed, ingest = await _read_request(request, db)
     
-    if 'error' in parsed:
+    if parsed is not None and 'error' in parsed:
+        # Full chunks of a streamed GetParameterValuesResponse were committed as they arrived
+        # and stay written, with their value hashes; only the partial chunk in memory is lost.
+        # The task stays sent and is requeued after TASK_RESPONSE_TIMEOUT.
         return Response(
             content=cwmp_server.create_empty_response(),
             media_type="text/xml",
             status_code=400
         )
     
+    # An empty POST (parsed is None) means the CPE has no more requests of its own
+    parsed = parsed or {}
     method = parsed.get('method')
     params = parsed.get('params', {})
     
-    response_xml = None
-    
     # Handle Inform message
     if method == 'Inform':
         device_info = params.get('device_id', {})
         device_id = f"{device_info.get('oui', '')}-{device_info.get('product_class', '')}-{device_info.get('serial_number', '')}"
+        if settings.ADMISSION_CONTROL:
+            # A retransmit storm from one CPE stops here, before any write
+            admission.check_device(device_id)
+            request.state.inform_device = device_id
         
         # Update or create device
-        device = db.query(Device).filter(Device.id == device_id).first()
+        now = datetime.utcnow()
+        created = False
+        heartbeat = None
+        device = await device_cache.get(db, device_id)
         if not device:
             device = Device(
                 id=device_id,
@@ -74,17 +355,28 @@ async def cwmp_endpoint(request: Request, db: Session = Depends(get_db)):
                 oui=device_info.get('oui', ''),
                 product_class=device_info.get('product_class', ''),
                 serial_number=device_info.get('serial_number', ''),
-                first_seen=datetime.utcnow()
+                first_seen=now,
+                last_inform=now,
+                online=True,
+                ip_address=request.client.host
             )
             db.add(device)
+            try:
+                await db.flush()
+                created = True
+            except IntegrityError:
+                # A concurrent Inform from the same CPE created it first
+                await db.rollback()
+                device = await db.get(Device, device_id)
         
-        # Update device status
-        device.last_inform = datetime.utcnow()
-        device.online = True
-        device.ip_address = request.client.host
+        # Update device status through the write-behind buffer (a new row already has it)
+        if not created:
+            before = (device.product_class, device.software_version, liveness_buffer.view(device)['online'])
+            heartbeat = liveness_buffer.record(device_id, request.client.host, now)
         
-        # Update parameters from Inform
-        for param_name, param_value in params.get('parameters', {}).items():
+        # Update device fields derived from Inform parameters
+        inform_params = params.get('parameters', {})
+        for param_name, param_value in inform_params.items():
             # Store important parameters
             if 'SoftwareVersion' in param_name:
                 device.software_version = param_value
@@ -92,130 +384,240 @@ async def cwmp_endpoint(request: Request, db: Session = Depends(get_db)):
                 device.hardware_version = param_value
             elif 'ConnectionRequestURL' in param_name:
                 device.connection_request_url = param_value
-            
-            # Store all parameters
-            param = db.query(Parameter).filter(
-                Parameter.device_id == device_id,
-                Parameter.name == param_name
-            ).first()
-            
-            if param:
-                param.value = param_value
-                param.last_updated = datetime.utcnow()
-            else:
-                param = Parameter(
-                    device_id=device_id,
-                    name=param_name,
-                    value=param_value,
-                    last_updated=datetime.utcnow()
-                )
-                db.add(param)
         
-        db.commit()
+        # Store the parameters whose value changed, in one bulk upsert
+        inform_types = params.get('types', {})
+        changed, fingerprints = await parameter_fingerprints.diff(db, device_id, inform_params, inform_types)
+        if changed:
+            await upsert_parameters_async(db, device_id, changed, types=inform_types)
         
-        # Check for pending tasks
-        pending_task = db.query(Task).filter(
-            Task.device_id == device_id,
-            Task.status == 'pending'
-        ).first()
-        
-        if pending_task:
-            # Send the task
-            if pending_task.task_type == 'get_params':
-                param_names = pending_task.parameters.get('names', [])
-                response_xml = cwmp_server.create_get_parameter_values(param_names)
-            elif pending_task.task_type == 'set_params':
-                params_to_set = pending_task.parameters.get('values', {})
-                response_xml = cwmp_server.create_set_parameter_values(params_to_set)
-            elif pending_task.task_type == 'reboot':
-                response_xml = cwmp_server.create_reboot()
-            elif pending_task.task_type == 'factory_reset':
-                response_xml = cwmp_server.create_factory_reset()
-            
-            # Mark task as sent
-            pending_task.status = 'sent'
-            db.commit()
+        if created or db.is_modified(device):
+            await device_cache.publish(db, [device_id])
+        await db.commit()
+        parameter_fingerprints.remember(device_id, fingerprints)
+        device_cache.put(device, created=created)
+        if heartbeat:
+            # The row still holds the previous heartbeat until the buffer flushes
+            device_cache.patch(device_id, heartbeat)
+        if created:
+            fleet_counters.device_added(device.product_class, device.software_version)
         else:
-            # No tasks, send InformResponse
-            response_xml = cwmp_server.create_inform_response()
+            fleet_counters.device_changed(before, (device.product_class, device.software_version, True))
+        offline_sweeper.touch(device_id, now)
+        
+        session = session_manager.create(request, device_id, params.get('events', []),
+                                         params.get('max_envelopes'))
+        
+        # Tasks follow once the CPE is done with its own requests (an empty POST)
+        hold_requests = settings.CWMP_HOLD_REQUESTS and bool(await _pending_tasks(db, device_id, 1))
+        response = _soap_response(cwmp_server.create_inform_response(parsed.get('cwmp_id'), hold_requests))
+        response.set_cookie(SESSION_COOKIE, session.id, httponly=True)
+        return response
     
-    # Handle other responses
-    elif method == 'GetParameterValuesResponse':
-        # Store the parameter values
-        # (Would need to parse and store)
-        response_xml = cwmp_server.create_empty_response()
+    session = session_manager.get(request)
+    if session is None:
+        # Nothing to continue: an empty response tells the CPE to close the session
+        return Response(status_code=204)
     
-    elif method == 'SetParameterValuesResponse':
-        # Task completed
-        response_xml = cwmp_server.create_empty_response()
+    if method in CPE_REQUESTS:
+        return _soap_response(CPE_REQUESTS[method](parsed.get('cwmp_id')))
     
+    if method is None:
+        session.cpe_done = True
+    elif method == 'Fault' or method.endswith('Response'):
+        # Response (or Fault) to the RPC sent for the current task
+        await _finish_task(db, session, method, params, parsed.get('cwmp_id'), ingest)
     else:
-        # Default: empty response
-        response_xml = cwmp_server.create_empty_response()
+        # A CPE request the ACS does not support (Kicked, RequestDownload, ...)
+        metrics.incr('cwmp_unsupported_requests')
+        return _fault_response(cwmp_server.create_fault(METHOD_NOT_SUPPORTED, 'Method not supported',
+                                                        parsed.get('cwmp_id')))
     
-    return Response(
-        content=response_xml,
-        media_type="text/xml",
-        headers={"SOAPAction": ""}
-    )
+    if not session.cpe_done:
+        # The ACS sends no RPC of its own before the CPE's empty POST
+        return Response(status_code=204)
+    
+    response = await _next_task_response(db, session)
+    if response is not None:
+        return response
+    
+    # Queue drained, and the CPE has nothing left either: an empty HTTP response ends the session
+    response = Response(status_code=204)
+    session_manager.end(session)
+    response.delete_cookie(SESSION_COOKIE)
+    return response
 
 
 # ============================================================================
 # REST API for Management
 # ============================================================================
 
+# Fields of the device list, in response order
+DEVICE_LIST_FIELDS = ('id', 'manufacturer', 'oui', 'product_class', 'serial_number', 'ip_address', 'online',
+                      'last_inform', 'software_version', 'hardware_version', 'tags')
+
+
+def _encode_cursor(values: list) -> str:
+    """Opaque page cursor holding the sort key of the last row returned"""
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def _decode_cursor(cursor: str, size: int) -> list:
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except ValueError:
+        values = None
+    if not isinstance(values, list) or len(values) != size:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return values
+
+
+def _naive_utc(value: Optional[datetime]) -> Optional[datetime]:
+    """Timestamps are stored naive in UTC"""
+    if value is not None and value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
 @app.get("/api/devices")
-async def list_devices(db: Session = Depends(get_db)):
-    """List all devices"""
-    devices = db.query(Device).all()
-    return [{
-        'id': d.id,
-        'manufacturer': d.manufacturer,
-        'oui': d.oui,
-        'product_class': d.product_class,
-        'serial_number': d.serial_number,
-        'ip_address': d.ip_address,
-        'online': d.online,
-        'last_inform': d.last_inform.isoformat() if d.last_inform else None,
-        'software_version': d.software_version,
-        'hardware_version': d.hardware_version,
-        'tags': d.tags or []
-    } for d in devices]
+async def list_devices(limit: int = Query(100, ge=1, le=1000), cursor: Optional[str] = None,
+                       online: Optional[bool] = None, product_class: Optional[str] = None,
+                       software_version: Optional[str] = None, tag: Optional[str] = None,
+                       last_inform_after: Optional[datetime] = None,
+                       last_inform_before: Optional[datetime] = None,
+                       fields: Optional[str] = None, db: AsyncSession = Depends(get_async_db)):
+    """List devices a page at a time, in id order (last_inform order when filtering on it)
+    
+    Pass next_cursor back as cursor for the following page. Each filter has an index ending
+    in the sort key, so a page reads only its own rows. fields=id,online,... limits the
+    columns read and returned; filters see liveness values as of the buffer's last flush.
+    """
+    selected = [field.strip() for field in fields.split(',') if field.strip()] if fields else DEVICE_LIST_FIELDS
+    unknown = [field for field in selected if field not in DEVICE_LIST_FIELDS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+    last_inform_after = _naive_utc(last_inform_after)
+    last_inform_before = _naive_utc(last_inform_before)
+    by_last_inform = last_inform_after is not None or last_inform_before is not None
+    keys = [Device.last_inform, Device.id] if by_last_inform else [Device.id]
+    # A tag page walks device_tags' (tag, device_id) key, which equals devices.id after the join
+    id_key = DeviceTag.device_id if tag is not None else Device.id
+    
+    columns = list(keys)
+    columns += [getattr(Device, field) for field in selected if getattr(Device, field) not in columns]
+    query = select(*columns)
+    if online is not None:
+        query = query.filter(Device.online == online)
+    if product_class is not None:
+        query = query.filter(Device.product_class == product_class)
+    if software_version is not None:
+        query = query.filter(Device.software_version == software_version)
+    if tag is not None:
+        query = query.join(DeviceTag, DeviceTag.device_id == Device.id).filter(DeviceTag.tag == tag)
+    if last_inform_after is not None:
+        query = query.filter(Device.last_inform >= last_inform_after)
+    if last_inform_before is not None:
+        query = query.filter(Device.last_inform < last_inform_before)
+    if cursor:
+        after = _decode_cursor(cursor, len(keys))
+        if by_last_inform:
+            try:
+                after[0] = datetime.fromisoformat(after[0])
+            except (TypeError, ValueError):
+                raise HTTPException(status_code=400, detail="Invalid cursor")
+            query = query.filter(tuple_(*keys) > tuple_(*after))
+        else:
+            query = query.filter(id_key > after[0])
+    order = keys if by_last_inform else [id_key]
+    rows = (await db.execute(query.order_by(*order).limit(limit))).all()
+    
+    devices = []
+    for row in rows:
+        live = liveness_buffer.get(row.id) or {}
+        device = {}
+        for field in selected:
+            value = live[field] if field in live and field != 'id' else getattr(row, field)
+            if field == 'last_inform':
+                value = value.isoformat() if value else None
+            elif field == 'tags':
+                value = value or []
+            device[field] = value
+        devices.append(device)
+    
+    next_cursor = None
+    if len(rows) == limit:
+        last = rows[-1]
+        next_cursor = _encode_cursor([last.last_inform.isoformat(), last.id] if by_last_inform else [last.id])
+    return {'devices': devices, 'next_cursor': next_cursor}
 
 
 @app.get("/api/devices/{device_id}")
-async def get_device(device_id: str, db: Session = Depends(get_db)):
+async def get_device(device_id: str, db: AsyncSession = Depends(get_async_db)):
     """Get device details"""
-    device = db.query(Device).filter(Device.id == device_id).first()
+    device = await device_cache.get(db, device_id)
     if not device:
         raise HTTPException(status_code=404, detail="Device not found")
     
+    live = liveness_buffer.view(device)
     return {
         'id': device.id,
         'manufacturer': device.manufacturer,
         'oui': device.oui,
         'product_class': device.product_class,
         'serial_number': device.serial_number,
-        'ip_address': device.ip_address,
-        'online': device.online,
-        'last_inform': device.last_inform.isoformat() if device.last_inform else None,
+        'ip_address': live['ip_address'],
+        'online': live['online'],
+        'last_inform': live['last_inform'].isoformat() if live['last_inform'] else None,
         'first_seen': device.first_seen.isoformat() if device.first_seen else None,
         'software_version': device.software_version,
         'hardware_version': device.hardware_version,
         'connection_request_url': device.connection_request_url,
         'tags': device.tags or [],
-        'metadata': device.metadata or {}
+        'metadata': device.metadata_ or {}
     }
 
 
+@app.put("/api/devices/{device_id}/tags")
+async def set_device_tags(device_id: str, tags: List[str], db: AsyncSession = Depends(get_async_db)):
+    """Replace a device's tags"""
+    device = await device_cache.get(db, device_id)
+    if not device:
+        raise HTTPException(status_code=404, detail="Device not found")
+    
+    tags = sorted(set(tags))
+    device.tags = tags
+    # device_tags mirrors the list for the device list's tag filter
+    await db.execute(delete(DeviceTag).filter(DeviceTag.device_id == device_id))
+    if tags:
+        await db.execute(insert(DeviceTag), [{'tag': tag, 'device_id': device_id} for tag in tags])
+    await device_cache.publish(db, [device_id])
+    await db.commit()
+    device_cache.put(device)
+    return {'id': device_id, 'tags': tags}
+
+
 @app.get("/api/devices/{device_id}/parameters")
-async def get_device_parameters(device_id: str, db: Session = Depends(get_db)):
-    """Get all parameters for a device"""
-    device = db.query(Device).filter(Device.id == device_id).first()
+async def get_device_parameters(device_id: str, prefix: Optional[str] = None,
+                                depth: Optional[int] = Query(None, ge=1),
+                                db: AsyncSession = Depends(get_async_db)):
+    """Get a device's parameters, or only the subtree under a partial path, at most depth levels deep
+    
+    e.g. ?prefix=InternetGatewayDevice.LANDevice.1.&depth=2; the prefix is a range scan of the
+    parameter_names index, so only the subtree's rows are read.
+    """
+    device = await device_cache.get(db, device_id)
     if not device:
         raise HTTPException(status_code=404, detail="Device not found")
     
-    parameters = db.query(Parameter).filter(Parameter.device_id == device_id).all()
+    query = select(
+        ParameterName.name, Parameter.value, Parameter.type, Parameter.writable, Parameter.last_updated
+    ).join(ParameterName, ParameterName.id == Parameter.name_id).filter(Parameter.device_id == device_id)
+    if prefix:
+        low, high = prefix_range(prefix)
+        query = query.filter(ParameterName.name >= low, ParameterName.name < high)
+    if depth is not None:
+        query = query.filter(ParameterName.depth <= (path_depth(prefix) if prefix else 0) + depth)
+    parameters = await db.execute(query.order_by(ParameterName.name))
     return [{
         'name': p.name,
         'value': p.value,
@@ -225,10 +627,79 @@ async def get_device_parameters(device_id: str, db: Session = Depends(get_db)):
     } for p in parameters]
 
 
+# Comparison operators of the fleet-wide parameter query
+COMPARISONS = {
+    'eq': operator.eq,
+    'ne': operator.ne,
+    'lt': operator.lt,
+    'le': operator.le,
+    'gt': operator.gt,
+    'ge': operator.ge,
+}
+
+
+def _typed_operand(value: str, value_type: Optional[str]) -> Tuple[List[str], object]:
+    """Shadow columns to compare against and the converted operand, from an explicit or inferred type"""
+    if value_type:
+        column = TYPE_COLUMNS.get(type_name(value_type))
+        if column is None:
+            raise ValueError(f"type {value_type} has no typed column")
+        return [column], convert(value, column)
+    if value.strip().lower() in ('true', 'false'):
+        return ['value_bool'], convert(value, 'value_bool')
+    for column in ('value_int', 'value_float'):
+        try:
+            # Numbers match integer and floating point parameters alike
+            return ['value_int', 'value_float'], convert(value, column)
+        except ValueError:
+            pass
+    try:
+        return ['value_time'], convert(value, 'value_time')
+    except ValueError:
+        raise ValueError("value must be a number, boolean or dateTime; pass type= to choose one")
+
+
+@app.get("/api/parameters")
+async def query_parameters(name: str, value: str, op: str = 'eq',
+                           value_type: Optional[str] = Query(None, alias='type'),
+                           limit: int = 1000, db: AsyncSession = Depends(get_async_db)):
+    """Find devices by comparing one parameter, e.g. ?name=Device.DeviceInfo.UpTime&op=lt&value=3600
+    
+    Compares the typed shadow columns, so the (name, value_*) indexes serve the filter.
+    """
+    compare = COMPARISONS.get(op)
+    if compare is None:
+        raise HTTPException(status_code=400, detail=f"op must be one of {', '.join(COMPARISONS)}")
+    try:
+        columns, operand = _typed_operand(value, value_type)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    name_id = (await db.run_sync(lambda session: parameter_names.ids(session, [name], create=False))).get(name)
+    if name_id is None:
+        return []
+    
+    # One indexable term per column, so the database can union the index scans
+    condition = or_(*[
+        and_(Parameter.name_id == name_id, compare(getattr(Parameter, column), operand))
+        for column in columns
+    ])
+    parameters = await db.execute(select(
+        Parameter.device_id, Parameter.value, Parameter.type, Parameter.last_updated
+    ).filter(condition).limit(max(min(limit, 10000), 1)))
+    return [{
+        'device_id': p.device_id,
+        'name': name,
+        'value': p.value,
+        'type': p.type,
+        'last_updated': p.last_updated.isoformat() if p.last_updated else None
+    } for p in parameters]
+
+
 @app.post("/api/devices/{device_id}/tasks")
-async def create_task(device_id: str, task: dict, db: Session = Depends(get_db)):
+async def create_task(device_id: str, task: dict, db: AsyncSession = Depends(get_async_db)):
     """Create a task for a device"""
-    device = db.query(Device).filter(Device.id == device_id).first()
+    device = await device_cache.get(db, device_id)
     if not device:
         raise HTTPException(status_code=404, detail="Device not found")
     
@@ -242,8 +713,10 @@ async def create_task(device_id: str, task: dict, db: Session = Depends(get_db))
         status='pending'
     )
     db.add(new_task)
-    db.commit()
-    db.refresh(new_task)
+    await db.commit()
+    fleet_counters.tasks_queued()
+    connection_requests.trigger(device)
+    await db.refresh(new_task)
     
     return {
         'id': new_task.id,
@@ -255,24 +728,28 @@ async def create_task(device_id: str, task: dict, db: Session = Depends(get_db))
 
 
 @app.get("/api/devices/{device_id}/tasks")
-async def get_device_tasks(device_id: str, db: Session = Depends(get_db)):
+async def get_device_tasks(device_id: str, db: AsyncSession = Depends(get_async_db)):
     """Get all tasks for a device"""
-    tasks = db.query(Task).filter(Task.device_id == device_id).order_by(Task.created_at.desc()).all()
+    tasks = await db.scalars(
+        select(Task).filter(Task.device_id == device_id).order_by(Task.created_at.desc())
+    )
     return [{
         'id': t.id,
         'task_type': t.task_type,
         'status': t.status,
         'created_at': t.created_at.isoformat(),
         'completed_at': t.completed_at.isoformat() if t.completed_at else None,
+        'retries': t.retries or 0,
+        'next_attempt_at': t.next_attempt_at.isoformat() if t.next_attempt_at else None,
         'parameters': t.parameters,
         'result': t.result
     } for t in tasks]
 
 
 @app.post("/api/devices/{device_id}/reboot")
-async def reboot_device(device_id: str, db: Session = Depends(get_db)):
+async def reboot_device(device_id: str, db: AsyncSession = Depends(get_async_db)):
     """Reboot a device"""
-    device = db.query(Device).filter(Device.id == device_id).first()
+    device = await device_cache.get(db, device_id)
     if not device:
         raise HTTPException(status_code=404, detail="Device not found")
     
@@ -283,15 +760,17 @@ async def reboot_device(device_id: str, db: Session = Depends(get_db)):
         status='pending'
     )
     db.add(task)
-    db.commit()
+    await db.commit()
+    fleet_counters.tasks_queued()
+    connection_requests.trigger(device)
     
     return {'message': 'Reboot task created', 'task_id': task.id}
 
 
 @app.post("/api/devices/{device_id}/factory-reset")
-async def factory_reset_device(device_id: str, db: Session = Depends(get_db)):
+async def factory_reset_device(device_id: str, db: AsyncSession = Depends(get_async_db)):
     """Factory reset a device"""
-    device = db.query(Device).filter(Device.id == device_id).first()
+    device = await device_cache.get(db, device_id)
     if not device:
         raise HTTPException(status_code=404, detail="Device not found")
     
@@ -302,23 +781,196 @@ async def factory_reset_device(device_id: str, db: Session = Depends(get_db)):
         status='pending'
     )
     db.add(task)
-    db.commit()
+    await db.commit()
+    fleet_counters.tasks_queued()
+    connection_requests.trigger(device)
     
     return {'message': 'Factory reset task created', 'task_id': task.id}
 
 
+@app.post("/api/tasks/bulk", status_code=202)
+async def create_bulk_tasks(request: dict, db: AsyncSession = Depends(get_async_db)):
+    """Queue a task on many devices, listed by id or matched by a filter
+    
+    Returns a job at once; the tasks are created in the background, a chunk per
+    multi-row INSERT, and GET /api/jobs/{job_id} reports the progress.
+    """
+    task_type = request.get('type')
+    if task_type not in TASK_TYPES:
+        raise HTTPException(status_code=400, detail=f"type must be one of: {', '.join(TASK_TYPES)}")
+    try:
+        target = parse_target(request)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    job = Job(
+        task_type=task_type,
+        parameters=request.get('parameters', {}),
+        target=target,
+        status='running'
+    )
+    db.add(job)
+    await db.commit()
+    bulk_tasks.submit(job.id, connection_request=bool(request.get('connection_request')))
+    
+    return job_summary(job)
+
+
+@app.get("/api/jobs/{job_id}")
+async def get_job(job_id: int, db: AsyncSession = Depends(get_async_db)):
+    """Get a bulk job: targeting counters and its tasks by status"""
+    job = await db.get(Job, job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    
+    rows = await db.execute(
+        select(Task.status, func.count()).filter(Task.job_id == job_id).group_by(Task.status)
+    )
+    return job_summary(job, {status: count for status, count in rows})
+
+
+@app.post("/api/jobs/{job_id}/cancel")
+async def cancel_job(job_id: int, db: AsyncSession = Depends(get_async_db)):
+    """Stop a running job and fail its tasks that were not sent yet"""
+    job = await db.get(Job, job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    
+    withdrawn = await bulk_tasks.cancel(job_id)
+    if withdrawn is None:
+        await db.refresh(job)
+        raise HTTPException(status_code=409, detail=f"Job is {job.status}")
+    return {'message': 'Job cancelled', 'tasks_withdrawn': withdrawn}
+
+
+@app.get("/api/inform-spreading")
+async def get_inform_spreading(interval: int = settings.DEFAULT_INFORM_INTERVAL,
+                               bucket: int = settings.INFORM_SPREAD_BUCKET,
+                               product_class: Optional[str] = None,
+                               software_version: Optional[str] = None,
+                               tag: Optional[str] = None,
+                               db: AsyncSession = Depends(get_async_db)):
+    """Histogram of the devices' last Informs over the interval, with peak and average rates
+    
+    peak_to_average is the busiest slot's Inform rate over the mean rate (1.0 when flat).
+    """
+    try:
+        check_slots(interval, bucket)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    device_filter = {key: value for key, value in (('product_class', product_class),
+                                                   ('software_version', software_version))
+                     if value is not None}
+    if tag is not None:
+        device_filter['tags'] = [tag]
+    counts = await inform_histogram(db, interval, bucket, device_filter)
+    return histogram_summary(counts, interval, bucket)
+
+
+@app.post("/api/inform-spreading")
+async def create_inform_spreading(request: dict, db: AsyncSession = Depends(get_async_db)):
+    """Even out the phase of periodic Informs over the interval
+    
+    Devices of crowded slots get a set_params task on PeriodicInformInterval and
+    PeriodicInformTime moving them to quiet ones, sent at their next Inform and tracked
+    as a job; returns the rates before and as projected once applied (dry_run only plans).
+    """
+    try:
+        spec = parse_spreading(request)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    return await spread_informs(db, spec['interval'], spec['bucket'], spec['filter'], spec['dry_run'])
+
+
+@app.post("/api/campaigns", status_code=201)
+async def create_campaign(request: dict, db: AsyncSession = Depends(get_async_db)):
+    """Start a staged rollout of a task over the devices matching a filter
+    
+    Tasks are released in waves, at most max_rate per second and max_in_flight
+    unfinished at once, inside the windows of each device group; see campaigns.py.
+    """
+    try:
+        spec = parse_campaign(request)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    campaign = await campaigns.create(db, spec)
+    return campaign_summary(campaign)
+
+
+@app.get("/api/campaigns")
+async def list_campaigns(db: AsyncSession = Depends(get_async_db)):
+    """List campaigns, newest first"""
+    rows = await db.scalars(select(Campaign).order_by(Campaign.id.desc()))
+    return [campaign_summary(campaign) for campaign in rows]
+
+
+@app.get("/api/campaigns/{campaign_id}")
+async def get_campaign(campaign_id: int, db: AsyncSession = Depends(get_async_db)):
+    """Get a campaign: its schedule, progress and tasks by status per wave"""
+    campaign = await db.get(Campaign, campaign_id)
+    if not campaign:
+        raise HTTPException(status_code=404, detail="Campaign not found")
+    return campaign_summary(campaign, await wave_counts(db, campaign))
+
+
+@app.post("/api/campaigns/{campaign_id}/{action}")
+async def control_campaign(campaign_id: int, action: str, db: AsyncSession = Depends(get_async_db)):
+    """Pause, resume or cancel a campaign
+    
+    Pausing stops releasing tasks (released ones stay queued); cancelling also fails
+    the tasks not sent yet.
+    """
+    if action not in ('pause', 'resume', 'cancel'):
+        raise HTTPException(status_code=404, detail="Unknown campaign action")
+    campaign = await db.get(Campaign, campaign_id)
+    if not campaign:
+        raise HTTPException(status_code=404, detail="Campaign not found")
+    
+    if action == 'cancel':
+        withdrawn = await campaigns.cancel(campaign_id)
+        done = withdrawn is not None
+    else:
+        done = await (campaigns.pause(campaign_id) if action == 'pause' else campaigns.resume(campaign_id))
+    if not done:
+        await db.refresh(campaign)
+        raise HTTPException(status_code=409, detail=f"Campaign is {campaign.status}")
+    
+    response = {'message': f"Campaign {'cancelled' if action == 'cancel' else action + 'd'}"}
+    if action == 'cancel':
+        response['tasks_withdrawn'] = withdrawn
+    return response
+
+
 @app.get("/api/stats")
-async def get_stats(db: Session = Depends(get_db)):
-    """Get system statistics"""
-    total_devices = db.query(Device).count()
-    online_devices = db.query(Device).filter(Device.online == True).count()
-    pending_tasks = db.query(Task).filter(Task.status == 'pending').count()
+async def get_stats():
+    """Get system statistics, with device counts per product class and software version
     
+    Served from the fleet counters, without a query; see fleet_counters.py for how
+    fresh they are.
+    """
+    return fleet_counters.stats()
+
+
+@app.get("/api/metrics")
+async def get_metrics():
+    """Get in-process counters"""
     return {
-        'total_devices': total_devices,
-        'online_devices': online_devices,
-        'offline_devices': total_devices - online_devices,
-        'pending_tasks': pending_tasks
+        **metrics.snapshot(),
+        'fingerprint_cache_devices': len(parameter_fingerprints),
+        'liveness_buffered_devices': len(liveness_buffer),
+        'device_cache_devices': len(device_cache),
+        'offline_sweeper_devices': len(offline_sweeper),
+        'connection_requests_pending': len(connection_requests),
+        'tasks_awaiting_response': len(task_retries),
+        'bulk_jobs_running': len(bulk_tasks),
+        'campaigns_releasing': len(campaigns),
+        'cwmp_sessions_live': len(session_manager),
+        'admission_in_flight': admission.in_flight,
+        'admission_queue_depth': admission.queue_depth,
+        'admission_devices_tracked': len(admission)
     }
 
 
@@ -398,6 +1050,18 @@ async def root():
                 box-shadow: 0 2px 8px rgba(0,0,0,0.08);
                 margin-bottom: 2rem;
             }
+            .pager {
+                display: flex;
+                align-items: center;
+                justify-content: flex-end;
+                gap: 1rem;
+                margin-top: 1rem;
+                color: #666;
+            }
+            .pager .btn:disabled {
+                opacity: 0.5;
+                cursor: default;
+            }
             .section h2 {
                 margin-bottom: 1.5rem;
                 color: #333;
@@ -512,11 +1176,21 @@ async def root():
             <div class="section">
                 <h2>Devices</h2>
                 <div id="devicesTable" class="loading">Loading devices...</div>
+                <div class="pager">
+                    <button class="btn btn-primary" id="prevPage" onclick="changePage(-1)" disabled>Previous</button>
+                    <span id="pageNumber">Page 1</span>
+                    <button class="btn btn-primary" id="nextPage" onclick="changePage(1)" disabled>Next</button>
+                </div>
             </div>
         </div>
         
         <script>
+            const PAGE_SIZE = 50;
+            // Only the columns the table shows
+            const DEVICE_FIELDS = 'id,manufacturer,product_class,serial_number,ip_address,software_version,online,last_inform';
             let devices = [];
+            let cursors = [null];  // cursor of every page visited so far; the last one is the current page
+            let nextCursor = null;
             
             async function loadStats() {
                 try {
@@ -533,20 +1207,39 @@ async def root():
             
             async function loadDevices() {
                 try {
-                    const response = await fetch('/api/devices');
-                    devices = await response.json();
+                    const params = new URLSearchParams({limit: PAGE_SIZE, fields: DEVICE_FIELDS});
+                    const cursor = cursors[cursors.length - 1];
+                    if (cursor) params.set('cursor', cursor);
+                    const response = await fetch('/api/devices?' + params);
+                    const page = await response.json();
+                    devices = page.devices;
+                    nextCursor = page.next_cursor;
                     renderDevices();
+                    document.getElementById('pageNumber').textContent = 'Page ' + cursors.length;
+                    document.getElementById('prevPage').disabled = cursors.length === 1;
+                    document.getElementById('nextPage').disabled = !nextCursor;
                 } catch (error) {
                     document.getElementById('devicesTable').innerHTML = 
                         '<p style="color: #dc3545;">Error loading devices</p>';
                 }
             }
             
+            function changePage(step) {
+                if (step > 0 && nextCursor) {
+                    cursors.push(nextCursor);
+                } else if (step < 0 && cursors.length > 1) {
+                    cursors.pop();
+                }
+                loadDevices();
+            }
+            
             function renderDevices() {
                 const container = document.getElementById('devicesTable');
                 
                 if (devices.length === 0) {
-                    container.innerHTML = '<p style="color: #666;">No devices registered yet. Connect a TR-069 device to get started.</p>';
+                    container.innerHTML = cursors.length > 1
+                        ? '<p style="color: #666;">No more devices.</p>'
+                        : '<p style="color: #666;">No devices registered yet. Connect a TR-069 device to get started.</p>';
                     return;
                 }
                 
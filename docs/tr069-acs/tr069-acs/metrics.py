@@ -0,0 +1,33 @@
+"""
+Metrics
+In-process counters exposed through /api/metrics
+"""
+from collections import Counter
+from typing import Dict
+
+
+class Metrics:
+    """Monotonic counters, per worker process"""
+
+    def __init__(self):
+        self._counters = Counter()
+
+    def incr(self, name: str, amount: int = 1) -> None:
+        """Add to a counter"""
+        self._counters[name] += amount
+
+    def get(self, name: str) -> int:
+        """Current value of a counter"""
+        return self._counters[name]
+
+    def snapshot(self) -> Dict[str, int]:
+        """All counters"""
+        return dict(sorted(self._counters.items()))
+
+    def reset(self) -> None:
+        """Zero every counter"""
+        self._counters.clear()
+
+
+# Global metrics instance
+metrics = Metrics()
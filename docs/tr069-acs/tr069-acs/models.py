@@ -1,10 +1,16 @@
 """
 Database models for TR-069 ACS
 """
-from sqlalchemy import create_engine, Column, String, DateTime, Integer, Text, Boolean, JSON
+from sqlalchemy import create_engine, event, text, Column, String, DateTime, Integer, BigInteger, Float, Text, Boolean, JSON, Index
+from sqlalchemy.engine import Engine, URL, make_url
+from sqlalchemy.ext.asyncio import AsyncEngine, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from sqlalchemy.orm import sessionmaker
 from datetime import datetime
+from typing import Optional
+
+from config import settings
 
 Base = declarative_base()
 
@@ -12,6 +18,13 @@ Base = declarative_base()
 class Device(Base):
     """Device (CPE) model"""
     __tablename__ = 'devices'
+    __table_args__ = (
+        # Filters of the paginated device list; each ends in id, the keyset order
+        Index('ix_devices_online_id', 'online', 'id'),
+        Index('ix_devices_product_class_id', 'product_class', 'id'),
+        Index('ix_devices_software_version_id', 'software_version', 'id'),
+        Index('ix_devices_last_inform_id', 'last_inform', 'id'),
+    )
     
     id = Column(String(100), primary_key=True)  # Composite: OUI-ProductClass-SerialNumber
     manufacturer = Column(String(100))
@@ -37,19 +50,52 @@ class Device(Base):
     # Tags for organization
     tags = Column(JSON, default=list)
     
-    # Custom metadata
-    metadata = Column(JSON, default=dict)
+    # Custom metadata ('metadata' is reserved by the declarative base)
+    metadata_ = Column('metadata', JSON, default=dict)
+
+
+class DeviceTag(Base):
+    """Devices.tags, one row per (tag, device) so the device list can filter on a tag by index"""
+    __tablename__ = 'device_tags'
+    
+    tag = Column(String(100), primary_key=True)
+    device_id = Column(String(100), primary_key=True)
+
+
+class ParameterName(Base):
+    """Interned parameter paths, stored once however many devices report them"""
+    __tablename__ = 'parameter_names'
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    # Byte-order collation on PostgreSQL too, so the unique index serves dotted-path prefix ranges
+    name = Column(String(500).with_variant(String(500, collation='C'), 'postgresql'), unique=True, nullable=False)
+    depth = Column(Integer)  # path segments, e.g. 3 for Device.DeviceInfo.UpTime
 
 
 class Parameter(Base):
     """Device parameter/data model"""
     __tablename__ = 'parameters'
+    __table_args__ = (
+        # One row per device parameter; the upsert conflict target and the per-device lookup index
+        Index('ix_parameters_device_id_name_id', 'device_id', 'name_id', unique=True),
+        # Fleet-wide comparisons on one parameter (e.g. Uptime < 3600); partial, so untyped rows cost nothing
+        *[Index(f'ix_parameters_name_id_{column}', 'name_id', column,
+                sqlite_where=text(f'{column} IS NOT NULL'),
+                postgresql_where=text(f'{column} IS NOT NULL'))
+          for column in ('value_int', 'value_float', 'value_bool', 'value_time')],
+    )
     
     id = Column(Integer, primary_key=True, autoincrement=True)
-    device_id = Column(String(100), index=True)
-    name = Column(String(500))
+    device_id = Column(String(100))
+    name_id = Column(Integer, nullable=False)  # parameter_names.id, see parameter_names.py
     value = Column(Text)
     type = Column(String(50))
+    # Typed shadows of value, filled from type (see parameter_types); at most one is set
+    value_int = Column(BigInteger)
+    value_float = Column(Float)
+    value_bool = Column(Boolean)
+    value_time = Column(DateTime)
+    value_hash = Column(BigInteger)  # hash of value and reported type, see fingerprints.py
     writable = Column(Boolean, default=False)
     last_updated = Column(DateTime, default=datetime.utcnow)
 
@@ -57,15 +103,85 @@ class Parameter(Base):
 class Task(Base):
     """Pending tasks/commands for devices"""
     __tablename__ = 'tasks'
+    __table_args__ = (
+        # A device's pending tasks in queue order, without reading its finished ones
+        Index('ix_tasks_device_id_status_id', 'device_id', 'status', 'id'),
+        # Progress of a bulk job by task status
+        Index('ix_tasks_job_id_status', 'job_id', 'status'),
+    )
     
     id = Column(Integer, primary_key=True, autoincrement=True)
-    device_id = Column(String(100), index=True)
+    device_id = Column(String(100))
     task_type = Column(String(50))  # get_params, set_params, reboot, factory_reset, etc.
     parameters = Column(JSON)  # Task-specific parameters
     status = Column(String(20), default='pending')  # pending, sent, completed, failed
     created_at = Column(DateTime, default=datetime.utcnow)
     completed_at = Column(DateTime, nullable=True)
     result = Column(JSON, nullable=True)
+    
+    # Retries after the CPE left the task unanswered (see task_retries.py)
+    retries = Column(Integer, default=0)
+    sent_at = Column(DateTime, nullable=True)
+    next_attempt_at = Column(DateTime, nullable=True)  # not sent again before this
+    
+    job_id = Column(Integer, nullable=True)  # bulk job that created the task
+
+
+class Job(Base):
+    """Bulk task creation over a device list or filter (see bulk_tasks.py)"""
+    __tablename__ = 'jobs'
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    task_type = Column(String(50))
+    parameters = Column(JSON)
+    target = Column(JSON)  # {'device_ids': [...]}, {'filter': {...}} or {'inform_spreading': {...}}
+    status = Column(String(20), default='running')  # running, completed, failed, cancelled
+    devices_matched = Column(Integer, default=0)
+    devices_missing = Column(Integer, default=0)  # listed ids with no device
+    tasks_created = Column(Integer, default=0)
+    cursor = Column(String(100), nullable=True)  # last device id (or list position) done
+    error = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    completed_at = Column(DateTime, nullable=True)
+
+
+class Campaign(Base):
+    """Staged rollout of a task over a device filter, a job per wave (see campaigns.py)"""
+    __tablename__ = 'campaigns'
+    
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    name = Column(String(200))
+    task_type = Column(String(50))
+    parameters = Column(JSON)
+    target = Column(JSON)  # {'filter': {...}}
+    status = Column(String(20), default='running')  # running, paused, completed, cancelled
+    pause_reason = Column(Text, nullable=True)
+    
+    # Schedule
+    waves = Column(JSON)  # cumulative task counts, resolved from counts and percentages
+    windows = Column(JSON)  # [{'group': {...}, 'start': 'HH:MM', 'end': 'HH:MM', 'timezone': ...}]
+    max_rate = Column(Float)  # tasks released per second
+    max_in_flight = Column(Integer)  # released tasks not finished yet
+    failure_threshold = Column(Float)  # pause when a wave's failed share exceeds this
+    failure_min_tasks = Column(Integer)  # finished tasks before a wave's failure rate counts
+    wave_timeout = Column(Integer)  # seconds before the next wave starts regardless
+    connection_request = Column(Boolean, default=False)
+    
+    # Progress
+    devices_targeted = Column(Integer, default=0)  # counted when the campaign was created
+    tasks_released = Column(Integer, default=0)
+    wave = Column(Integer, default=0)  # index of the current wave
+    wave_job_ids = Column(JSON)  # jobs.id of each wave started so far
+    wave_started_at = Column(DateTime, nullable=True)
+    cursors = Column(JSON)  # lane -> last device id released; null once the lane is done
+    failure_baseline = Column(JSON, nullable=True)  # current wave's counts when last resumed
+    
+    # The worker releasing its tasks
+    lease_owner = Column(String(50), nullable=True)
+    lease_expires_at = Column(DateTime, nullable=True)
+    
+    created_at = Column(DateTime, default=datetime.utcnow)
+    completed_at = Column(DateTime, nullable=True)
 
 
 class Session(Base):
@@ -81,9 +197,89 @@ class Session(Base):
 
 
 # Database setup
-engine = create_engine('sqlite:///tr069_acs.db', echo=False)
+
+# Async drivers used for each sync dialect when building the async engine
+ASYNC_DRIVERS = {
+    'sqlite': 'sqlite+aiosqlite',
+    'postgresql': 'postgresql+asyncpg',
+}
+
+
+def _engine_options(url: URL) -> dict:
+    """create_engine() keyword arguments tuned for the URL's dialect"""
+    pool_options = dict(
+        pool_size=settings.DB_POOL_SIZE,
+        max_overflow=settings.DB_MAX_OVERFLOW,
+        pool_timeout=settings.DB_POOL_TIMEOUT
+    )
+    
+    if url.get_backend_name() == 'sqlite':
+        in_memory = url.database in (None, '', ':memory:')
+        return dict(
+            echo=False,
+            # One file, many threads: let connections wait on locks instead of failing
+            connect_args={
+                'check_same_thread': False,
+                'timeout': settings.SQLITE_BUSY_TIMEOUT / 1000
+            },
+            **({} if in_memory else pool_options)
+        )
+    
+    return dict(
+        echo=False,
+        pool_recycle=settings.DB_POOL_RECYCLE,
+        pool_pre_ping=settings.DB_POOL_PRE_PING,
+        **pool_options
+    )
+
+
+def create_db_engine(database_url: Optional[str] = None) -> Engine:
+    """Create the engine for DATABASE_URL with per-dialect performance settings"""
+    url = make_url(database_url or settings.DATABASE_URL)
+    engine = create_engine(url, **_engine_options(url))
+    if url.get_backend_name() == 'sqlite':
+        event.listen(engine, 'connect', _set_sqlite_pragmas)
+    return engine
+
+
+def create_async_db_engine(database_url: Optional[str] = None) -> AsyncEngine:
+    """Create the asyncio engine (aiosqlite / asyncpg) for DATABASE_URL"""
+    url = make_url(database_url or settings.DATABASE_URL)
+    backend = url.get_backend_name()
+    options = _engine_options(url)
+    if backend in ASYNC_DRIVERS:
+        url = url.set(drivername=ASYNC_DRIVERS[backend])
+    if backend == 'sqlite':
+        # aiosqlite defaults to NullPool; keep connections so pragmas run once each
+        options['connect_args'].pop('check_same_thread')
+        if 'pool_size' in options:
+            options['poolclass'] = AsyncAdaptedQueuePool
+    
+    engine = create_async_engine(url, **options)
+    if backend == 'sqlite':
+        event.listen(engine.sync_engine, 'connect', _set_sqlite_pragmas)
+    return engine
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    """Apply WAL journaling and related tuning to every new SQLite connection"""
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute(f"PRAGMA journal_mode={settings.SQLITE_JOURNAL_MODE}")
+        cursor.execute(f"PRAGMA synchronous={settings.SQLITE_SYNCHRONOUS}")
+        cursor.execute(f"PRAGMA busy_timeout={int(settings.SQLITE_BUSY_TIMEOUT)}")
+        cursor.execute(f"PRAGMA mmap_size={int(settings.SQLITE_MMAP_SIZE)}")
+        cursor.execute(f"PRAGMA cache_size={int(settings.SQLITE_CACHE_SIZE)}")
+    finally:
+        cursor.close()
+
+
+engine = create_db_engine()
 SessionLocal = sessionmaker(bind=engine)
 
+async_engine = create_async_db_engine()
+AsyncSessionLocal = async_sessionmaker(bind=async_engine, expire_on_commit=False)
+
 
 def init_db():
     """Initialize database tables"""
@@ -97,3 +293,9 @@ def get_db():
         yield db
     finally:
         db.close()
+
+
+async def get_async_db():
+    """Get asyncio database session"""
+    async with AsyncSessionLocal() as db:
+        yield db
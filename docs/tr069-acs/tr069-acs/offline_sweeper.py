@@ -0,0 +1,211 @@
+"""
+Offline Sweeper
+Marks devices offline once DEVICE_OFFLINE_THRESHOLD passes without an Inform
+"""
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Set
+
+from sqlalchemy import or_, select, update
+
+from config import settings
+from device_cache import device_cache
+from fleet_counters import fleet_counters
+from liveness import liveness_buffer
+from metrics import metrics
+from models import AsyncSessionLocal, Device
+
+logger = logging.getLogger(__name__)
+
+EPOCH = datetime(1970, 1, 1)
+
+# Online devices read per round trip when the sweeper loads its deadlines
+LOAD_CHUNK_SIZE = 10000
+
+
+class OfflineSweeper:
+    """Hashed timer wheel of online devices' offline deadlines
+
+    Each device sits in the slot of last_inform + threshold, rounded up to the sweep
+    interval, so an Inform moves it between two sets in O(1) and a sweep only visits the
+    slots that expired. Expired devices are flipped in batched UPDATEs that re-check
+    last_inform, so a device another worker heard from stays online and is rescheduled.
+    """
+
+    def __init__(self, threshold: float = 600, interval: float = 10, batch_size: int = 500):
+        self.enabled = threshold > 0
+        self.threshold = timedelta(seconds=threshold)
+        self.interval = interval
+        self.batch_size = batch_size
+        self._slots: Dict[int, Set[str]] = {}  # slot -> device ids whose deadline falls in it
+        self._deadlines: Dict[str, int] = {}  # device id -> its slot
+        self._next_slot: Optional[int] = None  # earliest occupied slot
+        self._swept: Optional[int] = None  # last slot swept
+        self._task: Optional[asyncio.Task] = None
+
+    def touch(self, device_id: str, last_inform: Optional[datetime]) -> None:
+        """Schedule (or push back) a device's offline deadline after an Inform"""
+        if not self.enabled:
+            return
+        deadline = (last_inform or datetime.utcnow()) + self.threshold
+        slot = -int(-(deadline - EPOCH).total_seconds() // self.interval)  # rounded up
+        if self._swept is not None and slot <= self._swept:
+            # Already overdue: expire on the next sweep
+            slot = self._swept + 1
+        current = self._deadlines.get(device_id)
+        if current == slot:
+            return
+        if current is not None:
+            self._discard(device_id, current)
+        self._slots.setdefault(slot, set()).add(device_id)
+        self._deadlines[device_id] = slot
+        if self._next_slot is None or slot < self._next_slot:
+            self._next_slot = slot
+
+    def forget(self, device_id: str) -> None:
+        """Stop tracking a device"""
+        slot = self._deadlines.pop(device_id, None)
+        if slot is not None:
+            self._discard(device_id, slot)
+
+    def _discard(self, device_id: str, slot: int) -> None:
+        bucket = self._slots[slot]
+        bucket.discard(device_id)
+        if not bucket:
+            del self._slots[slot]
+
+    def expired(self, now: Optional[datetime] = None) -> List[str]:
+        """Remove and return the devices whose deadline has passed"""
+        now_slot = int((((now or datetime.utcnow()) - EPOCH).total_seconds()) // self.interval)
+        devices = []
+        # Deadlines are never earlier than the Inform that set them, so the slots walked here
+        # are the ones elapsed since the last sweep
+        while self._next_slot is not None and self._next_slot <= now_slot:
+            bucket = self._slots.pop(self._next_slot, None)
+            if bucket:
+                for device_id in bucket:
+                    del self._deadlines[device_id]
+                devices.extend(bucket)
+            self._next_slot = self._next_slot + 1 if self._slots else None
+        self._swept = max(now_slot, self._swept or now_slot)
+        return devices
+
+    async def sweep(self, now: Optional[datetime] = None) -> int:
+        """Mark the expired devices offline; returns how many were"""
+        now = now or datetime.utcnow()
+        devices = self.expired(now)
+        marked = 0
+        for start in range(0, len(devices), self.batch_size):
+            marked += await self._mark_offline(devices[start:start + self.batch_size], now)
+        metrics.incr('offline_sweeps')
+        return marked
+
+    async def _mark_offline(self, device_ids: List[str], now: datetime) -> int:
+        """One batch: a conditional UPDATE, then reschedule the devices it did not flip"""
+        candidates = []
+        for device_id in device_ids:
+            heartbeat = liveness_buffer.get(device_id)
+            if heartbeat is not None:
+                # Heard from after all; the buffer has not written it yet
+                self.touch(device_id, heartbeat['last_inform'])
+            else:
+                candidates.append(device_id)
+        if not candidates:
+            return 0
+
+        cutoff = now - self.threshold
+        async with AsyncSessionLocal() as db:
+            flipped = (await db.execute(
+                update(Device)
+                .where(
+                    Device.id.in_(candidates),
+                    Device.online == True,
+                    or_(Device.last_inform == None, Device.last_inform < cutoff)
+                )
+                .values(online=False)
+                .returning(Device.id, Device.product_class, Device.software_version)
+                .execution_options(synchronize_session=False)
+            )).all()
+            flipped_ids = {row.id for row in flipped}
+            # Still online with a newer last_inform: another worker took its Inform
+            rest = [device_id for device_id in candidates if device_id not in flipped_ids]
+            if rest:
+                rows = await db.execute(
+                    select(Device.id, Device.last_inform).filter(Device.id.in_(rest), Device.online == True)
+                )
+                for device_id, last_inform in rows:
+                    self.touch(device_id, last_inform)
+            if flipped_ids:
+                await device_cache.publish(db, flipped_ids)
+            await db.commit()
+
+        marked = 0
+        for row in flipped:
+            if liveness_buffer.get(row.id) is not None:
+                # An Inform arrived during the UPDATE; the buffer's flush sets it online again
+                continue
+            device_cache.patch(row.id, {'online': False})
+            fleet_counters.device_changed((row.product_class, row.software_version, True),
+                                          (row.product_class, row.software_version, False))
+            marked += 1
+        metrics.incr('devices_marked_offline', marked)
+        return marked
+
+    async def load(self) -> int:
+        """Schedule every device the database has online; returns how many"""
+        count = 0
+        # Overdue devices (or ones that never sent an Inform) go in the first slot swept
+        oldest = datetime.utcnow() - self.threshold
+        async with AsyncSessionLocal() as db:
+            result = await db.stream(
+                select(Device.id, Device.last_inform).filter(Device.online == True)
+                .execution_options(yield_per=LOAD_CHUNK_SIZE)
+            )
+            async for rows in result.partitions():
+                for device_id, last_inform in rows:
+                    # An Inform taken while loading already set a later deadline
+                    if device_id not in self._deadlines:
+                        self.touch(device_id, max(last_inform or oldest, oldest))
+                count += len(rows)
+        return count
+
+    async def _run(self) -> None:
+        """Load the online devices, then sweep every interval"""
+        while True:
+            try:
+                count = await self.load()
+                logger.info("Offline sweeper tracking %d online devices", count)
+                break
+            except Exception:
+                logger.exception("Loading online devices failed; retrying")
+                await asyncio.sleep(self.interval)
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.sweep()
+            except Exception:
+                logger.exception("Offline sweep failed; retrying on the next cycle")
+
+    async def start(self) -> None:
+        """Start sweeping; the online devices load in the background"""
+        if self.enabled and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stop sweeping"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def __len__(self) -> int:
+        return len(self._deadlines)
+
+
+# Global offline sweeper
+offline_sweeper = OfflineSweeper(settings.DEVICE_OFFLINE_THRESHOLD, settings.OFFLINE_SWEEP_INTERVAL,
+                                 settings.OFFLINE_SWEEP_BATCH_SIZE)
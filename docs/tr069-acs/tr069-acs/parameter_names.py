@@ -0,0 +1,100 @@
+"""
+Parameter Names
+Interning of parameter paths into the parameter_names table, with an in-process id cache
+"""
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Tuple
+
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+
+from config import settings
+from metrics import metrics
+from models import ParameterName
+
+DIALECT_INSERTS = {
+    'sqlite': sqlite.insert,
+    'postgresql': postgresql.insert,
+}
+
+
+class ParameterNameCache:
+    """LRU of name -> parameter_names.id
+
+    Only ids read back from the table are cached. Names this transaction inserted are
+    returned but cached once a later lookup finds them, so a rollback never leaves an
+    id pointing at a row that does not exist.
+    """
+
+    def __init__(self, max_size: int = 100000):
+        self.max_size = max_size
+        self._ids: OrderedDict = OrderedDict()
+
+    def ids(self, db: Session, names: Iterable[str], create: bool = True) -> Dict[str, int]:
+        """Ids of names, inserting the ones never seen before when create is set"""
+        found = {}
+        missing = []
+        for name in names:
+            name_id = self._ids.get(name)
+            if name_id is None:
+                missing.append(name)
+            else:
+                self._ids.move_to_end(name)
+                found[name] = name_id
+        metrics.incr('parameter_name_cache_hits', len(found))
+        if not missing:
+            return found
+
+        metrics.incr('parameter_name_cache_misses', len(missing))
+        stored = _select(db, missing)
+        self._store(stored)
+        found.update(stored)
+        if create and len(stored) < len(missing):
+            new = sorted(name for name in missing if name not in stored)
+            _insert(db, new)
+            created = _select(db, new)
+            metrics.incr('parameter_names_created', len(created))
+            found.update(created)
+        return found
+
+    def _store(self, ids: Dict[str, int]) -> None:
+        if self.max_size <= 0:
+            return
+        self._ids.update(ids)
+        while len(self._ids) > self.max_size:
+            self._ids.popitem(last=False)
+
+    def clear(self) -> None:
+        self._ids.clear()
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+
+def path_depth(name: str) -> int:
+    """Segments of a dotted path; a partial path's trailing '.' does not add one"""
+    return name.rstrip('.').count('.') + 1
+
+
+def prefix_range(prefix: str) -> Tuple[str, str]:
+    """[low, high) bounds of the names starting with prefix, in byte order"""
+    return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def _select(db: Session, names: List[str]) -> Dict[str, int]:
+    return dict(db.query(ParameterName.name, ParameterName.id).filter(ParameterName.name.in_(names)).all())
+
+
+def _insert(db: Session, names: List[str]) -> None:
+    """Insert names, skipping any another transaction added meanwhile"""
+    rows = [{'name': name, 'depth': path_depth(name)} for name in names]
+    dialect = db.get_bind().dialect.name
+    if dialect in DIALECT_INSERTS:
+        # Sorted names take the unique index's locks in the same order in every transaction
+        db.execute(DIALECT_INSERTS[dialect](ParameterName).on_conflict_do_nothing(index_elements=['name']), rows)
+    else:
+        db.bulk_insert_mappings(ParameterName, rows)
+
+
+# Global name cache
+parameter_names = ParameterNameCache(settings.PARAMETER_NAME_CACHE_SIZE)
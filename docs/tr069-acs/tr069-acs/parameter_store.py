@@ -0,0 +1,181 @@
+"""
+Parameter Store
+Bulk writes of CPE parameters into the parameters table
+"""
+from datetime import datetime
+from typing import Dict, Optional
+
+from sqlalchemy import func
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from config import settings
+from fingerprints import parameter_fingerprints, value_hash
+from models import Device, Parameter
+from parameter_names import DIALECT_INSERTS, parameter_names
+from parameter_types import SHADOW_COLUMNS, shadow_values
+
+# Compiled once per dialect and executed with the whole row list: SQLAlchemy caches the
+# compiled form and the driver batches the rows (sqlite3 executemany, psycopg2 execute_values)
+_upsert_statements = {}
+
+
+def _upsert_statement(dialect: str):
+    """INSERT ... ON CONFLICT (device_id, name_id) DO UPDATE for the given dialect"""
+    stmt = _upsert_statements.get(dialect)
+    if stmt is None:
+        insert = DIALECT_INSERTS[dialect](Parameter)
+        stmt = insert.on_conflict_do_update(
+            index_elements=['device_id', 'name_id'],
+            set_={
+                'value': insert.excluded.value,
+                # A CPE that omits xsi:type keeps the type it reported earlier
+                'type': func.coalesce(insert.excluded.type, Parameter.type),
+                **{column: insert.excluded[column] for column in SHADOW_COLUMNS},
+                'value_hash': insert.excluded.value_hash,
+                'last_updated': insert.excluded.last_updated
+            }
+        # The ORM batches consecutive rows with the same non-NULL keys; rows of mixed
+        # types leave different shadow columns NULL, so send the NULLs to keep one batch
+        ).execution_options(render_nulls=True)
+        _upsert_statements[dialect] = stmt
+    return stmt
+
+
+def upsert_parameters(db: Session, device_id: str, parameters: Dict[str, str],
+                      updated_at: Optional[datetime] = None,
+                      types: Optional[Dict[str, str]] = None) -> int:
+    """Insert or update a device's parameters in a single upsert statement, interning new names first
+
+    Each row stores the hash of its value and reported type, which later reports are diffed against.
+    """
+    if not parameters:
+        return 0
+
+    updated_at = updated_at or datetime.utcnow()
+    name_ids = parameter_names.ids(db, parameters)
+    types = types or {}
+    hashes = {name: value_hash(value, types.get(name)) for name, value in parameters.items()}
+    untyped = [name_ids[name] for name in parameters if name not in types]
+    if untyped:
+        # Fill the typed columns of values reported without xsi:type from the stored type
+        stored = _stored_types(db, device_id, untyped)
+        types = dict(types)
+        types.update((name, stored[name_ids[name]]) for name in parameters if name_ids[name] in stored)
+    rows = [{
+        'device_id': device_id,
+        'name_id': name_ids[name],
+        'value': value,
+        'type': types.get(name),
+        **shadow_values(value, types.get(name)),
+        'value_hash': hashes[name],
+        'last_updated': updated_at
+    } for name, value in parameters.items()]
+
+    dialect = db.get_bind().dialect.name
+    if dialect in DIALECT_INSERTS:
+        db.execute(_upsert_statement(dialect), rows)
+    else:
+        _upsert_generic(db, device_id, rows)
+    return len(rows)
+
+
+def _stored_types(db: Session, device_id: str, name_ids: list) -> Dict[int, str]:
+    """Types already stored for some of a device's parameters, by name id"""
+    return dict(
+        db.query(Parameter.name_id, Parameter.type).filter(
+            Parameter.device_id == device_id,
+            Parameter.name_id.in_(name_ids),
+            Parameter.type.isnot(None)
+        ).all()
+    )
+
+
+def _upsert_generic(db: Session, device_id: str, rows: list) -> None:
+    """Fallback for dialects without ON CONFLICT: one lookup, then bulk insert/update"""
+    existing = dict(
+        db.query(Parameter.name_id, Parameter.id).filter(
+            Parameter.device_id == device_id,
+            Parameter.name_id.in_([row['name_id'] for row in rows])
+        ).all()
+    )
+    updates = [
+        {key: value for key, value in dict(row, id=existing[row['name_id']]).items()
+         if key != 'type' or value is not None}
+        for row in rows if row['name_id'] in existing
+    ]
+    inserts = [row for row in rows if row['name_id'] not in existing]
+    if updates:
+        db.bulk_update_mappings(Parameter, updates)
+    if inserts:
+        db.bulk_insert_mappings(Parameter, inserts, render_nulls=True)
+
+
+async def upsert_parameters_async(db: AsyncSession, device_id: str, parameters: Dict[str, str],
+                                  updated_at: Optional[datetime] = None,
+                                  types: Optional[Dict[str, str]] = None) -> int:
+    """upsert_parameters() for an AsyncSession"""
+    return await db.run_sync(
+        lambda session: upsert_parameters(session, device_id, parameters, updated_at, types)
+    )
+
+
+class ParameterIngest:
+    """Writes a stream of (name, value, xsi:type) in chunked upserts, skipping unchanged values
+
+    Every full chunk is upserted and committed as it fills, so neither memory nor the
+    database write lock grows with the response; its rows carry their value hashes, so an
+    ingest that never finishes leaves nothing to rewrite. finish() writes the last chunk
+    without committing; the caller commits it with its own changes and then calls remember().
+    """
+
+    def __init__(self, db: AsyncSession, device: Device, chunk_size: Optional[int] = None):
+        self.db = db
+        self.device = device
+        self.chunk_size = max(chunk_size or settings.PARAMETER_INGEST_CHUNK_SIZE, 1)
+        self.updated_at = datetime.utcnow()
+        self.received = 0
+        self.written = 0
+        self.chunks = 0
+        self._updates: Dict[int, int] = {}  # fingerprints of the rows written, not yet committed
+        self._values: Dict[str, str] = {}
+        self._types: Dict[str, str] = {}
+
+    async def add(self, values: list) -> None:
+        """Queue (name, value, type) tuples, writing and committing every full chunk"""
+        for name, value, value_type in values:
+            self._values[name] = value
+            if value_type:
+                self._types[name] = value_type
+            if len(self._values) >= self.chunk_size:
+                await self._write()
+                await self.db.commit()
+                self.remember()
+
+    async def _write(self) -> None:
+        if not self._values:
+            return
+        self.received += len(self._values)
+        changed, updates = await parameter_fingerprints.diff(self.db, self.device.id, self._values, self._types)
+        if changed:
+            await upsert_parameters_async(self.db, self.device.id, changed, self.updated_at, self._types)
+            self._updates.update(updates)
+            self.written += len(changed)
+            self.chunks += 1
+        self._values = {}
+        self._types = {}
+
+    async def finish(self) -> Dict[str, int]:
+        """Write the last partial chunk; returns a summary"""
+        await self._write()
+        return {
+            'parameters': self.received,
+            'written': self.written,
+            'unchanged': self.received - self.written,
+            'chunks': self.chunks
+        }
+
+    def remember(self) -> None:
+        """Cache the fingerprints of the rows written once the transaction committed"""
+        parameter_fingerprints.remember(self.device.id, self._updates)
+        self._updates = {}
@@ -0,0 +1,79 @@
+"""
+Parameter Types
+Typed shadow values of CPE parameters, derived from their xsi:type
+"""
+from datetime import datetime, timezone
+from typing import Any, Dict, Optional
+
+# xsi:type local names (TR-069 data model types and common vendor variants) -> shadow column
+TYPE_COLUMNS = {
+    'int': 'value_int',
+    'integer': 'value_int',
+    'long': 'value_int',
+    'short': 'value_int',
+    'byte': 'value_int',
+    'unsignedInt': 'value_int',
+    'unsignedLong': 'value_int',
+    'unsignedShort': 'value_int',
+    'unsignedByte': 'value_int',
+    'float': 'value_float',
+    'double': 'value_float',
+    'decimal': 'value_float',
+    'boolean': 'value_bool',
+    'dateTime': 'value_time',
+}
+
+SHADOW_COLUMNS = ('value_int', 'value_float', 'value_bool', 'value_time')
+
+# Signed 64-bit range of the value_int column; larger unsignedLong counters stay text-only
+INT_MIN = -2 ** 63
+INT_MAX = 2 ** 63 - 1
+
+EMPTY_SHADOWS = dict.fromkeys(SHADOW_COLUMNS)
+
+
+def type_name(value_type: Optional[str]) -> Optional[str]:
+    """xsi:type without its namespace prefix ('xsd:unsignedInt' -> 'unsignedInt')"""
+    return value_type.rsplit(':', 1)[-1] if value_type else None
+
+
+def convert(value: Optional[str], column: str) -> Any:
+    """Convert text to the Python value stored in a shadow column; raises ValueError"""
+    if value is None:
+        raise ValueError('no value')
+    value = value.strip()
+    if column == 'value_int':
+        number = int(value)
+        if not INT_MIN <= number <= INT_MAX:
+            raise ValueError(f'{value} is out of range')
+        return number
+    if column == 'value_float':
+        return float(value)
+    if column == 'value_bool':
+        lowered = value.lower()
+        if lowered in ('true', '1'):
+            return True
+        if lowered in ('false', '0'):
+            return False
+        raise ValueError(f'{value} is not a boolean')
+    if column == 'value_time':
+        parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        # Stored naive in UTC, like every other timestamp in the schema
+        if parsed.tzinfo is not None:
+            parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+        return parsed
+    raise ValueError(f'unknown column {column}')
+
+
+def shadow_values(value: Optional[str], value_type: Optional[str]) -> Dict[str, Any]:
+    """Shadow columns of a parameter row; all None when the type is unknown or the value does not parse"""
+    column = TYPE_COLUMNS.get(type_name(value_type))
+    if column is None:
+        return EMPTY_SHADOWS
+    try:
+        converted = convert(value, column)
+    except ValueError:
+        return EMPTY_SHADOWS
+    shadows = dict(EMPTY_SHADOWS)
+    shadows[column] = converted
+    return shadows
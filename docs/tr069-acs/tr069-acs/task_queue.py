@@ -0,0 +1,92 @@
+"""
+Task Queue
+Claims a device's next task atomically, in queue order, across workers and nodes
+"""
+from datetime import datetime, timedelta
+from typing import Optional
+
+from sqlalchemy import func, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased
+
+from config import settings
+from fleet_counters import fleet_counters
+from metrics import metrics
+from models import Task
+
+
+def _head(device_id: str):
+    """Id of the device's oldest unfinished task: the only one that may be claimed
+
+    A 'sent' task holds the queue until it is answered or its lease expires, so two
+    sessions of one device never run its tasks out of order or side by side. Task ids
+    only grow, so the head never moves back to an older task.
+    """
+    unfinished = ('pending', 'sent') if settings.TASK_RESPONSE_TIMEOUT > 0 else ('pending',)
+    queued = aliased(Task)
+    return (
+        select(queued.id)
+        .filter(queued.device_id == device_id, queued.status.in_(unfinished))
+        .order_by(queued.id)
+        .limit(1)
+        .scalar_subquery()
+    )
+
+
+async def claim_next_task(db: AsyncSession, device_id: str) -> Optional[Task]:
+    """Mark the device's next task 'sent' and return it, committed; None when there is none to send
+
+    The head task is read, then claimed with an UPDATE ... RETURNING that only matches
+    while its status and retries are still the ones read, so of two sessions racing for
+    it exactly one gets a row. Only a claimable head takes SQLite's write lock. On
+    PostgreSQL the read is SELECT ... FOR UPDATE SKIP LOCKED: a session that finds
+    another worker claiming the device's queue returns at once instead of waiting.
+    A head left 'sent' past its lease (TASK_RESPONSE_TIMEOUT) is claimed again as a
+    retry, or failed once MAX_TASK_RETRIES is spent.
+    """
+    lease = timedelta(seconds=settings.TASK_RESPONSE_TIMEOUT)
+    while True:
+        now = datetime.utcnow()
+        query = select(Task.id, Task.status, Task.retries, Task.sent_at, Task.created_at,
+                       Task.next_attempt_at).where(Task.id == _head(device_id))
+        if db.bind.dialect.name == 'postgresql':
+            query = query.with_for_update(skip_locked=True)
+        head = (await db.execute(query)).first()
+
+        retries = (head.retries or 0) if head else 0
+        if head is None:
+            values = None
+        elif head.status == 'pending':
+            # Backing off after a timeout: later tasks wait behind it
+            ready = head.next_attempt_at is None or head.next_attempt_at <= now
+            values = {'status': 'sent', 'sent_at': now} if ready else None
+        elif (head.sent_at or head.created_at) >= now - lease:
+            values = None  # in flight in another session
+        elif retries < settings.MAX_TASK_RETRIES:
+            # Unanswered past its lease: the session that sent it is gone
+            values = {'status': 'sent', 'sent_at': now, 'retries': retries + 1}
+        else:
+            values = {'status': 'failed', 'completed_at': now,
+                      'result': {'error': f'No response after {retries + 1} attempts'}}
+        if values is None:
+            await db.commit()
+            return None
+
+        task = (await db.scalars(
+            update(Task)
+            .where(Task.id == head.id, Task.status == head.status, func.coalesce(Task.retries, 0) == retries)
+            .values(**values)
+            .returning(Task)
+            .execution_options(synchronize_session=False, populate_existing=True)
+        )).first()
+        await db.commit()
+        if task is None:
+            continue  # another session changed it first
+        if task.status == 'failed':
+            metrics.incr('tasks_timed_out')
+            continue
+        if head.status == 'pending':
+            fleet_counters.tasks_queued(-1)
+        else:
+            metrics.incr('task_leases_reclaimed')
+        return task
@@ -0,0 +1,194 @@
+"""
+Task Retries
+Requeues tasks a CPE never answered, with exponential backoff, and fails them after MAX_TASK_RETRIES
+"""
+import asyncio
+import heapq
+import logging
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Set, Tuple
+
+from sqlalchemy import and_, func, or_, select, update
+
+from config import settings
+from connection_requests import connection_requests
+from device_cache import device_cache
+from fleet_counters import fleet_counters
+from metrics import metrics
+from models import AsyncSessionLocal, Task
+
+logger = logging.getLogger(__name__)
+
+# Tasks per UPDATE when a sweep requeues or fails them
+SWEEP_BATCH_SIZE = 500
+
+
+class TaskRetryScheduler:
+    """Response deadlines of the tasks sent to CPEs
+
+    A task still 'sent' `timeout` seconds after it went out is set back to 'pending' with
+    next_attempt_at `retry_delay * 2**retries` ahead, and the device is sent a connection
+    request once that time comes. A task sent max_retries + 1 times without an answer is
+    failed. Deadlines sit in a min-heap; answered tasks leave stale entries that are dropped
+    when they reach the top. The UPDATEs re-check status and retries, so an answer (or a
+    resend by another worker) that lands first wins.
+    """
+
+    def __init__(self, timeout: float = 120, max_retries: int = 3, retry_delay: float = 60,
+                 interval: float = 10):
+        self.enabled = timeout > 0
+        self.timeout = timedelta(seconds=timeout)
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.interval = interval
+        self._deadlines: List[Tuple[datetime, int]] = []  # heap of (deadline, task id), possibly stale
+        self._sent: Dict[int, Tuple[datetime, int]] = {}  # task id -> (deadline, retries when sent)
+        self._retry_at: List[Tuple[datetime, str]] = []  # heap of (next attempt, device id)
+        self._task: Optional[asyncio.Task] = None
+
+    def sent(self, task_id: int, sent_at: datetime, retries: int) -> None:
+        """Start waiting for the response to a task"""
+        if not self.enabled:
+            return
+        deadline = sent_at + self.timeout
+        self._sent[task_id] = (deadline, retries)
+        heapq.heappush(self._deadlines, (deadline, task_id))
+
+    def answered(self, task_id: int) -> None:
+        """The CPE answered the task; its heap entry goes stale"""
+        self._sent.pop(task_id, None)
+
+    def expired(self, now: Optional[datetime] = None) -> Dict[int, List[int]]:
+        """Remove and return the unanswered tasks whose deadline passed, by retries so far"""
+        now = now or datetime.utcnow()
+        expired: Dict[int, List[int]] = {}
+        heap = self._deadlines
+        while heap and heap[0][0] <= now:
+            deadline, task_id = heapq.heappop(heap)
+            entry = self._sent.get(task_id)
+            if entry is None or entry[0] != deadline:
+                continue  # answered, or sent again since this entry was pushed
+            del self._sent[task_id]
+            expired.setdefault(entry[1], []).append(task_id)
+        return expired
+
+    def due(self, now: Optional[datetime] = None) -> Set[str]:
+        """Remove and return the devices with a requeued task whose backoff has elapsed"""
+        now = now or datetime.utcnow()
+        devices = set()
+        while self._retry_at and self._retry_at[0][0] <= now:
+            devices.add(heapq.heappop(self._retry_at)[1])
+        return devices
+
+    async def sweep(self, now: Optional[datetime] = None) -> int:
+        """Requeue or fail the expired tasks and wake the devices due a retry; returns tasks handled"""
+        now = now or datetime.utcnow()
+        handled = 0
+        for retries, task_ids in self.expired(now).items():
+            for start in range(0, len(task_ids), SWEEP_BATCH_SIZE):
+                handled += await self._expire(task_ids[start:start + SWEEP_BATCH_SIZE], retries, now)
+        devices = self.due(now)
+        if devices:
+            async with AsyncSessionLocal() as db:
+                for device_id in devices:
+                    device = await device_cache.get(db, device_id)
+                    if device is not None:
+                        connection_requests.trigger(device)
+        return handled
+
+    async def _expire(self, task_ids: List[int], retries: int, now: datetime) -> int:
+        """One batch of tasks sent `retries` times before: back to pending, or failed"""
+        unanswered = (
+            Task.id.in_(task_ids),
+            Task.status == 'sent',
+            func.coalesce(Task.retries, 0) == retries
+        )
+        async with AsyncSessionLocal() as db:
+            if retries < self.max_retries:
+                next_attempt = now + timedelta(seconds=self.retry_delay * 2 ** retries)
+                statement = update(Task).where(*unanswered).values(
+                    status='pending', retries=retries + 1, next_attempt_at=next_attempt
+                )
+            else:
+                next_attempt = None
+                statement = update(Task).where(*unanswered).values(
+                    status='failed', completed_at=now,
+                    result={'error': f'No response after {retries + 1} attempts'}
+                )
+            rows = (await db.execute(
+                statement.returning(Task.id, Task.device_id).execution_options(synchronize_session=False)
+            )).all()
+            await db.commit()
+
+        if next_attempt is None:
+            metrics.incr('tasks_timed_out', len(rows))
+        else:
+            fleet_counters.tasks_queued(len(rows))
+            metrics.incr('task_retries', len(rows))
+            for device_id in {row.device_id for row in rows}:
+                heapq.heappush(self._retry_at, (next_attempt, device_id))
+        return len(rows)
+
+    async def load(self) -> int:
+        """Track the tasks the database has in flight or backing off; returns how many"""
+        count = 0
+        now = datetime.utcnow()
+        async with AsyncSessionLocal() as db:
+            result = await db.stream(
+                select(Task.id, Task.device_id, Task.status, Task.retries, Task.sent_at,
+                       Task.created_at, Task.next_attempt_at)
+                .filter(or_(
+                    Task.status == 'sent',
+                    and_(Task.status == 'pending', Task.next_attempt_at > now)
+                ))
+                .execution_options(yield_per=SWEEP_BATCH_SIZE)
+            )
+            async for rows in result.partitions():
+                for row in rows:
+                    if row.status == 'pending':
+                        heapq.heappush(self._retry_at, (row.next_attempt_at, row.device_id))
+                    elif row.id not in self._sent:
+                        # Rows sent before sent_at existed count from their creation
+                        self.sent(row.id, row.sent_at or row.created_at or now, row.retries or 0)
+                count += len(rows)
+        return count
+
+    async def _run(self) -> None:
+        """Load the tasks in flight, then sweep every interval"""
+        while True:
+            try:
+                count = await self.load()
+                logger.info("Task retry scheduler tracking %d tasks", count)
+                break
+            except Exception:
+                logger.exception("Loading tasks in flight failed; retrying")
+                await asyncio.sleep(self.interval)
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.sweep()
+            except Exception:
+                logger.exception("Task retry sweep failed; retrying on the next cycle")
+
+    async def start(self) -> None:
+        """Start sweeping; the tasks in flight load in the background"""
+        if self.enabled and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stop sweeping"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def __len__(self) -> int:
+        return len(self._sent)
+
+
+# Global task retry scheduler
+task_retries = TaskRetryScheduler(settings.TASK_RESPONSE_TIMEOUT, settings.MAX_TASK_RETRIES,
+                                  settings.TASK_RETRY_DELAY, settings.TASK_RETRY_SWEEP_INTERVAL)
@@ -5,11 +5,27 @@ Simulates a CPE device connecting to the ACS for testing
 import requests
 import xml.etree.ElementTree as ET
 from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import hashlib
+import os
+import re
+import secrets
+import threading
 import time
 import sys
 
 ACS_URL = "http://localhost:8080/cwmp"
 
+# Where the ACS sends connection requests; 'listen' mode points it at its own server
+CONNECTION_REQUEST_URL = 'http://192.168.1.1:7547/'
+# Digest credentials the ACS must present (the ACS reads the same variables)
+CONNECTION_REQUEST_USERNAME = os.getenv('CONNECTION_REQUEST_USERNAME', 'cpe')
+CONNECTION_REQUEST_PASSWORD = os.getenv('CONNECTION_REQUEST_PASSWORD', 'cpe-secret')
+CONNECTION_REQUEST_REALM = 'TestRouter'
+
+# Inform attempts after the ACS answers 503 (it sends Retry-After)
+INFORM_RETRIES = 3
+
 # Sample device information
 DEVICE_INFO = {
     'manufacturer': 'TestVendor',
@@ -18,7 +34,7 @@ DEVICE_INFO = {
     'serial_number': 'TEST123456'
 }
 
-def create_inform_message():
+def create_inform_message(events=('0 BOOTSTRAP', '2 PERIODIC')):
     """Create TR-069 Inform message"""
     envelope = ET.Element('{http://schemas.xmlsoap.org/soap/envelope/}Envelope')
     envelope.set('xmlns:soap', 'http://schemas.xmlsoap.org/soap/envelope/')
@@ -48,21 +64,13 @@ def create_inform_message():
     
     # Event
     event = ET.SubElement(inform, 'Event')
-    event.set('soap:arrayType', 'cwmp:EventStruct[2]')
-    
-    # Event 1: BOOTSTRAP
-    event_struct1 = ET.SubElement(event, 'EventStruct')
-    event_code1 = ET.SubElement(event_struct1, 'EventCode')
-    event_code1.text = '0 BOOTSTRAP'
-    event_key1 = ET.SubElement(event_struct1, 'CommandKey')
-    event_key1.text = ''
-    
-    # Event 2: PERIODIC
-    event_struct2 = ET.SubElement(event, 'EventStruct')
-    event_code2 = ET.SubElement(event_struct2, 'EventCode')
-    event_code2.text = '2 PERIODIC'
-    event_key2 = ET.SubElement(event_struct2, 'CommandKey')
-    event_key2.text = ''
+    event.set('soap:arrayType', f'cwmp:EventStruct[{len(events)}]')
+    for code in events:
+        event_struct = ET.SubElement(event, 'EventStruct')
+        event_code = ET.SubElement(event_struct, 'EventCode')
+        event_code.text = code
+        event_key = ET.SubElement(event_struct, 'CommandKey')
+        event_key.text = ''
     
     # MaxEnvelopes
     max_envelopes = ET.SubElement(inform, 'MaxEnvelopes')
@@ -88,7 +96,7 @@ def create_inform_message():
         'InternetGatewayDevice.DeviceInfo.SerialNumber': DEVICE_INFO['serial_number'],
         'InternetGatewayDevice.DeviceInfo.SoftwareVersion': '1.0.0',
         'InternetGatewayDevice.DeviceInfo.HardwareVersion': '1.0',
-        'InternetGatewayDevice.ManagementServer.ConnectionRequestURL': 'http://192.168.1.1:7547/',
+        'InternetGatewayDevice.ManagementServer.ConnectionRequestURL': CONNECTION_REQUEST_URL,
         'InternetGatewayDevice.WANDevice.1.WANConnectionDevice.1.WANIPConnection.1.ExternalIPAddress': '203.0.113.1'
     }
     
@@ -103,22 +111,85 @@ def create_inform_message():
     return ET.tostring(envelope, encoding='unicode')
 
 
+# Simulated parameter values the device reports and accepts
+DEVICE_PARAMETERS = {
+    'InternetGatewayDevice.DeviceInfo.SoftwareVersion': '1.0.0',
+    'InternetGatewayDevice.DeviceInfo.HardwareVersion': '1.0',
+    'InternetGatewayDevice.ManagementServer.PeriodicInformInterval': '300',
+    'InternetGatewayDevice.LANDevice.1.WLANConfiguration.1.SSID': 'TestNetwork',
+}
+
+
+def create_envelope(cwmp_id):
+    """Create an empty SOAP envelope carrying the ACS request's cwmp:ID"""
+    envelope = ET.Element('{http://schemas.xmlsoap.org/soap/envelope/}Envelope')
+    header = ET.SubElement(envelope, '{http://schemas.xmlsoap.org/soap/envelope/}Header')
+    id_elem = ET.SubElement(header, '{urn:dslforum-org:cwmp-1-0}ID')
+    id_elem.set('{http://schemas.xmlsoap.org/soap/envelope/}mustUnderstand', '1')
+    id_elem.text = cwmp_id
+    body = ET.SubElement(envelope, '{http://schemas.xmlsoap.org/soap/envelope/}Body')
+    return envelope, body
+
+
+def create_rpc_response(method_name, method, cwmp_id):
+    """Answer an ACS request the way a CPE would"""
+    envelope, body = create_envelope(cwmp_id)
+    
+    if method_name == 'GetParameterValues':
+        response = ET.SubElement(body, '{urn:dslforum-org:cwmp-1-0}GetParameterValuesResponse')
+        param_list = ET.SubElement(response, 'ParameterList')
+        names = [name.text for name in method.iter('string')]
+        # A partial path (ending in '.') selects every parameter below it
+        values = {
+            name: value for name, value in DEVICE_PARAMETERS.items()
+            if any(name == n or (n.endswith('.') and name.startswith(n)) for n in names)
+        }
+        for name, value in values.items():
+            param_struct = ET.SubElement(param_list, 'ParameterValueStruct')
+            ET.SubElement(param_struct, 'Name').text = name
+            value_type = 'xsd:unsignedInt' if value.isdigit() else 'xsd:string'
+            value_elem = ET.SubElement(param_struct, 'Value')
+            value_elem.set('{http://www.w3.org/2001/XMLSchema-instance}type', value_type)
+            value_elem.text = value
+    elif method_name == 'SetParameterValues':
+        for param in method.iter('ParameterValueStruct'):
+            DEVICE_PARAMETERS[param.findtext('Name')] = param.findtext('Value')
+        response = ET.SubElement(body, '{urn:dslforum-org:cwmp-1-0}SetParameterValuesResponse')
+        ET.SubElement(response, 'Status').text = '0'
+    elif method_name in ('Reboot', 'FactoryReset'):
+        ET.SubElement(body, f'{{urn:dslforum-org:cwmp-1-0}}{method_name}Response')
+    else:
+        # 9000: Method not supported
+        fault = ET.SubElement(body, '{http://schemas.xmlsoap.org/soap/envelope/}Fault')
+        ET.SubElement(fault, 'faultcode').text = 'Client'
+        ET.SubElement(fault, 'faultstring').text = 'CWMP fault'
+        detail = ET.SubElement(ET.SubElement(fault, 'detail'), '{urn:dslforum-org:cwmp-1-0}Fault')
+        ET.SubElement(detail, 'FaultCode').text = '9000'
+        ET.SubElement(detail, 'FaultString').text = f'Method not supported: {method_name}'
+    
+    return ET.tostring(envelope, encoding='unicode')
+
+
 def parse_acs_response(response_text):
-    """Parse ACS response"""
+    """Parse ACS response into (method name, method element, cwmp:ID, error)"""
+    if not response_text.strip():
+        return None, None, None, "Empty response (session end)"
     try:
         root = ET.fromstring(response_text)
         body = root.find('.//{http://schemas.xmlsoap.org/soap/envelope/}Body')
         
         if body is None or len(body) == 0:
-            return None, "Empty response (session end)"
+            return None, None, None, "Empty response (session end)"
+        
+        cwmp_id = root.findtext('.//{urn:dslforum-org:cwmp-1-0}ID')
         
         # Get the method name
         method = body[0]
         method_name = method.tag.split('}')[-1]
         
-        return method_name, None
+        return method_name, method, cwmp_id, None
     except Exception as e:
-        return None, f"Parse error: {e}"
+        return None, None, None, f"Parse error: {e}"
 
 
 def send_empty_response():
@@ -126,7 +197,7 @@ def send_empty_response():
     return ""
 
 
-def simulate_device_session():
+def simulate_device_session(events=('0 BOOTSTRAP', '2 PERIODIC')):
     """Simulate a complete TR-069 session"""
     print("=" * 60)
     print("TR-069 Device Simulator")
@@ -137,19 +208,27 @@ def simulate_device_session():
     print("=" * 60)
     print()
     
+    # One HTTP session keeps the connection and the ACS session cookie
+    http = requests.Session()
+    headers = {
+        'Content-Type': 'text/xml; charset=utf-8',
+        'SOAPAction': ''
+    }
+    
     # Step 1: Send Inform
     print("[1] Sending Inform message to ACS...")
-    inform_xml = create_inform_message()
+    inform_xml = create_inform_message(events)
     
     try:
-        response = requests.post(
-            ACS_URL,
-            data=inform_xml,
-            headers={
-                'Content-Type': 'text/xml; charset=utf-8',
-                'SOAPAction': ''
-            }
-        )
+        response = http.post(ACS_URL, data=inform_xml, headers=headers)
+        for attempt in range(INFORM_RETRIES):
+            if response.status_code != 503:
+                break
+            # ACS overloaded: retry the session when it says (TR-069 3.2.1.1)
+            retry_after = int(response.headers.get('Retry-After', '30'))
+            print(f"⏳ ACS busy (503), retrying in {retry_after}s")
+            time.sleep(retry_after)
+            response = http.post(ACS_URL, data=inform_xml, headers=headers)
         
         if response.status_code != 200:
             print(f"❌ Error: ACS returned status {response.status_code}")
@@ -160,49 +239,45 @@ def simulate_device_session():
         print(f"   Status: {response.status_code}")
         
         # Parse response
-        method_name, error = parse_acs_response(response.text)
+        method_name, _, _, error = parse_acs_response(response.text)
         
         if error:
-            if "Empty response" in error:
-                print(f"✅ {error}")
-                return
-            else:
-                print(f"❌ {error}")
-                return
+            print(f"❌ {error}")
+            return
         
         if method_name == 'InformResponse':
             print("✅ Received InformResponse from ACS")
         else:
             print(f"⚠️  Unexpected response: {method_name}")
         
-        # Check for more messages
+        # Step 2: No requests of our own, so send an empty POST and answer
+        # every ACS request until the ACS ends the session with an empty response
         print()
         print("[2] Checking for pending tasks...")
         
-        # Send empty request to get next command
-        response = requests.post(
-            ACS_URL,
-            data=send_empty_response(),
-            headers={
-                'Content-Type': 'text/xml; charset=utf-8',
-                'SOAPAction': ''
-            }
-        )
-        
-        method_name, error = parse_acs_response(response.text)
-        
-        if error:
-            if "Empty response" in error:
-                print("✅ No pending tasks (session complete)")
-            else:
+        message = send_empty_response()
+        handled = 0
+        while True:
+            response = http.post(ACS_URL, data=message, headers=headers)
+            if response.status_code not in (200, 204):
+                print(f"❌ Error: ACS returned status {response.status_code}")
+                return
+            
+            method_name, method, cwmp_id, error = parse_acs_response(response.text)
+            
+            if error:
+                if "Empty response" in error:
+                    if handled:
+                        print(f"✅ Queue drained after {handled} request(s) (session complete)")
+                    else:
+                        print("✅ No pending tasks (session complete)")
+                    break
                 print(f"❌ {error}")
-            return
-        
-        if method_name:
-            print(f"📋 ACS requested: {method_name}")
-            print()
-            print("Response from ACS:")
-            print(response.text[:500] + "..." if len(response.text) > 500 else response.text)
+                return
+            
+            handled += 1
+            print(f"📋 ACS requested: {method_name} (ID {cwmp_id})")
+            message = create_rpc_response(method_name, method, cwmp_id)
         
         print()
         print("=" * 60)
@@ -234,13 +309,91 @@ def continuous_inform(interval=30):
         print("\n\nStopped by user")
 
 
+def _md5(*parts):
+    return hashlib.md5(':'.join(parts).encode()).hexdigest()
+
+
+class ConnectionRequestHandler(BaseHTTPRequestHandler):
+    """Answers the ACS's connection requests like a CPE: digest auth, then a new session"""
+    
+    nonces = set()
+    session_lock = threading.Lock()
+    session_requested = threading.Event()
+    
+    def do_GET(self):
+        if not self._authorized():
+            nonce = secrets.token_hex(16)
+            self.nonces.add(nonce)
+            self.send_response(401)
+            self.send_header('WWW-Authenticate',
+                             f'Digest realm="{CONNECTION_REQUEST_REALM}", qop="auth", nonce="{nonce}", algorithm=MD5')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        print(f"\n📞 Connection request from {self.client_address[0]}")
+        # Requests arriving during a session start one more session after it, not one each
+        self.session_requested.set()
+        threading.Thread(target=self._run_sessions, daemon=True).start()
+    
+    def _authorized(self):
+        """Check the Authorization header against RFC 2617 digest with qop=auth"""
+        header = self.headers.get('Authorization', '')
+        if not header.startswith('Digest '):
+            return False
+        fields = {key: quoted or plain for key, quoted, plain in re.findall(r'(\w+)=(?:"([^"]*)"|([^\s,]*))', header)}
+        if fields.get('username') != CONNECTION_REQUEST_USERNAME or fields.get('nonce') not in self.nonces:
+            return False
+        ha1 = _md5(CONNECTION_REQUEST_USERNAME, CONNECTION_REQUEST_REALM, CONNECTION_REQUEST_PASSWORD)
+        ha2 = _md5('GET', fields.get('uri', ''))
+        expected = _md5(ha1, fields['nonce'], fields.get('nc', ''), fields.get('cnonce', ''), 'auth', ha2)
+        return fields.get('response') == expected
+    
+    def _run_sessions(self):
+        if not self.session_lock.acquire(blocking=False):
+            return
+        try:
+            while self.session_requested.is_set():
+                self.session_requested.clear()
+                simulate_device_session(('6 CONNECTION REQUEST',))
+        finally:
+            self.session_lock.release()
+    
+    def log_message(self, format, *args):
+        pass
+
+
+def listen_for_connection_requests(port=7547, host='127.0.0.1'):
+    """Inform once with our own ConnectionRequestURL, then wait for connection requests"""
+    global CONNECTION_REQUEST_URL
+    CONNECTION_REQUEST_URL = f'http://{host}:{port}/'
+    server = ThreadingHTTPServer((host, port), ConnectionRequestHandler)
+    simulate_device_session()
+    print()
+    print(f"Listening for connection requests on {CONNECTION_REQUEST_URL}")
+    print(f"(digest user '{CONNECTION_REQUEST_USERNAME}'; start the ACS with the same "
+          f"CONNECTION_REQUEST_USERNAME/CONNECTION_REQUEST_PASSWORD)")
+    print("Queue a task for this device and it runs at once. Press Ctrl+C to stop")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\n\nStopped by user")
+    finally:
+        server.server_close()
+
+
 if __name__ == "__main__":
     print()
     
     if len(sys.argv) > 1 and sys.argv[1] == "continuous":
         continuous_inform()
+    elif len(sys.argv) > 1 and sys.argv[1] == "listen":
+        listen_for_connection_requests(int(sys.argv[2]) if len(sys.argv) > 2 else 7547)
     else:
         simulate_device_session()
         print()
-        print("💡 Tip: Run 'python test_device.py continuous' for periodic Inform messages")
+        print("💡 Tip: Run 'python test_device.py continuous' for periodic Inform messages,")
+        print("   or 'python test_device.py listen' to take connection requests from the ACS")
         print()
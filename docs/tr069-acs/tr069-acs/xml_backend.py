@@ -0,0 +1,96 @@
+"""
+XML Backends for the CWMP server
+Parse (and re-indent for debug output) through xml.etree (always available) or lxml (when installed).
+Outgoing envelopes are not built here: cwmp_serializer.py splices them from byte templates.
+"""
+import xml.etree.ElementTree as ET
+from abc import ABC, abstractmethod
+from xml.dom import minidom
+
+try:
+    from lxml import etree as lxml_etree
+except ImportError:  # lxml is optional
+    lxml_etree = None
+
+
+class XMLBackend(ABC):
+    """Interface implemented by every XML engine; a backend missing a method cannot be created"""
+
+    name = 'base'
+    ParseError = Exception
+
+    @abstractmethod
+    def fromstring(self, data: bytes):
+        """Parse a complete document and return its root element"""
+
+    @abstractmethod
+    def pull_parser(self):
+        """Create an incremental parser reporting 'start' and 'end' events"""
+
+    @abstractmethod
+    def reindent(self, data: bytes) -> bytes:
+        """Pretty-print an already serialized document"""
+
+
+class StdlibBackend(XMLBackend):
+    """xml.etree.ElementTree (expat)"""
+
+    name = 'stdlib'
+    ParseError = ET.ParseError
+
+    def fromstring(self, data: bytes):
+        return ET.fromstring(data)
+
+    def pull_parser(self):
+        return ET.XMLPullParser(events=('start', 'end'))
+
+    def reindent(self, data):
+        # minidom keeps every xmlns declaration, including ones only referenced from
+        # attribute values such as xsi:type="xsd:string"
+        return minidom.parseString(data).toprettyxml(indent="  ", encoding='utf-8')
+
+
+class LxmlBackend(XMLBackend):
+    """lxml (libxml2)"""
+
+    name = 'lxml'
+    ParseError = lxml_etree.ParseError if lxml_etree is not None else Exception
+
+    def __init__(self):
+        if lxml_etree is None:
+            raise RuntimeError("lxml is not installed")
+        # Match expat: drop comments/PIs from the tree and never fetch external entities
+        self._options = dict(remove_comments=True, remove_pis=True,
+                             resolve_entities=False, no_network=True)
+        self._parser = lxml_etree.XMLParser(**self._options)
+
+    def fromstring(self, data):
+        return lxml_etree.fromstring(data, self._parser)
+
+    def pull_parser(self):
+        return lxml_etree.XMLPullParser(events=('start', 'end'), **self._options)
+
+    def reindent(self, data):
+        parser = lxml_etree.XMLParser(remove_blank_text=True, **self._options)
+        return lxml_etree.tostring(lxml_etree.fromstring(data, parser), encoding='UTF-8',
+                                   xml_declaration=True, pretty_print=True)
+
+
+BACKENDS = {
+    'stdlib': StdlibBackend,
+    'lxml': LxmlBackend,
+}
+
+
+def available_backends() -> list:
+    """Names of the backends usable in this environment"""
+    return [name for name in BACKENDS if name != 'lxml' or lxml_etree is not None]
+
+
+def get_backend(name: str = 'auto') -> XMLBackend:
+    """Create a backend by name; 'auto' prefers lxml when it is installed"""
+    if name == 'auto':
+        name = 'lxml' if lxml_etree is not None else 'stdlib'
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown XML backend: {name}")
+    return BACKENDS[name]()